@@ -59,6 +59,54 @@ chrome.runtime.onMessage.addListener((msg, _sender, sendResponse) => {
   return true;
 });
 
+// Bridge answers kept while the local server is unreachable or busy (oldest
+// dropped).
+const INGEST_BACKLOG_MAX = 200;
+let ingestChain = Promise.resolve();
+
+const storageGet = (keys) => new Promise((resolve) => chrome.storage.local.get(keys, resolve));
+const storageSet = (items) => new Promise((resolve) => chrome.storage.local.set(items, resolve));
+
+// Sends the new answer together with any undelivered ones: a single item to
+// /api/bridge/ingest, several as one /api/bridge/ingest/batch. Items stay in
+// the backlog unless the server stored them or rejected them as invalid (4xx);
+// a network error, 429 or 5xx keeps them for the next answer.
+async function ingestWithBacklog(payload, fetchWithFallback) {
+  const stored = await storageGet(["ingestBacklog"]);
+  const backlog = Array.isArray(stored.ingestBacklog) ? stored.ingestBacklog : [];
+  const items = backlog.concat([payload]).slice(-INGEST_BACKLOG_MAX);
+  const single = items.length === 1;
+  let res;
+  try {
+    res = await fetchWithFallback(single ? "/api/bridge/ingest" : "/api/bridge/ingest/batch", {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      // The reply is not used; slim skips sending the whole chat back.
+      body: JSON.stringify(single ? { ...items[0], slim: true } : { items })
+    });
+  } catch (e) {
+    await storageSet({ ingestBacklog: items });
+    return { ok: false, queued: items.length, error: String(e) };
+  }
+  const data = await res.json().catch(() => ({}));
+  const error = data.error || `HTTP ${res.status}`;
+  if (res.status === 429 || res.status >= 500) {
+    await storageSet({ ingestBacklog: items });
+    return { ok: false, queued: items.length, error };
+  }
+  let results;
+  if (res.ok && !single && Array.isArray(data.results)) {
+    results = data.results;
+  } else {
+    results = items.map(() => (res.ok ? { ok: true } : { ok: false, error }));
+  }
+  // Missing results and per-chat storage failures ("retry") are sent again.
+  const remaining = items.filter((_item, i) => !results[i] || results[i].retry);
+  await storageSet({ ingestBacklog: remaining });
+  const current = results[items.length - 1] || { ok: false, error: "no result" };
+  return { ok: !!current.ok, queued: remaining.length, error: current.error };
+}
+
 chrome.runtime.onMessage.addListener((msg, _sender, sendResponse) => {
   if (!msg || !msg.type) return;
   const bases = ["http://127.0.0.1:5050", "http://localhost:5050"];
@@ -94,13 +142,10 @@ chrome.runtime.onMessage.addListener((msg, _sender, sendResponse) => {
     });
   };
   if (msg.type === "bridge-ingest") {
-    fetchWithFallback("/api/bridge/ingest", {
-      method: "POST",
-      headers: { "Content-Type": "application/json" },
-      body: JSON.stringify(msg.payload || {})
-    })
-      .then(() => sendResponse({ ok: true }))
-      .catch((e) => sendResponse({ ok: false, error: String(e) }));
+    // One ingest at a time, so backlog read-modify-writes never interleave.
+    const run = () => ingestWithBacklog(msg.payload || {}, fetchWithFallback);
+    ingestChain = ingestChain.then(run, run);
+    ingestChain.then(sendResponse, (e) => sendResponse({ ok: false, error: String(e) }));
     return true;
   }
   if (msg.type === "bridge-ui-toggle") {
@@ -206,8 +251,36 @@ chrome.runtime.onMessage.addListener((msg, _sender, sendResponse) => {
       .catch((e) => sendResponse({ ok: false, error: String(e) }));
     return true;
   }
+  if (msg.type === "outbox-claim") {
+    fetchWithFallback("/api/bridge/outbox/claim", {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify({ source: msg.source || "", wait: msg.wait || 0 })
+    })
+      .then((r) => r.json())
+      .then((data) => sendResponse({ ok: true, data }))
+      .catch((e) => sendResponse({ ok: false, error: String(e) }));
+    return true;
+  }
+  if (msg.type === "outbox-ack" || msg.type === "outbox-nack") {
+    const path = msg.type === "outbox-ack" ? "/api/bridge/outbox/ack" : "/api/bridge/outbox/nack";
+    fetchWithFallback(path, {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify({ id: msg.id, token: msg.token })
+    })
+      .then((r) => r.json())
+      .then((data) => sendResponse({ ok: true, data }))
+      .catch((e) => sendResponse({ ok: false, error: String(e) }));
+    return true;
+  }
   if (msg.type === "outbox-count") {
-    fetchWithFallback("/api/bridge/outbox/count")
+    const params = new URLSearchParams();
+    if (msg.known !== null && msg.known !== undefined) {
+      params.set("known", String(msg.known));
+      params.set("wait", String(msg.wait || 0));
+    }
+    fetchWithFallback("/api/bridge/outbox/count?" + params.toString())
       .then((r) => r.json())
       .then((data) => sendResponse({ ok: true, data }))
       .catch((e) => sendResponse({ ok: false, error: String(e) }));
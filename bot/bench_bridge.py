@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# Responsiveness benchmark for bridge.py: several WebSocket clients connect,
+# some of them send prompts to a fake Ollama, the rest measure ping round trips.
+# "--blocking" runs the old behaviour (urllib directly on the event loop) for comparison.
+#
+#   python3 bench_bridge.py [--clients 6] [--generating 3] [--gen-delay 2.0] [--blocking]
+import argparse
+import asyncio
+import json
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import websockets
+
+import bridge
+
+
+class FakeOllama(BaseHTTPRequestHandler):
+    gen_delay = 1.0
+    reply = "Fake answer streamed word by word from a local model."
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        words = self.reply.split(" ")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        if not payload.get("stream"):
+            time.sleep(self.gen_delay)
+            self.wfile.write(json.dumps({"response": self.reply, "done": True}).encode("utf-8"))
+            return
+        for i, word in enumerate(words):
+            time.sleep(self.gen_delay / len(words))
+            piece = word if i == 0 else " " + word
+            self.wfile.write((json.dumps({"response": piece, "done": False}) + "\n").encode("utf-8"))
+            self.wfile.flush()
+        self.wfile.write((json.dumps({"response": "", "done": True}) + "\n").encode("utf-8"))
+
+
+async def blocking_generate(websocket, prompt, stream):
+    return bridge.ollama_generate(prompt, False, lambda piece: None, threading.Event())
+
+
+async def prompt_client(url, n_prompts, out):
+    async with websockets.connect(url) as ws:
+        for _ in range(n_prompts):
+            t0 = time.perf_counter()
+            first = None
+            await ws.send(json.dumps({"type": "prompt", "text": "bench"}))
+            while True:
+                msg = json.loads(await ws.recv())
+                if first is None:
+                    first = time.perf_counter() - t0
+                if msg.get("type") == "response":
+                    break
+            out.append((first, time.perf_counter() - t0))
+
+
+async def ping_client(url, stop, out):
+    async with websockets.connect(url, ping_interval=None) as ws:
+        while not stop.is_set():
+            t0 = time.perf_counter()
+            pong = await ws.ping()
+            await pong
+            out.append(time.perf_counter() - t0)
+            await asyncio.sleep(0.05)
+
+
+def summarize(label, samples):
+    ms = sorted(s * 1000 for s in samples)
+    if not ms:
+        print(f"  {label:<22} no samples")
+        return
+    p95 = ms[min(len(ms) - 1, int(len(ms) * 0.95))]
+    print(f"  {label:<22} n={len(ms):<4} p50={statistics.median(ms):8.1f}ms  p95={p95:8.1f}ms  max={ms[-1]:8.1f}ms")
+
+
+async def run(args):
+    FakeOllama.gen_delay = args.gen_delay
+    fake = ThreadingHTTPServer(("127.0.0.1", 0), FakeOllama)
+    fake.daemon_threads = True
+    threading.Thread(target=fake.serve_forever, daemon=True).start()
+    bridge.OLLAMA_URL = f"http://127.0.0.1:{fake.server_address[1]}"
+    bridge.SCHEDULER_URL = ""
+    if args.blocking:
+        bridge.generate = blocking_generate
+
+    async with websockets.serve(bridge.handle, "127.0.0.1", 0) as srv:
+        port = srv.sockets[0].getsockname()[1]
+        url = f"ws://127.0.0.1:{port}"
+        stop = asyncio.Event()
+        pings = []
+        gens = []
+        pingers = [asyncio.create_task(ping_client(url, stop, pings)) for _ in range(args.clients - args.generating)]
+        await asyncio.gather(*(prompt_client(url, args.prompts, gens) for _ in range(args.generating)))
+        stop.set()
+        await asyncio.gather(*pingers)
+
+    mode = "blocking (urllib on the loop)" if args.blocking else "executor"
+    print(f"[{mode}] {args.clients} clients, {args.generating} generating, fake Ollama delay {args.gen_delay}s")
+    summarize("ping round trip", pings)
+    summarize("first frame", [first for first, _total in gens])
+    summarize("full response", [total for _first, total in gens])
+    fake.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="bridge.py responsiveness benchmark")
+    parser.add_argument("--clients", type=int, default=6)
+    parser.add_argument("--generating", type=int, default=3)
+    parser.add_argument("--prompts", type=int, default=2)
+    parser.add_argument("--gen-delay", type=float, default=2.0)
+    parser.add_argument("--blocking", action="store_true")
+    args = parser.parse_args()
+    bridge.print = lambda *a, **k: None
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
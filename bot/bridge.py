@@ -1,53 +1,169 @@
 #!/usr/bin/env python3
 import asyncio
 import json
-import urllib.request
+import os
+import sys
+import threading
 import websockets
 
+# The pooled Ollama client is shared with the web server.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "local-bot-ui", "web"))
+from ollama_client import OllamaClient, OllamaUnavailable  # noqa: E402
+
 MODEL = "llama3.1:8b"
-OLLAMA_URL = "http://127.0.0.1:11434/api/generate"
+OLLAMA_URL = "http://127.0.0.1:11434"
+# Generations go through the web server's scheduler (/api/generate, same API as
+# Ollama) so they queue behind the UI; without the server, straight to Ollama.
+# Empty disables the detour.
+SCHEDULER_URL = os.environ.get("LOCAL_BOT_URL", "http://127.0.0.1:5050")
+HOST = "127.0.0.1"
+PORT = 8765
 
-async def handle(websocket):
-    print("[Bridge] Client connected")
-    async for message in websocket:
+# Ollama calls run in worker threads; these caps bound how many run at once
+# in total and per connected client (extra prompts wait their turn).
+MAX_GLOBAL_GENERATIONS = 2
+MAX_CLIENT_GENERATIONS = 1
+
+_global_slots = None
+_ollama = None
+_scheduler = None
+
+
+def global_slots():
+    global _global_slots
+    if _global_slots is None:
+        _global_slots = asyncio.Semaphore(MAX_GLOBAL_GENERATIONS)
+    return _global_slots
+
+
+def ollama():
+    global _ollama
+    if _ollama is None:
+        _ollama = OllamaClient(OLLAMA_URL)
+    return _ollama
+
+
+def scheduler():
+    # No retries: a stopped web server should cost nothing before the fallback.
+    global _scheduler
+    if _scheduler is None and SCHEDULER_URL:
+        _scheduler = OllamaClient(SCHEDULER_URL, retries=0)
+    return _scheduler
+
+
+def ollama_generate(prompt, stream, on_piece, cancelled):
+    # Blocking; always called from a worker thread, never on the event loop.
+    if scheduler() is not None:
         try:
-            data = json.loads(message)
-            if data.get("type") != "prompt":
-                continue
+            return _generate(scheduler(), prompt, stream, on_piece, cancelled)
+        except OllamaUnavailable:
+            pass
+    return _generate(ollama(), prompt, stream, on_piece, cancelled)
 
-            prompt = data.get("text", "").strip()
-            if not prompt:
-                await websocket.send(json.dumps({"type": "response", "text": "Пустой запрос"}))
-                continue
 
-            payload = json.dumps({
-                "model": MODEL,
-                "prompt": prompt,
-                "stream": False
-            }).encode("utf-8")
+def _generate(client, prompt, stream, on_piece, cancelled):
+    # Ollama always streams, so that a cancelled generation can be stopped;
+    # without "stream" the pieces are only joined, not sent as deltas.
+    parts = []
+    pieces = client.generate_stream(MODEL, prompt)
+    try:
+        for piece in pieces:
+            if cancelled.is_set():
+                # Closing the stream drops the connection, which stops Ollama.
+                break
+            parts.append(piece)
+            if stream:
+                on_piece(piece)
+    finally:
+        pieces.close()
+    return "".join(parts)
+
 
-            req = urllib.request.Request(
-                OLLAMA_URL,
-                data=payload,
-                headers={"Content-Type": "application/json"},
-                method="POST"
-            )
+async def generate(websocket, prompt, stream):
+    loop = asyncio.get_running_loop()
+    pieces = asyncio.Queue()
+    cancelled = threading.Event()
+    done = object()
 
-            with urllib.request.urlopen(req, timeout=120) as res:
-                response_data = json.loads(res.read().decode("utf-8"))
+    def on_piece(piece):
+        loop.call_soon_threadsafe(pieces.put_nowait, piece)
+
+    def run():
+        try:
+            return ollama_generate(prompt, stream, on_piece, cancelled)
+        finally:
+            loop.call_soon_threadsafe(pieces.put_nowait, done)
 
-            text = response_data.get("response", "(пустой ответ)")
-            await websocket.send(json.dumps({"type": "response", "text": text}))
-            print("[Bridge] Response sent")
+    future = loop.run_in_executor(None, run)
+    try:
+        while True:
+            piece = await pieces.get()
+            if piece is done:
+                break
+            await websocket.send(json.dumps({"type": "delta", "text": piece}))
+        return await future
+    finally:
+        cancelled.set()
+        if not future.done():
+            # Client gone: the caller's slots stay taken until the worker
+            # thread sees `cancelled` at the next piece and drops Ollama.
+            await asyncio.wait([future])
+            if not future.cancelled():
+                future.exception()
 
-        except Exception as e:
-            err = f"Ошибка: {e}"
+
+async def serve_prompt(websocket, data, client_slots):
+    # Streams by default: {"type": "delta"} frames as Ollama produces
+    # tokens, then the usual {"type": "response"} with the full text.
+    prompt = data.get("text", "").strip()
+    if not prompt:
+        await websocket.send(json.dumps({"type": "response", "text": "Пустой запрос"}))
+        return
+    try:
+        async with client_slots, global_slots():
+            text = await generate(websocket, prompt, data.get("stream", True))
+        await websocket.send(json.dumps({"type": "response", "text": text or "(пустой ответ)"}))
+        print("[Bridge] Response sent")
+    except asyncio.CancelledError:
+        print("[Bridge] Generation cancelled: client disconnected")
+        raise
+    except websockets.ConnectionClosed:
+        pass
+    except Exception as e:
+        err = f"Ошибка: {e}"
+        try:
             await websocket.send(json.dumps({"type": "response", "text": err}))
-            print("[Bridge]", err)
+        except websockets.ConnectionClosed:
+            pass
+        print("[Bridge]", err)
+
+
+async def handle(websocket):
+    print("[Bridge] Client connected")
+    client_slots = asyncio.Semaphore(MAX_CLIENT_GENERATIONS)
+    tasks = set()
+    try:
+        async for message in websocket:
+            try:
+                data = json.loads(message)
+            except ValueError:
+                continue
+            if data.get("type") != "prompt":
+                continue
+            task = asyncio.create_task(serve_prompt(websocket, data, client_slots))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    except websockets.ConnectionClosed:
+        pass
+    finally:
+        for task in list(tasks):
+            task.cancel()
+        print("[Bridge] Client disconnected")
+
 
 async def main():
-    print("[Bridge] Starting on ws://127.0.0.1:8765")
-    async with websockets.serve(handle, "127.0.0.1", 8765):
+    print(f"[Bridge] Starting on ws://{HOST}:{PORT}")
+    async with websockets.serve(handle, HOST, PORT):
         await asyncio.Future()
 
 if __name__ == "__main__":
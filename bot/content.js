@@ -26,6 +26,10 @@ let lastSeenText = "";
 let lastSeenAt = 0;
 const RESPONSE_STABLE_MS = 2000;
 const RESPONSE_MAX_WAIT_MS = 25000;
+// Outbox and queue count are long-polled; the server answers as soon as
+// something changes, or after this many seconds.
+const OUTBOX_WAIT_SEC = 25;
+const OUTBOX_RETRY_MS = 2000;
 let bridgeOn = false;
 let autoSendOn = false;
 let autoReceiveOn = false;
@@ -552,12 +556,12 @@ function tryAutoSend(item) {
     }
     if (!inputEl || !sendEl) {
       setStatus(`Не найдены элементы. input=${!!inputEl} send=${!!sendEl}`);
-      return;
+      return false;
     }
     const ok = setInputValue(inputEl, item.text);
     if (!ok) {
       setStatus("Не удалось вставить текст в поле ввода");
-      return;
+      return false;
     }
     setStatus("Текст вставлен, пытаюсь отправить...");
     // snapshot current assistant text to avoid sending previous message
@@ -581,45 +585,82 @@ function tryAutoSend(item) {
       }
       setStatus("Команда отправки выполнена");
     }, 250);
+    return true;
 }
 
+function sendRuntime(msg) {
+  return new Promise((resolve) => {
+    try {
+      chrome.runtime.sendMessage(msg, (res) => {
+        if (chrome.runtime.lastError) {
+          resolve(null);
+          return;
+        }
+        resolve(res);
+      });
+    } catch (e) {
+      contextAlive = false;
+      resolve(null);
+    }
+  });
+}
+
+const delay = (ms) => new Promise((resolve) => setTimeout(resolve, ms));
+
 async function pollOutbox() {
-  if (!bridgeOn || !autoSendOn) return;
-  const source = sourceFromHost();
-  if (!contextAlive || !chrome.runtime?.id) return;
-  try {
-    chrome.runtime.sendMessage({ type: "outbox-next", source }, (res) => {
-      if (chrome.runtime.lastError) return;
-      if (!res || !res.ok) {
-        setStatus("Ошибка связи с локальным UI");
-        return;
-      }
-      const data = res.data;
-      if (data && data.item) {
-        setStatus(`Очередь → отправка в ${data.item.source}`);
-        tryAutoSend(data.item);
-      }
-    });
-  } catch (e) {
-    contextAlive = false;
+  // The item is leased, not removed: it is acked once the text went into the
+  // page, otherwise released (nack) so this or another tab can retry it.
+  const res = await sendRuntime({ type: "outbox-claim", source: sourceFromHost(), wait: OUTBOX_WAIT_SEC });
+  if (!res || !res.ok) {
+    setStatus("Ошибка связи с локальным UI");
+    return false;
+  }
+  const item = res.data && res.data.item;
+  if (!item) return true;
+  let sent = false;
+  if (bridgeOn && autoSendOn) {
+    setStatus(`Очередь → отправка в ${item.source}`);
+    sent = tryAutoSend(item);
   }
+  await sendRuntime({ type: sent ? "outbox-ack" : "outbox-nack", id: item.id, token: item.token });
+  return true;
 }
 
-async function pollQueueCount() {
-  if (!bridgeOn) return;
-  if (!contextAlive || !chrome.runtime?.id) return;
-  try {
-    chrome.runtime.sendMessage({ type: "outbox-count" }, (res) => {
-      if (chrome.runtime.lastError) return;
-      if (!res || !res.ok) {
-        if (queueBadge) queueBadge.textContent = "Очередь: ?";
-        return;
-      }
-      const data = res.data || {};
-      if (queueBadge) queueBadge.textContent = `Очередь: ${data.count ?? 0}`;
-    });
-  } catch (e) {
-    contextAlive = false;
+async function outboxLoop() {
+  while (contextAlive) {
+    if (!bridgeOn || !autoSendOn || !chrome.runtime?.id) {
+      await delay(OUTBOX_RETRY_MS);
+      continue;
+    }
+    const started = Date.now();
+    const ok = await pollOutbox();
+    // An error, or an empty answer that came back at once (the server had no
+    // free long-poll slot), falls back to the old 2s pace.
+    if (!ok || Date.now() - started < 1000) await delay(OUTBOX_RETRY_MS);
+  }
+}
+
+async function queueCountLoop() {
+  let known = null;
+  while (contextAlive) {
+    if (!bridgeOn || !chrome.runtime?.id) {
+      known = null;
+      await delay(OUTBOX_RETRY_MS);
+      continue;
+    }
+    const started = Date.now();
+    const res = await sendRuntime({ type: "outbox-count", known, wait: known === null ? 0 : OUTBOX_WAIT_SEC });
+    if (!res || !res.ok) {
+      if (queueBadge) queueBadge.textContent = "Очередь: ?";
+      known = null;
+      await delay(OUTBOX_RETRY_MS);
+      continue;
+    }
+    const data = res.data || {};
+    const count = data.count ?? 0;
+    if (queueBadge) queueBadge.textContent = `Очередь: ${count}`;
+    if (count === known && Date.now() - started < 1000) await delay(OUTBOX_RETRY_MS);
+    known = count;
   }
 }
 
@@ -757,8 +798,8 @@ function startBridgeObserver() {
 }
 
 startBridgeObserver();
-setInterval(pollOutbox, 2000);
-setInterval(pollQueueCount, 2000);
+outboxLoop();
+queueCountLoop();
 setInterval(() => {
   if (!bridgeOn || !autoReceiveOn) return;
   if (!assistantDirty && Date.now() - pendingSince < RESPONSE_STABLE_MS) return;
@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 import json
 import os
+import sys
+import threading
 import time
 import urllib.request
 import urllib.error
@@ -9,34 +11,32 @@ from tkinter import ttk
 from tkinter import scrolledtext
 
 APP_DIR = os.path.dirname(os.path.abspath(__file__))
+# Chats are read and written through the web server's chat store (snapshot +
+# log, per-chat locks), so both can share a chats dir; graphs are counted with
+# the web server's tokenizer.
+sys.path.insert(0, os.path.join(APP_DIR, "web"))
+import chat_store  # noqa: E402
+from graph import build_graph_from_texts, merge_graph  # noqa: E402
+
 DATA_DIR = os.path.join(APP_DIR, "data")
 CHATS_DIR = os.path.join(DATA_DIR, "chats")
+CHAT_STORE = chat_store.ChatStore(CHATS_DIR)
+# Per-chat session graphs ({"count", "nodes", "edges"}), same files as the web
+# server's; "count" is the number of messages a graph covers.
+SESSION_GRAPHS_DIR = os.path.join(CHATS_DIR, ".graphs")
 GLOBAL_GRAPH_PATH = os.path.join(DATA_DIR, "global_graph.json")
 CONFIG_PATH = os.path.join(DATA_DIR, "config.json")
 
 OLLAMA_TAGS_URL = "http://127.0.0.1:11434/api/tags"
 OLLAMA_GEN_URL = "http://127.0.0.1:11434/api/generate"
+# The web server's Ollama-compatible /api/generate queues requests from here
+# with the browser UI, ahead of bridge traffic. Used when the server is running.
+SCHEDULER_GEN_URL = (os.environ.get("LOCAL_BOT_URL") or "http://127.0.0.1:5050").rstrip("/") + "/api/generate"
 
 DEFAULT_MODEL = "llama3.1:8b"
-
-STOPWORDS = set([
-    "и", "в", "во", "не", "что", "он", "на", "я", "с", "со", "как", "а", "то", "все", "она",
-    "так", "его", "но", "да", "ты", "к", "у", "же", "вы", "за", "бы", "по", "только", "ее",
-    "мне", "было", "вот", "от", "меня", "еще", "нет", "о", "из", "ему", "теперь", "когда",
-    "даже", "ну", "вдруг", "ли", "если", "уже", "или", "ни", "быть", "был", "него", "до",
-    "вас", "нибудь", "опять", "уж", "вам", "ведь", "там", "потом", "себя", "ничего", "ей",
-    "может", "они", "тут", "где", "есть", "надо", "ней", "для", "мы", "тебя", "их", "чем",
-    "была", "сам", "чтоб", "без", "будто", "чего", "раз", "тоже", "себе", "под", "будет",
-    "ж", "тогда", "кто", "этот", "того", "потому", "этого", "какой", "совсем", "ним", "здесь",
-    "этом", "один", "почти", "мой", "тем", "чтобы", "нее", "сейчас", "были", "куда", "зачем",
-    "сказать", "всех", "никогда", "сегодня", "можно", "при", "наконец", "два", "об", "другой",
-    "хоть", "после", "над", "больше", "тот", "через", "эти", "нас", "про", "всего", "них", "какая",
-    "много", "разве", "три", "эту", "моя", "впрочем", "хорошо", "свою", "этой", "перед", "иногда",
-    "лучше", "чуть", "том", "нельзя", "такой", "им", "более", "всегда", "конечно", "всю", "между",
-    "и", "a", "the", "to", "of", "in", "is", "it", "for", "on", "with", "as", "that", "this",
-    "are", "be", "or", "an", "by", "from", "at", "was", "were", "but", "not", "we", "you", "your",
-    "i", "me", "my", "they", "them", "their", "our", "us", "so", "if", "then", "than", "about"
-])
+# The last Ollama model list is kept in config.json and shown at once; it is
+# re-fetched in the background when older than this (the button always does).
+MODELS_TTL_SEC = 60
 
 
 def ensure_dirs():
@@ -54,8 +54,13 @@ def load_json(path, default):
 
 
 def save_json(path, data):
-    with open(path, "w", encoding="utf-8") as f:
+    # Temp file + rename: a crash leaves the old file or the new one, never half.
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
         json.dump(data, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
 
 
 def list_chat_files():
@@ -81,15 +86,10 @@ def fetch_models_from_ollama():
         return []
 
 
-def call_ollama(model, prompt):
-    payload = json.dumps({
-        "model": model,
-        "prompt": prompt,
-        "stream": False
-    }).encode("utf-8")
+def _post_generate(url, payload):
     req = urllib.request.Request(
-        OLLAMA_GEN_URL,
-        data=payload,
+        url,
+        data=json.dumps(payload).encode("utf-8"),
         headers={"Content-Type": "application/json"},
         method="POST"
     )
@@ -98,42 +98,51 @@ def call_ollama(model, prompt):
     return data.get("response", "")
 
 
-def tokenize(text):
-    out = []
-    for raw in text.lower().replace("\n", " ").split(" "):
-        t = "".join(ch for ch in raw if ch.isalnum() or ch in ("-", "_"))
-        if len(t) < 3:
-            continue
-        if t in STOPWORDS:
-            continue
-        out.append(t)
-    return out
-
-
-def build_graph_from_texts(texts):
-    nodes = {}
-    edges = {}
-    for text in texts:
-        tokens = tokenize(text)
-        unique = list(dict.fromkeys(tokens))
-        for t in unique:
-            nodes[t] = nodes.get(t, 0) + 1
-        for i in range(len(unique)):
-            for j in range(i + 1, len(unique)):
-                a, b = unique[i], unique[j]
-                key = "|".join(sorted([a, b]))
-                edges[key] = edges.get(key, 0) + 1
-    return {"nodes": nodes, "edges": edges}
-
-
-def merge_graph(g1, g2):
-    nodes = dict(g1.get("nodes", {}))
-    edges = dict(g1.get("edges", {}))
-    for k, v in g2.get("nodes", {}).items():
-        nodes[k] = nodes.get(k, 0) + v
-    for k, v in g2.get("edges", {}).items():
-        edges[k] = edges.get(k, 0) + v
-    return {"nodes": nodes, "edges": edges}
+def call_ollama(model, prompt):
+    payload = {
+        "model": model,
+        "prompt": prompt,
+        "stream": False
+    }
+    try:
+        return _post_generate(SCHEDULER_GEN_URL, dict(payload, priority="ui"))
+    except urllib.error.HTTPError:
+        raise
+    except (urllib.error.URLError, ConnectionError):
+        # Web server not running.
+        pass
+    return _post_generate(OLLAMA_GEN_URL, payload)
+
+
+def session_graph_path(chat_id):
+    return os.path.join(SESSION_GRAPHS_DIR, f"{chat_id}.json")
+
+
+def save_session_graph(chat_id, graph, count):
+    os.makedirs(SESSION_GRAPHS_DIR, exist_ok=True)
+    save_json(session_graph_path(chat_id), {"count": count, **graph})
+
+
+def load_session_graph(chat_id, messages):
+    # The stored graph if it covers exactly these messages, else rebuilt.
+    data = load_json(session_graph_path(chat_id), None)
+    if isinstance(data, dict) and data.get("count") == len(messages):
+        return {"nodes": data.get("nodes", {}), "edges": data.get("edges", {})}
+    graph = build_graph_from_texts([m.get("content", "") for m in messages])
+    save_session_graph(chat_id, graph, len(messages))
+    return graph
+
+
+def update_session_graph(chat_id, messages, added):
+    # messages already include `added`; only those are counted when the stored
+    # graph covers everything before them.
+    before = len(messages) - len(added)
+    data = load_json(session_graph_path(chat_id), None)
+    if not isinstance(data, dict) or data.get("count") != before:
+        return load_session_graph(chat_id, messages)
+    graph = merge_graph(data, build_graph_from_texts([m.get("content", "") for m in added]))
+    save_session_graph(chat_id, graph, len(messages))
+    return graph
 
 
 class App:
@@ -149,6 +158,7 @@ class App:
 
         self.current_chat_id = None
         self.current_chat = {"id": None, "title": "Новый чат", "messages": []}
+        self.session_graph = {"nodes": {}, "edges": {}}
 
         self._build_ui()
         self._load_chat_list()
@@ -190,7 +200,7 @@ class App:
         self.model_entry = tk.Entry(top_bar, width=20)
         self.model_entry.pack(side=tk.LEFT, padx=(0, 6))
         tk.Button(top_bar, text="Добавить", command=self._add_model).pack(side=tk.LEFT)
-        tk.Button(top_bar, text="Обновить", command=self._refresh_models).pack(side=tk.LEFT, padx=(6, 0))
+        tk.Button(top_bar, text="Обновить", command=lambda: self._refresh_models(force=True)).pack(side=tk.LEFT, padx=(6, 0))
 
         self.chat_view = scrolledtext.ScrolledText(
             self.center,
@@ -239,26 +249,30 @@ class App:
         for f in list_chat_files():
             self.chat_list.insert(tk.END, f.replace(".json", ""))
 
-    def _save_current_chat(self):
-        if not self.current_chat_id:
-            return
-        path = os.path.join(CHATS_DIR, f"{self.current_chat_id}.json")
-        save_json(path, self.current_chat)
+    def _append_messages(self, messages):
+        # Appended to the chat log under the chat lock; the reload picks up
+        # messages another writer (the web server) added meanwhile.
+        chat_id = self.current_chat_id
+        with CHAT_STORE.locks.hold(chat_id):
+            CHAT_STORE.append(chat_id, messages)
+            chat = CHAT_STORE.load(chat_id, chat_store.new_chat(chat_id))
+            self.session_graph = update_session_graph(chat_id, chat["messages"], messages)
+        self.current_chat = chat
 
     def _new_chat(self):
         self.current_chat_id = new_chat_id()
-        self.current_chat = {"id": self.current_chat_id, "title": "Новый чат", "messages": []}
-        self._save_current_chat()
+        self.current_chat = CHAT_STORE.create(self.current_chat_id)
         self._load_chat_list()
         self._render_chat()
-        self._render_graph(session_graph={"nodes": {}, "edges": {}})
+        self.session_graph = {"nodes": {}, "edges": {}}
+        self._render_graph(session_graph=self.session_graph)
 
     def _delete_chat(self):
         if not self.current_chat_id:
             return
-        path = os.path.join(CHATS_DIR, f"{self.current_chat_id}.json")
-        if os.path.exists(path):
-            os.remove(path)
+        CHAT_STORE.delete(self.current_chat_id)
+        if os.path.exists(session_graph_path(self.current_chat_id)):
+            os.remove(session_graph_path(self.current_chat_id))
         self._new_chat()
 
     def _on_chat_select(self, _evt):
@@ -266,8 +280,7 @@ class App:
         if not sel:
             return
         chat_id = self.chat_list.get(sel[0])
-        path = os.path.join(CHATS_DIR, f"{chat_id}.json")
-        data = load_json(path, None)
+        data = CHAT_STORE.load(chat_id, None)
         if not data:
             return
         self.current_chat_id = chat_id
@@ -285,8 +298,25 @@ class App:
         self.chat_view.configure(state=tk.DISABLED)
         self.chat_view.see(tk.END)
 
-    def _refresh_models(self):
+    def _refresh_models(self, force=False):
+        self._apply_models(self.config.get("ollama_models", []), save=False)
+        if force or time.time() - self.config.get("ollama_models_at", 0) >= MODELS_TTL_SEC:
+            threading.Thread(target=self._fetch_models, daemon=True).start()
+
+    def _fetch_models(self):
+        # Worker thread: the Tk UI is only touched back on the main loop.
         auto = fetch_models_from_ollama()
+        self.root.after(0, lambda: self._models_fetched(auto))
+
+    def _models_fetched(self, auto):
+        if not auto:
+            # Ollama unreachable: keep showing the last known list.
+            return
+        self.config["ollama_models"] = auto
+        self.config["ollama_models_at"] = time.time()
+        self._apply_models(auto)
+
+    def _apply_models(self, auto, save=True):
         manual = self.config.get("manual_models", [])
         models = []
         for m in auto + manual:
@@ -300,8 +330,10 @@ class App:
             self.model_var.set(last)
         else:
             self.model_var.set(models[0])
-        self.config["last_model"] = self.model_var.get()
-        save_json(CONFIG_PATH, self.config)
+        if save:
+            # Only a fetched list may replace last_model; the cached one can be empty.
+            self.config["last_model"] = self.model_var.get()
+            save_json(CONFIG_PATH, self.config)
 
     def _add_model(self):
         name = self.model_entry.get().strip()
@@ -324,32 +356,31 @@ class App:
         self.config["last_model"] = model
         save_json(CONFIG_PATH, self.config)
 
-        self.current_chat["messages"].append({"role": "user", "content": prompt})
+        self._append_messages([{"role": "user", "content": prompt}])
         self._render_chat()
-        self._save_current_chat()
 
         self._set_status("Запрос к Ollama...")
         try:
             response = call_ollama(model, prompt)
+        except urllib.error.HTTPError as e:
+            response = "Модель занята, попробуйте позже" if e.code == 429 else f"Ошибка: {e}"
         except urllib.error.URLError as e:
             response = f"Ошибка подключения к Ollama: {e}"
         except Exception as e:
             response = f"Ошибка: {e}"
 
-        self.current_chat["messages"].append({"role": "assistant", "content": response})
+        self._append_messages([{"role": "assistant", "content": response}])
         self._render_chat()
-        self._save_current_chat()
         self._update_graphs_from_chat()
         self._set_status("Готово")
 
     def _render_graph_from_chat(self):
-        texts = [m.get("content", "") for m in self.current_chat.get("messages", [])]
-        session_graph = build_graph_from_texts(texts)
-        self._render_graph(session_graph=session_graph)
+        self.session_graph = load_session_graph(self.current_chat_id, self.current_chat.get("messages", []))
+        self._render_graph(session_graph=self.session_graph)
 
     def _update_graphs_from_chat(self):
-        texts = [m.get("content", "") for m in self.current_chat.get("messages", [])]
-        session_graph = build_graph_from_texts(texts)
+        # self.session_graph was brought up to date by _append_messages.
+        session_graph = self.session_graph
         self.global_graph = merge_graph(self.global_graph, session_graph)
         save_json(GLOBAL_GRAPH_PATH, self.global_graph)
         self._render_graph(session_graph=session_graph)
@@ -30,6 +30,8 @@ let currentChatId = null;
 let sessionGraph = { nodes: {}, edges: {} };
 let globalGraph = { nodes: {}, edges: {} };
 let lastInboxTs = 0;
+// true while /api/events is connected; the 3s polling below is only a fallback.
+let eventsLive = false;
 let autoScroll = true;
 const chatState = {};
 const chatCache = {};
@@ -53,8 +55,9 @@ function addLog(text) {
   miniLog.textContent = logLines.join('\n');
 }
 
-async function apiGet(path) {
-  const res = await fetch(path, { cache: 'no-store' });
+async function apiGet(path, headers) {
+  const res = await fetch(path, { cache: 'no-store', headers: headers || {} });
+  if (res.status === 304) return null;
   const text = await res.text();
   if (!text) {
     throw new Error(res.ok ? 'Пустой ответ сервера' : `HTTP ${res.status}`);
@@ -93,6 +96,60 @@ async function apiPost(path, body) {
   return data;
 }
 
+// POST that understands both JSON and SSE replies. For SSE, onEvent(name, data)
+// is called per event and the payload of the final "done" event is returned.
+async function apiPostStream(path, body, onEvent) {
+  const res = await fetch(path, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify(body || {})
+  });
+  const type = res.headers.get('Content-Type') || '';
+  if (!type.startsWith('text/event-stream') || !res.body) {
+    const text = await res.text();
+    let data;
+    try {
+      data = JSON.parse(text);
+    } catch (e) {
+      throw new Error(`Невалидный ответ: ${text.slice(0, 120)}`);
+    }
+    if (!res.ok) {
+      throw new Error(data.error || `HTTP ${res.status}`);
+    }
+    return data;
+  }
+  const reader = res.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  let result = null;
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+    let sep;
+    while ((sep = buffer.indexOf('\n\n')) >= 0) {
+      const raw = buffer.slice(0, sep);
+      buffer = buffer.slice(sep + 2);
+      let name = 'message';
+      let payload = '';
+      for (const line of raw.split('\n')) {
+        if (line.startsWith('event: ')) name = line.slice(7);
+        else if (line.startsWith('data: ')) payload += line.slice(6);
+      }
+      const data = payload ? JSON.parse(payload) : {};
+      if (name === 'error') {
+        const err = new Error(data.error || 'Ошибка генерации');
+        err.stream = true;
+        throw err;
+      }
+      if (name === 'done') result = data;
+      if (onEvent) onEvent(name, data);
+    }
+  }
+  if (!result) throw new Error('Поток прерван');
+  return result;
+}
+
 function formatUptime(sec) {
   const s = Math.max(0, Math.floor(sec || 0));
   const h = Math.floor(s / 3600);
@@ -103,14 +160,19 @@ function formatUptime(sec) {
   return `${r}с`;
 }
 
+function renderServerStatus(data) {
+  if (!serverInfo) return;
+  const up = formatUptime(data.uptime_sec || 0);
+  const auto = autoScroll ? 'автоскролл: вкл' : 'автоскролл: пауза';
+  const pid = data.pid ? ` • pid ${data.pid}` : '';
+  const mode = eventsLive ? 'push' : 'автообновление 3с';
+  serverInfo.textContent = `Сервер: онлайн • аптайм ${up} • ${mode} • ${auto}${pid}`;
+}
+
 async function refreshServerStatus() {
   if (!serverInfo) return;
   try {
-    const data = await apiGet('/api/status');
-    const up = formatUptime(data.uptime_sec || 0);
-    const auto = autoScroll ? 'автоскролл: вкл' : 'автоскролл: пауза';
-    const pid = data.pid ? ` • pid ${data.pid}` : '';
-    serverInfo.textContent = `Сервер: онлайн • аптайм ${up} • автообновление 3с • ${auto}${pid}`;
+    renderServerStatus(await apiGet('/api/status'));
   } catch (e) {
     serverInfo.textContent = 'Сервер: нет связи';
   }
@@ -276,24 +338,57 @@ function setPending(count) {
   }
 }
 
+function chatPath(id, state, incremental) {
+  if (!incremental) return `/api/chat/${id}`;
+  return `/api/chat/${id}?after=${state.seq}&graph=${encodeURIComponent(state.graphVersion || '')}`;
+}
+
+function applyChatVersion(state, data, seq) {
+  state.seq = seq;
+  state.version = data.version;
+  state.graphVersion = data.graph_version;
+  sessionGraph = data.session_graph || sessionGraph;
+  globalGraph = data.global_graph || globalGraph;
+}
+
+async function applyReply(res, previous) {
+  // Slim replies carry only the appended messages, from seq `after` on.
+  const state = getChatState(currentChatId);
+  if (!res || !res.messages || previous.length < res.after) {
+    await loadChat(currentChatId, { force: true });
+    return;
+  }
+  const messages = previous.slice(0, res.after).concat(res.messages);
+  setChatCache(currentChatId, messages);
+  applyChatVersion(state, res, res.message_count);
+  renderChat(messages);
+  drawGraph();
+}
+
 async function loadChat(id, opts) {
   const options = opts || {};
+  const state = getChatState(id);
+  const cached = chatCache[id] || [];
+  // Polls of the open chat only ask for what changed: 304 if nothing did,
+  // otherwise the messages after the ones we already have.
+  const incremental = !options.force && id === currentChatId && !!state.version && cached.length >= state.seq;
   let data;
   try {
-    data = await apiGet(`/api/chat/${id}`);
+    data = await apiGet(chatPath(id, state, incremental), incremental ? { 'If-None-Match': `"${state.version}"` } : null);
   } catch (e) {
     setStatus(`Ошибка загрузки чата: ${e.message || e}`);
     return;
   }
+  if (data === null) return;
   if (data && data.error) {
     setStatus(`Чат не найден: ${id}`);
     return;
   }
   currentChatId = id;
-  const messages = data.messages || [];
-  const cached = chatCache[id] || [];
+  const delta = data.after !== undefined;
+  const messages = delta ? cached.slice(0, data.after).concat(data.messages || []) : (data.messages || []);
+  const seq = delta ? data.message_count : messages.length;
   const effectiveMessages = messages.length < cached.length ? cached : messages;
-  const state = getChatState(id);
   const newCount = effectiveMessages.length - state.lastCount;
   if (!options.force && !autoScroll && !isNearBottom()) {
     if (newCount > 0) {
@@ -303,9 +398,18 @@ async function loadChat(id, opts) {
       return;
     }
     if (newCount === 0) {
+      applyChatVersion(state, data, seq);
+      drawGraph();
       return;
     }
   }
+  if (delta && !(data.messages || []).length) {
+    // Only the global graph changed.
+    applyChatVersion(state, data, seq);
+    drawGraph();
+    return;
+  }
+  applyChatVersion(state, data, seq);
   state.pending = 0;
   state.lastCount = effectiveMessages.length;
   setPending(0);
@@ -317,8 +421,6 @@ async function loadChat(id, opts) {
     // ignore
   }
   await refreshChats();
-  sessionGraph = data.session_graph || sessionGraph;
-  globalGraph = data.global_graph || globalGraph;
   drawGraph();
   setStatus(`Открыт чат ${id} • сообщений: ${effectiveMessages.length}`);
 }
@@ -332,17 +434,41 @@ async function refreshChats() {
   }
 }
 
+function modelLabel(name, info) {
+  if (!info) return name;
+  const parts = [info.parameter_size, info.quantization].filter(Boolean);
+  if (info.size) parts.push(`${(info.size / 1e9).toFixed(1)} GB`);
+  return parts.length ? `${name} (${parts.join(', ')})` : name;
+}
+
+function renderModels(data) {
+  const current = modelSelect.value;
+  const details = data.details || {};
+  modelSelect.innerHTML = '';
+  (data.models || []).forEach(m => {
+    const opt = document.createElement('option');
+    opt.value = m;
+    opt.textContent = modelLabel(m, details[m]);
+    modelSelect.appendChild(opt);
+  });
+  modelSelect.value = current || data.last || '';
+  if (!modelSelect.value && data.last) modelSelect.value = data.last;
+  const catalog = data.catalog || {};
+  if (catalog.error && catalog.stale) setStatus(`Ollama: ${catalog.error}`);
+}
+
 async function refreshModels() {
   try {
-    const data = await apiGet('/api/models');
-    modelSelect.innerHTML = '';
-    (data.models || []).forEach(m => {
-      const opt = document.createElement('option');
-      opt.value = m;
-      opt.textContent = m;
-      modelSelect.appendChild(opt);
-    });
-    if (data.last) modelSelect.value = data.last;
+    renderModels(await apiGet('/api/models'));
+  } catch (e) {
+    setStatus('Нет связи с сервером');
+  }
+}
+
+async function reloadModels() {
+  // Button: ask Ollama now instead of serving the cached catalog.
+  try {
+    renderModels(await apiPost('/api/models/refresh', {}));
   } catch (e) {
     setStatus('Нет связи с сервером');
   }
@@ -378,7 +504,8 @@ async function sendMessage() {
   const text = promptInput.value.trim();
   if (!text || !currentChatId) return;
   promptInput.value = '';
-  const optimistic = (chatCache[currentChatId] || []).slice();
+  const previous = (chatCache[currentChatId] || []).slice();
+  const optimistic = previous.slice();
   optimistic.push({ role: 'user', content: text });
   setChatCache(currentChatId, optimistic);
   renderChat(optimistic);
@@ -388,22 +515,49 @@ async function sendMessage() {
   try {
     await apiPost('/api/models/last', { name: model });
     await apiPost('/api/sources/last', { name: source });
-    const res = await apiPost('/api/chat/send', {
-      chat_id: currentChatId,
+    const chatId = currentChatId;
+    const streamed = { role: 'assistant', content: '' };
+    const res = await apiPostStream('/api/chat/send', {
+      chat_id: chatId,
       text,
       model,
       source,
-      enqueue: source !== 'Local (Ollama)'
+      enqueue: source !== 'Local (Ollama)',
+      stream: true,
+      slim: true
+    }, (name, data) => {
+      if (name !== 'delta' || chatId !== currentChatId) return;
+      if (!streamed.content) {
+        optimistic.push(streamed);
+        setStatus('Генерация...');
+      }
+      streamed.content += data.text || '';
+      renderChat(optimistic);
     });
-    if (res && res.chat && res.chat.messages) {
-      setChatCache(currentChatId, res.chat.messages);
-      renderChat(res.chat.messages || []);
+    await applyReply(res, previous);
+    if (res.truncated) {
+      setStatus(`Ответ прерван: ${res.error}`);
+      return;
     }
-    sessionGraph = res.session_graph || sessionGraph;
-    globalGraph = res.global_graph || globalGraph;
-    drawGraph();
-    setStatus('Готово');
+    const ctx = res.context_stats;
+    setStatus(ctx && ctx.saved_tokens ? `Готово (контекст: ${ctx.mode}, сэкономлено ~${ctx.saved_tokens} ток.)` : 'Готово');
   } catch (e) {
+    if (e.message === 'busy') {
+      // Generation queue is full (429): nothing was saved, give the text back.
+      setChatCache(currentChatId, previous);
+      renderChat(previous);
+      promptInput.value = text;
+      setStatus('Модель занята, попробуйте позже');
+      return;
+    }
+    if (e.stream) {
+      // The server failed after streaming started: the reply was not saved.
+      setChatCache(currentChatId, previous);
+      renderChat(previous);
+      promptInput.value = text;
+      setStatus(e.message);
+      return;
+    }
     setStatus('Нет связи с сервером');
   }
 }
@@ -429,14 +583,9 @@ async function addBridgeResponse() {
   const text = prompt('Вставьте ответ от ' + source + ':');
   if (!text || !currentChatId) return;
   try {
-    const res = await apiPost('/api/bridge/ingest', { chat_id: currentChatId, source, text });
-    if (res && res.chat && res.chat.messages) {
-      setChatCache(currentChatId, res.chat.messages);
-      renderChat(res.chat.messages || []);
-    }
-    sessionGraph = res.session_graph || sessionGraph;
-    globalGraph = res.global_graph || globalGraph;
-    drawGraph();
+    const previous = (chatCache[currentChatId] || []).slice();
+    const res = await apiPost('/api/bridge/ingest', { chat_id: currentChatId, source, text, slim: true });
+    await applyReply(res, previous);
   } catch (e) {
     setStatus('Нет связи с сервером');
   }
@@ -531,7 +680,7 @@ async function resetGraph() {
 }
 
 newChatBtn.onclick = newChat;
-refreshModelsBtn.onclick = refreshModels;
+refreshModelsBtn.onclick = reloadModels;
 addModelBtn.onclick = addModel;
 refreshSourcesBtn.onclick = refreshSources;
 addSourceBtn.onclick = addSource;
@@ -586,25 +735,65 @@ if (showLogBtn && miniLog) {
   };
 }
 
+async function handleInbox(last) {
+  if (!last) return;
+  if (last.ts && last.ts > lastInboxTs) {
+    lastInboxTs = last.ts;
+    if (last.chat_id && last.chat_id !== currentChatId) {
+      await loadChat(last.chat_id);
+      setStatus(`Переключено на чат ${last.chat_id}`);
+    }
+  }
+}
+
+function connectEvents() {
+  if (!window.EventSource) return;
+  const source = new EventSource('/api/events');
+  const on = (name, fn) => source.addEventListener(name, (ev) => {
+    try {
+      fn(JSON.parse(ev.data || '{}'));
+    } catch (e) {
+      // ignore
+    }
+  });
+  source.onopen = () => {
+    eventsLive = true;
+  };
+  source.onerror = () => {
+    eventsLive = false;
+    // EventSource reconnects by itself unless the server refused (e.g. 429).
+    if (source.readyState === EventSource.CLOSED) {
+      setTimeout(connectEvents, 10000);
+    }
+  };
+  on('status', renderServerStatus);
+  on('chat', async (data) => {
+    if (data.chat_id && data.chat_id === currentChatId) {
+      await loadChat(currentChatId, { force: false });
+    } else {
+      await refreshChats();
+    }
+  });
+  on('inbox', (data) => handleInbox(data.last));
+  on('models', refreshModels);
+}
+
+connectEvents();
+
 setInterval(async () => {
+  if (eventsLive) return;
   if (currentChatId) {
     await loadChat(currentChatId, { force: false });
   }
 }, 3000);
 
 setInterval(async () => {
+  if (eventsLive) return;
   await refreshServerStatus();
 }, 3000);
 
 setInterval(async () => {
+  if (eventsLive) return;
   const data = await apiGet('/api/bridge/inbox/last');
-  const last = data.last;
-  if (!last) return;
-  if (last.ts && last.ts > lastInboxTs) {
-    lastInboxTs = last.ts;
-    if (last.chat_id && last.chat_id !== currentChatId) {
-      await loadChat(last.chat_id);
-      setStatus(`Переключено на чат ${last.chat_id}`);
-    }
-  }
+  await handleInbox(data.last);
 }, 3000);
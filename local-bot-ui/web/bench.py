@@ -0,0 +1,1455 @@
+#!/usr/bin/env python3
+# Local benchmarks for the web server. Every run uses a temporary data dir and a
+# fake Ollama, so nothing in data/ is touched and no model has to be installed.
+#
+#   python3 bench.py load [--generations 4] [--gen-delay 2.0] [--workers 16]
+#   python3 bench.py poll [--tabs 4] [--polls 50]
+#   python3 bench.py outbox [--items 300] [--pollers 12]
+#   python3 bench.py push [--items 5] [--idle 10]
+#   python3 bench.py inbox [--sizes 100,1000,10000]
+#   python3 bench.py storage [--threads 8] [--writes 50]
+#   python3 bench.py locks [--threads 8] [--processes 4]
+#   python3 bench.py ollama [--calls 200] [--down-calls 20]
+#   python3 bench.py models [--loads 50] [--down-loads 3]
+#   python3 bench.py sched [--bridge 8] [--gen-delay 1.0]
+#   python3 bench.py gencache [--prompts 5] [--repeats 4] [--gen-delay 0.5]
+#   python3 bench.py context [--turns 200] [--words 60]
+#   python3 bench.py search [--messages 100000] [--chats 200]
+#   python3 bench.py chatpoll [--messages 1000] [--polls 100]
+#   python3 bench.py wire [--messages 500] [--sends 50]
+#   python3 bench.py ingest [--items 300] [--chats 5]
+#   python3 bench.py metrics [--generations 4] [--gen-delay 0.5] [--reads 200]
+#   python3 bench.py stream [--gen-delay 2.0]
+#   python3 bench.py graph [--lengths 10,100,1000]
+#   python3 bench.py sessions [--lengths 100,1000,5000]
+#   python3 bench.py tokenize [--messages 200] [--words 300]
+#   python3 bench.py compact [--sizes 10000,100000,1000000]
+import argparse
+import contextlib
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class FakeOllama(BaseHTTPRequestHandler):
+    # HTTP/1.1 keep-alive like the real Ollama; streams are chunked.
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    gen_delay = 1.0
+    reply = "Fake answer about graphs, tokens and local models."
+    # A Lock here makes concurrent generations take turns per word, like one
+    # local model: N at once each take about N times longer.
+    gpu = None
+    # Prompt characters received, to compare what callers send.
+    prompt_chars = 0
+
+    def log_message(self, *args):
+        pass
+
+    def _json(self, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/api/tags":
+            return self._json({"models": [{"name": "fake:latest", "size": 4920753328, "details": {
+                "family": "llama", "parameter_size": "8.0B", "quantization_level": "Q4_K_M"}}]})
+        self.send_response(404)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def _chunk(self, data):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def _pieces(self):
+        # The delay is spread evenly over the words of the reply.
+        words = self.reply.split(" ")
+        for i, word in enumerate(words):
+            with self.gpu or contextlib.nullcontext():
+                time.sleep(self.gen_delay / len(words))
+            yield word if i == 0 else " " + word
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        prompt = payload.get("prompt") or ""
+        FakeOllama.prompt_chars += len(prompt)
+        # Like Ollama's context: the previous one plus this exchange, one
+        # "token" per word.
+        done = {"done": True, "context": (payload.get("context") or []) + [0] * len((prompt + " " + self.reply).split())}
+        if not payload.get("stream"):
+            return self._json(dict(done, response="".join(self._pieces())))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for piece in self._pieces():
+            self._chunk((json.dumps({"response": piece, "done": False}) + "\n").encode("utf-8"))
+        self._chunk((json.dumps(dict(done, response="")) + "\n").encode("utf-8"))
+        self._chunk(b"")
+
+
+def start_fake_ollama(gen_delay):
+    FakeOllama.gen_delay = gen_delay
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), FakeOllama)
+    srv.daemon_threads = True
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    return srv
+
+
+def import_server(ollama_port):
+    # server.py reads its data dir and Ollama URL at import time.
+    os.environ["LOCAL_BOT_DATA_DIR"] = tempfile.mkdtemp(prefix="local-bot-bench-")
+    os.environ["OLLAMA_URL"] = f"http://127.0.0.1:{ollama_port}"
+    sys.path.insert(0, BASE_DIR)
+    import server
+    server.ensure_dirs()
+    server.Handler.log_message = lambda *args: None
+    return server
+
+
+def start_server(server, workers):
+    srv = server.make_server("127.0.0.1", 0, workers=workers)
+    srv.daemon_threads = True
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    return srv, f"http://127.0.0.1:{srv.server_address[1]}"
+
+
+def http(base, path, payload=None, timeout=60):
+    data = None if payload is None else json.dumps(payload).encode("utf-8")
+    req = urllib.request.Request(base + path, data=data, headers={"Content-Type": "application/json"})
+    t0 = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as res:
+            res.read()
+            code = res.status
+    except urllib.error.HTTPError as e:
+        code = e.code
+    return code, time.perf_counter() - t0
+
+
+def http_json(base, path, payload=None, timeout=60):
+    data = None if payload is None else json.dumps(payload).encode("utf-8")
+    req = urllib.request.Request(base + path, data=data, headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(req, timeout=timeout) as res:
+        return json.loads(res.read().decode("utf-8"))
+
+
+def summarize(label, samples):
+    if not samples:
+        print(f"  {label:<28} no samples")
+        return
+    ms = sorted(s * 1000 for s in samples)
+    p95 = ms[min(len(ms) - 1, int(len(ms) * 0.95))]
+    print(f"  {label:<28} n={len(ms):<4} p50={statistics.median(ms):8.1f}ms  p95={p95:8.1f}ms  max={ms[-1]:8.1f}ms")
+
+
+def sample_polls(base, stop, out):
+    while not stop.is_set():
+        for path in ("/api/status", "/api/bridge/outbox/count"):
+            _code, dt = http(base, path)
+            out.setdefault(path, []).append(dt)
+        time.sleep(0.05)
+
+
+def bench_load(args):
+    fake = start_fake_ollama(args.gen_delay)
+    server = import_server(fake.server_address[1])
+    for workers in (0, args.workers):
+        srv, base = start_server(server, workers)
+        chat_id = json.loads(urllib.request.urlopen(base + "/api/chat/new", data=b"{}").read())["id"]
+        mode = f"{workers} workers" if workers else "single-threaded"
+        print(f"[{mode}] {args.generations} generations in flight, fake Ollama delay {args.gen_delay}s")
+
+        idle = {}
+        stop = threading.Event()
+        t = threading.Thread(target=sample_polls, args=(base, stop, idle))
+        t.start()
+        time.sleep(0.5)
+        stop.set()
+        t.join()
+
+        busy = {}
+        results = []
+        stop = threading.Event()
+        poller = threading.Thread(target=sample_polls, args=(base, stop, busy))
+        gens = [
+            threading.Thread(target=lambda: results.append(http(base, "/api/chat/send", {"chat_id": chat_id, "text": "bench", "model": "fake:latest"})))
+            for _ in range(args.generations)
+        ]
+        poller.start()
+        for g in gens:
+            g.start()
+        for g in gens:
+            g.join()
+        stop.set()
+        poller.join()
+
+        for path in ("/api/status", "/api/bridge/outbox/count"):
+            summarize(f"{path} idle", idle.get(path, []))
+            summarize(f"{path} busy", busy.get(path, []))
+        codes = {}
+        for code, _dt in results:
+            codes[code] = codes.get(code, 0) + 1
+        summarize("/api/chat/send", [dt for _code, dt in results])
+        print(f"  send status codes: {codes}")
+        srv.shutdown()
+        srv.server_close()
+
+
+class UncachedState:
+    # The old behaviour: every load/save hits the file.
+    def __init__(self, storage):
+        self.storage = storage
+        self.disk_reads = 0
+
+    def load(self, path, default):
+        self.disk_reads += 1
+        return self.storage.load_json(path, default)
+
+    def save(self, path, data):
+        self.storage.save_json(path, data)
+
+    def flush(self):
+        pass
+
+
+def bench_poll(args):
+    # Each tab running content.js polls outbox/count and outbox/next every 2s.
+    fake = start_fake_ollama(0.1)
+    server = import_server(fake.server_address[1])
+    import storage
+    for label, state in (("uncached", UncachedState(storage)), ("cached", storage.JsonCache())):
+        server.STATE_FILES = state
+        srv, base = start_server(server, args.workers)
+        http(base, "/api/sources")
+        http(base, "/api/bridge/outbox/count")
+        time.sleep(storage.FLUSH_SEC)
+        reads_before = state.disk_reads
+        samples = []
+        for _ in range(args.polls):
+            for _tab in range(args.tabs):
+                for path in ("/api/bridge/outbox/count", "/api/bridge/outbox/next?source=ChatGPT", "/api/sources"):
+                    _code, dt = http(base, path)
+                    samples.append(dt)
+        print(f"[{label}] {args.tabs} tabs x {args.polls} polls: {state.disk_reads - reads_before} state file reads")
+        summarize("poll latency", samples)
+        srv.shutdown()
+        srv.server_close()
+
+
+def legacy_outbox_next(storage, path, source):
+    outbox = storage.load_json(path, [])
+    for i, candidate in enumerate(outbox):
+        if candidate.get("source") == source:
+            item = outbox.pop(i)
+            storage.save_json(path, outbox)
+            return item
+    return None
+
+
+def bench_outbox(args):
+    # Exactly-once check: parallel pollers claim/ack over HTTP; "crashy" ones
+    # sometimes drop a lease without acking, so the item must be redelivered.
+    fake = start_fake_ollama(0.1)
+    server = import_server(fake.server_address[1])
+    server.print = lambda *a, **k: None
+    import storage
+    sources = [f"S{i}" for i in range(args.sources)]
+
+    path = os.path.join(os.environ["LOCAL_BOT_DATA_DIR"], "legacy_outbox.json")
+    storage.save_json(path, [{"chat_id": "c", "source": sources[i % len(sources)], "text": str(i)} for i in range(args.items)])
+    got = []
+
+    def legacy_poller(source):
+        while True:
+            try:
+                item = legacy_outbox_next(storage, path, source)
+            except Exception:
+                continue
+            if item is None:
+                return
+            got.append(item["text"])
+
+    threads = [threading.Thread(target=legacy_poller, args=(sources[i % len(sources)],)) for i in range(args.pollers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    dupes = len(got) - len(set(got))
+    print(f"[legacy json list] {args.items} items, {args.pollers} pollers: "
+          f"delivered {len(set(got))}, duplicates {dupes}, lost {args.items - len(set(got))}")
+
+    srv, base = start_server(server, args.workers)
+    ids = [http_json(base, "/api/bridge/outbox/enqueue", {"chat_id": "c", "source": sources[i % len(sources)], "text": str(i)})["id"]
+           for i in range(args.items)]
+    acked = []
+    stats = {"claims": 0, "dropped_leases": 0}
+    lock = threading.Lock()
+
+    def poller(n):
+        rnd = random.Random(n)
+        source = sources[n % len(sources)]
+        crashy = n % 3 == 0
+        while True:
+            item = http_json(base, "/api/bridge/outbox/claim", {"source": source, "visibility": 0.3})["item"]
+            if item is None:
+                if http_json(base, f"/api/bridge/outbox/count?source={source}")["count"] == 0:
+                    return
+                time.sleep(0.05)
+                continue
+            with lock:
+                stats["claims"] += 1
+            if crashy and rnd.random() < 0.2:
+                with lock:
+                    stats["dropped_leases"] += 1
+                continue
+            if http_json(base, "/api/bridge/outbox/ack", {"id": item["id"], "token": item["token"]})["ok"]:
+                with lock:
+                    acked.append(item["id"])
+
+    t0 = time.perf_counter()
+    threads = [threading.Thread(target=poller, args=(n,)) for n in range(args.pollers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - t0
+    exactly_once = sorted(acked) == sorted(ids)
+    print(f"[sqlite claim/ack] {args.items} items, {args.pollers} pollers: acked {len(acked)}, "
+          f"duplicates {len(acked) - len(set(acked))}, lost {len(set(ids) - set(acked))}, "
+          f"claims {stats['claims']} ({stats['dropped_leases']} leases dropped), {elapsed:.2f}s")
+    print(f"  exactly once: {exactly_once}")
+    srv.shutdown()
+    srv.server_close()
+    if not exactly_once:
+        sys.exit(1)
+
+
+def bench_push(args):
+    # Enqueue -> tab dispatch latency and idle request rate: the old 2s polling
+    # vs long-poll claim, plus ingest -> UI latency over /api/events.
+    fake = start_fake_ollama(0.1)
+    server = import_server(fake.server_address[1])
+    server.print = lambda *a, **k: None
+    srv, base = start_server(server, args.workers)
+    chat_id = http_json(base, "/api/chat/new", {})["id"]
+
+    for mode in ("poll 2s", "long-poll"):
+        stop = threading.Event()
+        received = {}
+        requests = [0]
+
+        def tab():
+            while not stop.is_set():
+                if mode == "long-poll":
+                    item = http_json(base, "/api/bridge/outbox/claim", {"source": "Bench", "wait": 25})["item"]
+                else:
+                    item = http_json(base, "/api/bridge/outbox/claim", {"source": "Bench"})["item"]
+                requests[0] += 1
+                if item is not None:
+                    received[item["text"]] = time.perf_counter()
+                    http_json(base, "/api/bridge/outbox/ack", {"id": item["id"], "token": item["token"]})
+                elif mode != "long-poll":
+                    stop.wait(2.0)
+
+        t = threading.Thread(target=tab, daemon=True)
+        t.start()
+        time.sleep(args.idle)
+        idle_requests = requests[0]
+        sent = {}
+        for i in range(args.items):
+            sent[str(i)] = time.perf_counter()
+            http_json(base, "/api/bridge/outbox/enqueue", {"chat_id": chat_id, "source": "Bench", "text": str(i)})
+            time.sleep(0.7)
+        time.sleep(2.5)
+        # A long-poller may still be parked in a 25s wait; it exits on its own.
+        stop.set()
+        print(f"[{mode}] idle {args.idle:.0f}s: {idle_requests} requests")
+        summarize("enqueue -> tab", [received[k] - sent[k] for k in sent if k in received])
+
+    got = []
+    ready = threading.Event()
+
+    def listen():
+        with urllib.request.urlopen(base + "/api/events", timeout=30) as res:
+            event = None
+            for raw in res:
+                line = raw.decode("utf-8").strip()
+                if line.startswith("event:"):
+                    event = line[6:].strip()
+                    if event == "status":
+                        ready.set()
+                elif line.startswith("data:") and event == "inbox":
+                    got.append(time.perf_counter())
+                    if len(got) >= args.items:
+                        return
+
+    t = threading.Thread(target=listen, daemon=True)
+    t.start()
+    ready.wait(5)
+    lat = []
+    for i in range(args.items):
+        t0 = time.perf_counter()
+        http_json(base, "/api/bridge/ingest", {"chat_id": chat_id, "source": "Bench", "text": f"answer {i}"})
+        deadline = time.time() + 5
+        while len(got) <= i and time.time() < deadline:
+            time.sleep(0.001)
+        if len(got) > i:
+            lat.append(got[i] - t0)
+    print("[/api/events]")
+    summarize("ingest -> UI event", lat)
+    server.EVENTS.close()
+    srv.shutdown()
+    srv.server_close()
+
+
+def bench_inbox(args):
+    # Ingest and last-read cost as the inbox history grows: the old JSON list
+    # (load all, append, rewrite) vs segmented log with retention.
+    sys.path.insert(0, BASE_DIR)
+    import inbox
+    import storage
+    tmp = tempfile.mkdtemp(prefix="local-bot-bench-")
+    path = os.path.join(tmp, "bridge_inbox.json")
+    retention = dict(inbox.DEFAULT_RETENTION, max_bytes=args.max_kb * 1024, segment_bytes=args.max_kb * 1024 / 8)
+    log = inbox.Inbox(os.path.join(tmp, "bridge_inbox"))
+    text = "answer " * 80
+    items = []
+    done = 0
+    print(f"per-ingest cost vs history length (retention {args.max_kb}KB)")
+    for n in [int(x) for x in args.sizes.split(",")]:
+        while done < n:
+            item = {"chat_id": "c", "source": "Bench", "text": text, "ts": time.time()}
+            items.append(item)
+            log.append(item, retention)
+            done += 1
+        storage.save_json(path, items)
+        item = {"chat_id": "c", "source": "Bench", "text": text, "ts": time.time()}
+
+        def legacy_ingest():
+            data = storage.load_json(path, [])
+            data.append(item)
+            storage.save_json(path, data)
+
+        t_old, _ = timed(legacy_ingest)
+        t_old_last, _ = timed(lambda: storage.load_json(path, [])[-1])
+        t_new, _ = timed(lambda: log.append(item, retention))
+        t_new_last, _ = timed(log.last)
+        done += 3
+        stats = log.stats()
+        print(f"  {n:>6} items: json ingest {t_old * 1000:8.2f}ms last {t_old_last * 1000:8.2f}ms  "
+              f"({os.path.getsize(path) // 1024}KB) | log ingest {t_new * 1000:6.3f}ms last {t_new_last * 1000:6.3f}ms  "
+              f"({stats['bytes'] // 1024}KB in {stats['segments']} segments)")
+
+
+def bench_storage(args):
+    # Write throughput and file size: old in-place writes vs atomic temp+rename
+    # with a per-write fsync vs the same with group commit, from N threads.
+    sys.path.insert(0, BASE_DIR)
+    import storage
+    tmp = tempfile.mkdtemp(prefix="local-bot-bench-", dir=args.dir)
+    chat = {"id": "x", "title": "bench", "messages": [{"role": "user", "content": t} for t in synthetic_messages(args.messages)]}
+
+    def legacy(path, data):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+
+    def atomic_fsync(path, data):
+        tmp_path = storage._write_temp(path, storage.dump_json(data), True)
+        os.replace(tmp_path, path)
+        storage._fsync_path(os.path.dirname(path), directory=True)
+
+    committer = storage.GroupCommit()
+    if args.fsync_delay_ms:
+        # Models a disk that flushes one request at a time and each flush costs
+        # a few ms (laptop SSD/HDD), unlike tmpfs or most VMs.
+        real_fsync = os.fsync
+        disk = threading.Lock()
+
+        def slow_fsync(fd):
+            with disk:
+                time.sleep(args.fsync_delay_ms / 1000)
+            real_fsync(fd)
+        os.fsync = slow_fsync
+
+    def group(path, data):
+        committer.submit(path, storage.dump_json(data))
+
+    def run(label, write):
+        # Threads save the same few files (chat snapshot, index, graph...).
+        paths = [os.path.join(tmp, f"{label.split()[0]}-{i}.json") for i in range(args.files)]
+
+        def worker(t):
+            for i in range(args.writes):
+                try:
+                    write(paths[(t + i) % len(paths)], chat)
+                except OSError:
+                    pass
+        t0 = time.perf_counter()
+        threads = [threading.Thread(target=worker, args=(t,)) for t in range(args.threads)]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        dt = time.perf_counter() - t0
+        total = args.threads * args.writes
+        broken = 0
+        for path in paths:
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    json.load(f)
+            except ValueError:
+                broken += 1
+        print(f"  {label:<22} {total / dt:8.0f} saves/s  unreadable files: {broken}/{len(paths)}")
+
+    print(f"{args.threads} threads x {args.writes} saves of a {args.messages}-message chat into {args.files} files")
+    run("in place (old)", legacy)
+    run("atomic + fsync each", atomic_fsync)
+    before = committer.fsyncs
+    run("atomic + group commit", group)
+    print(f"  group commit: {committer.batches} batches, {committer.fsyncs - before} fsyncs "
+          f"for {args.threads * args.writes} saves")
+    pretty = len(storage.dump_json(chat, compact=False))
+    compact = len(storage.dump_json(chat, compact=True))
+    print(f"  chat file size: indent=2 {pretty / 1024:.1f}KB, compact {compact / 1024:.1f}KB ({compact / pretty:.0%})")
+    sys.path.insert(0, BASE_DIR)
+    import graph
+    g = graph.to_json_graph(synthetic_graph(100000))
+    pretty = len(storage.dump_json(g, compact=False))
+    compact = len(storage.dump_json(g, compact=True))
+    print(f"  graph file size: indent=2 {pretty / 1024:.0f}KB, compact {compact / 1024:.0f}KB ({compact / pretty:.0%})")
+
+
+class NoLocks:
+    # The old behaviour: no coordination between writers.
+    @contextlib.contextmanager
+    def hold(self, chat_id):
+        yield
+
+
+def append_worker(chats_dir, chat_id, n, tag, locked):
+    sys.path.insert(0, BASE_DIR)
+    import chat_store
+    store = chat_store.ChatStore(chats_dir, None if locked else NoLocks())
+    for i in range(n):
+        store.append(chat_id, [{"role": "user", "content": f"{tag}-{i}"}])
+
+
+def check_chat(chats_dir, chat_id, expected):
+    sys.path.insert(0, BASE_DIR)
+    import chat_store
+    chat = chat_store.ChatStore(chats_dir).load(chat_id)
+    got = [m["content"] for m in chat["messages"]]
+    seqs = []
+    with open(os.path.join(chats_dir, f"{chat_id}.log"), "r", encoding="utf-8") as f:
+        for line in f:
+            seqs.append(json.loads(line)["seq"])
+    return len(expected - set(got)), len(seqs) - len(set(seqs))
+
+
+def bench_locks(args):
+    # Concurrent appends to one chat from threads and from processes, with and
+    # without the per-chat locks; counts lost messages and reused seqs.
+    import multiprocessing
+    sys.path.insert(0, BASE_DIR)
+    import chat_store
+    import storage
+    storage.FSYNC = False
+    for locked in (False, True):
+        label = "per-chat locks" if locked else "no locks (old)"
+        chats_dir = tempfile.mkdtemp(prefix="local-bot-bench-")
+        store = chat_store.ChatStore(chats_dir, None if locked else NoLocks())
+        store.create("threads")
+        t0 = time.perf_counter()
+        threads = [threading.Thread(target=lambda t=t: [store.append("threads", [{"role": "user", "content": f"t{t}-{i}"}])
+                                                        for i in range(args.appends)]) for t in range(args.threads)]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        dt = time.perf_counter() - t0
+        expected = {f"t{t}-{i}" for t in range(args.threads) for i in range(args.appends)}
+        lost, reused = check_chat(chats_dir, "threads", expected)
+        print(f"[{label}] {args.threads} threads x {args.appends} appends: lost {lost}, reused seqs {reused}, "
+              f"{len(expected) / dt:.0f} appends/s")
+        if locked:
+            print(f"  lock waits: {store.locks.stats()}")
+
+        store.create("procs")
+        ctx = multiprocessing.get_context("spawn")
+        procs = [ctx.Process(target=append_worker, args=(chats_dir, "procs", args.appends, f"p{p}", locked))
+                 for p in range(args.processes)]
+        for pr in procs:
+            pr.start()
+        for pr in procs:
+            pr.join()
+        expected = {f"p{p}-{i}" for p in range(args.processes) for i in range(args.appends)}
+        lost, reused = check_chat(chats_dir, "procs", expected)
+        print(f"[{label}] {args.processes} processes x {args.appends} appends: lost {lost}, reused seqs {reused}")
+
+
+def legacy_ollama_tags(base, timeout):
+    # The old per-call urllib request: new TCP connection every time.
+    with urllib.request.urlopen(urllib.request.Request(base + "/api/tags"), timeout=timeout) as res:
+        return json.loads(res.read().decode("utf-8")).get("models", [])
+
+
+def stuck_listener():
+    # A port whose accept queue is full: connects hang like a host that has
+    # stopped answering. Returns (port, sockets to keep open).
+    import socket
+    srv = socket.socket()
+    srv.bind(("127.0.0.1", 0))
+    srv.listen(0)
+    port = srv.getsockname()[1]
+    held = [srv]
+    for _ in range(4):
+        c = socket.socket()
+        c.setblocking(False)
+        c.connect_ex(("127.0.0.1", port))
+        held.append(c)
+    time.sleep(0.1)
+    return port, held
+
+
+def bench_ollama(args):
+    # Per-call latency, fresh urllib connections vs the pooled client, and how
+    # fast calls fail while Ollama is down (refused port, then a stuck host).
+    import socket
+    sys.path.insert(0, BASE_DIR)
+    import ollama_client
+    ollama_client.print = lambda *a, **k: None
+    fake = start_fake_ollama(0.0)
+    base = f"http://127.0.0.1:{fake.server_address[1]}"
+    print(f"{args.calls} sequential /api/tags calls")
+    samples = []
+    for _ in range(args.calls):
+        t0 = time.perf_counter()
+        legacy_ollama_tags(base, 5)
+        samples.append(time.perf_counter() - t0)
+    summarize("urllib per call (old)", samples)
+    client = ollama_client.OllamaClient(base)
+    samples = []
+    for _ in range(args.calls):
+        t0 = time.perf_counter()
+        client.tags()
+        samples.append(time.perf_counter() - t0)
+    summarize("pooled keep-alive", samples)
+    print(f"  connections opened: {client.connects}")
+    client.close()
+
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    refused = s.getsockname()[1]
+    s.close()
+    stuck, held = stuck_listener()
+    for label, port in (("refused", refused), ("stuck", stuck)):
+        url = f"http://127.0.0.1:{port}"
+        print(f"Ollama down ({label}): {args.down_calls} calls")
+        samples = []
+        # Every old call behaves the same; a few are enough.
+        for _ in range(min(3, args.down_calls)):
+            t0 = time.perf_counter()
+            try:
+                legacy_ollama_tags(url, args.legacy_timeout)
+            except (urllib.error.URLError, OSError):
+                pass
+            samples.append(time.perf_counter() - t0)
+        summarize("urllib (old)", samples)
+        client = ollama_client.OllamaClient(url)
+        samples = []
+        for _ in range(args.down_calls):
+            t0 = time.perf_counter()
+            try:
+                client.tags()
+            except urllib.error.URLError:
+                pass
+            samples.append(time.perf_counter() - t0)
+        summarize("client + breaker", samples)
+        summarize("  once breaker is open", samples[ollama_client.BREAKER_THRESHOLD:])
+        print(f"  breaker: {client.stats()}")
+    for sock in held:
+        sock.close()
+
+
+class RefetchEveryTime:
+    # The old /api/models: Ollama is asked on every request.
+    def __init__(self, fetch):
+        import model_catalog
+        self.catalog = model_catalog.ModelCatalog(fetch)
+
+    def get(self):
+        return self.catalog.refresh(wait=None)
+
+
+def bench_models(args):
+    # /api/models page-load latency with Ollama up and stuck, fetching on every
+    # request (old) vs the cached catalog.
+    fake = start_fake_ollama(0.0)
+    server = import_server(fake.server_address[1])
+    import model_catalog
+    import ollama_client
+    model_catalog.print = lambda *a, **k: None
+    ollama_client.print = lambda *a, **k: None
+    srv, base = start_server(server, args.workers)
+    stuck, held = stuck_listener()
+    for label, url, n in (("up", f"http://127.0.0.1:{fake.server_address[1]}", args.loads),
+                          ("stuck", f"http://127.0.0.1:{stuck}", args.down_loads)):
+        print(f"Ollama {label}: {n} page loads")
+        server.MODELS = RefetchEveryTime(lambda url=url: legacy_ollama_tags(url, 5))
+        summarize("fetch per request (old)", [http(base, "/api/models")[1] for _ in range(n)])
+        client = ollama_client.OllamaClient(url)
+        # ttl=0: every load triggers a background revalidation.
+        server.MODELS = model_catalog.ModelCatalog(lambda c=client: c.tags(timeout=5), server.MODELS_CACHE_PATH, ttl=0)
+        summarize("cached catalog", [http(base, "/api/models")[1] for _ in range(max(n, 10))])
+        data = http_json(base, "/api/models")
+        print(f"  models: {data['models']}  catalog: {data['catalog']}")
+    for sock in held:
+        sock.close()
+    srv.shutdown()
+    srv.server_close()
+
+
+def bench_sched(args):
+    # A burst of bridge generations (/api/generate) and one UI send arriving
+    # just after it, against a fake Ollama that runs one word at a time.
+    # Without admission (old) everything shares the model; with the scheduler
+    # the UI goes first and the overflow gets 429.
+    fake = start_fake_ollama(args.gen_delay)
+    FakeOllama.gpu = threading.Lock()
+    server = import_server(fake.server_address[1])
+    import scheduler
+    srv, base = start_server(server, args.workers)
+    chat_id = http_json(base, "/api/chat/new", {})["id"]
+    print(f"{args.bridge} bridge generations + 1 UI send, fake Ollama {args.gen_delay}s per reply, one at a time")
+    for label, sched in (("no admission (old)", scheduler.Scheduler(slots=1000, max_queue=1000, max_running=1000)),
+                         ("scheduler", scheduler.Scheduler())):
+        server.SCHEDULER = sched
+        bridge, codes = [], []
+
+        def bridge_call():
+            code, dt = http(base, "/api/generate", {"model": "fake:latest", "prompt": "bench", "stream": False}, timeout=300)
+            codes.append(code)
+            if code == 200:
+                bridge.append(dt)
+
+        t0 = time.perf_counter()
+        threads = [threading.Thread(target=bridge_call) for _ in range(args.bridge)]
+        for th in threads:
+            th.start()
+        time.sleep(0.2)
+        code, ui = http(base, "/api/chat/send", {"chat_id": chat_id, "text": "bench", "model": "fake:latest"}, timeout=300)
+        for th in threads:
+            th.join()
+        print(f"[{label}] UI send {code} in {ui * 1000:.0f}ms, all done in {time.perf_counter() - t0:.1f}s, "
+              f"bridge codes {dict((c, codes.count(c)) for c in sorted(set(codes)))}")
+        summarize("bridge generation", bridge)
+        print(f"  scheduler: {sched.stats()}")
+    srv.shutdown()
+    srv.server_close()
+
+
+def bench_gencache(args):
+    # Re-sent prompts through /api/chat/send: cache off, on, on after a restart
+    # (disk tier only), and on with "cache": false per request. Single-turn
+    # ("history": false): with history every prompt carries the chat so far.
+    fake = start_fake_ollama(args.gen_delay)
+    server = import_server(fake.server_address[1])
+    import gen_cache
+    srv, base = start_server(server, args.workers)
+    chat_id = http_json(base, "/api/chat/new", {})["id"]
+    prompts = [f"bench prompt {i}" for i in range(args.prompts)]
+    print(f"{args.prompts} prompts x {args.repeats} sends, fake Ollama {args.gen_delay}s per reply")
+    for label, enabled, bypass, restart in (("cache off (old)", False, False, False),
+                                            ("cache on", True, False, False),
+                                            ("cache on, after restart", True, False, True),
+                                            ("cache on, \"cache\": false", True, True, False)):
+        server.STATE_FILES.save(server.CONFIG_PATH, {"gen_cache": {"enabled": enabled}})
+        if restart:
+            server.GEN_CACHE = gen_cache.GenCache(server.GEN_CACHE_DIR)
+        samples = []
+        t0 = time.perf_counter()
+        for _ in range(args.repeats):
+            for text in prompts:
+                body = {"chat_id": chat_id, "text": text, "model": "fake:latest", "history": False}
+                if bypass:
+                    body["cache"] = False
+                samples.append(http(base, "/api/chat/send", body)[1])
+        print(f"[{label}] {len(samples)} sends in {time.perf_counter() - t0:.1f}s")
+        summarize("send", samples)
+        print(f"  {server.GEN_CACHE.stats()}")
+    srv.shutdown()
+    srv.server_close()
+
+
+def bench_context(args):
+    # One long chat through /api/chat/send: prompt size per turn with the
+    # bounded context (Ollama context reuse, window + summary) against
+    # resending every message. Every --interleave turns a message is appended
+    # from elsewhere, which forces a window turn.
+    fake = start_fake_ollama(0.0)
+    FakeOllama.reply = " ".join(["answer"] * args.words)
+    server = import_server(fake.server_address[1])
+    server.print = lambda *a, **k: None
+    srv, base = start_server(server, args.workers)
+    chat_id = http_json(base, "/api/chat/new", {})["id"]
+    print(f"{args.turns} turns, ~{args.words} words per message, budget {server.CONTEXT.max_tokens} tokens")
+    print(f"  {'turn':>5} {'mode':>7} {'sent':>7} {'context':>8} {'resend all':>11} {'saved':>7}")
+    words = "question about the local graph model".split()
+    for turn in range(1, args.turns + 1):
+        if args.interleave and turn % args.interleave == 0:
+            http(base, "/api/bridge/ingest", {"chat_id": chat_id, "source": "Bench", "text": "bridge answer"})
+        text = " ".join(words[(turn + i) % len(words)] for i in range(args.words))
+        report = http_json(base, "/api/chat/send", {"chat_id": chat_id, "text": text, "model": "fake:latest"})["context_stats"]
+        if turn in (1, 2, 10, 50, 100, 200, 500) or turn == args.turns:
+            print(f"  {turn:>5} {report['mode']:>7} {report['prompt_tokens']:>7} {report['context_tokens']:>8} "
+                  f"{report['full_tokens']:>11} {report['saved_tokens']:>7}")
+    stats = server.CONTEXT.stats()
+    print(f"  total: sent {stats['prompt_tokens']} of {stats['full_tokens']} tokens "
+          f"({stats['saved_tokens'] / max(1, stats['full_tokens']):.0%} saved), turns {stats['turns']}")
+    print(f"  prompt chars received by Ollama: {FakeOllama.prompt_chars}")
+    print("cost of building one turn vs chat length (the old path loaded the whole chat)")
+    for n in (100, 1000, 10000):
+        chat_id = f"context-{n}"
+        server.append_chat_messages(chat_id, [{"role": "user" if i % 2 else "assistant", "content": t}
+                                              for i, t in enumerate(synthetic_messages(n, args.words))])
+        server.CHAT_STORE.compact(chat_id)
+        server.append_chat_messages(chat_id, [{"role": "user", "content": t} for t in synthetic_messages(40, args.words, seed=2)])
+        t_cold, _ = timed(lambda: server.chat_turn(chat_id, "fake:latest", "cold"), repeat=1)
+        t_load, _ = timed(lambda: server.CHAT_STORE.load(chat_id))
+        # A different model each time forces a window turn.
+        t_window, _ = timed(lambda: server.chat_turn(chat_id, f"other-{time.perf_counter()}", "next"))
+        server.CONTEXT.commit(chat_id, "fake:latest", server.CHAT_STORE.count(chat_id), [1] * 100)
+        t_ollama, _ = timed(lambda: server.chat_turn(chat_id, "fake:latest", "next"))
+        print(f"  {n:>6} messages: whole chat load {t_load * 1000:7.2f}ms  first turn {t_cold * 1000:7.2f}ms  "
+              f"window turn {t_window * 1000:6.2f}ms  ollama turn {t_ollama * 1000:6.2f}ms")
+    srv.shutdown()
+    srv.server_close()
+
+
+def legacy_search(store, chat_ids, query):
+    # What finding a message took before: open every chat and scan it.
+    terms = query.lower().split()
+    hits = []
+    for chat_id in chat_ids:
+        for seq, m in enumerate(store.load(chat_id)["messages"]):
+            content = m.get("content", "").lower()
+            if any(t in content for t in terms):
+                hits.append((chat_id, seq))
+    return hits
+
+
+def bench_search(args):
+    # Index build, query latency and per-append cost over --messages messages,
+    # against scanning every chat. Word frequencies are skewed, so queries
+    # cover both rare terms and terms found in a large share of messages.
+    sys.path.insert(0, BASE_DIR)
+    import chat_store
+    import search
+    rnd = random.Random(3)
+    vocab = [f"слово{i}" for i in range(args.vocab)]
+    store = chat_store.ChatStore(tempfile.mkdtemp(prefix="local-bot-bench-"))
+    chat_ids = [f"chat{i:04d}" for i in range(args.chats)]
+    per_chat = args.messages // args.chats
+    t0 = time.perf_counter()
+    for chat_id in chat_ids:
+        store.append(chat_id, [
+            {"role": "user" if i % 2 == 0 else "assistant",
+             "content": " ".join(vocab[int(args.vocab * rnd.random() ** 3)] for _ in range(args.words))}
+            for i in range(per_chat)
+        ])
+    print(f"{per_chat * args.chats} messages in {args.chats} chats, {args.words} words each "
+          f"(written in {time.perf_counter() - t0:.1f}s)")
+    index = search.SearchIndex(lambda: chat_ids, lambda chat_id: store.load(chat_id)["messages"])
+    t0 = time.perf_counter()
+    index.start()
+    index._built.wait()
+    print(f"  build: {time.perf_counter() - t0:.2f}s, {index.stats()}")
+    queries = {
+        "rare term": vocab[-1],
+        "mid term": vocab[args.vocab // 10],
+        "common term": vocab[0],
+        "3 terms": f"{vocab[0]} {vocab[args.vocab // 10]} {vocab[-1]}",
+    }
+    for label, query in queries.items():
+        t_new, res = timed(lambda: index.search(query), repeat=args.repeats)
+        line = f"  {label:<12} index {t_new * 1000:8.2f}ms  matches={res['total']:<6}"
+        if args.scan:
+            t_old, _ = timed(lambda: legacy_search(store, chat_ids, query), repeat=1)
+            line += f"  scan {t_old * 1000:8.1f}ms  x{t_old / t_new:7.0f}"
+        print(line)
+    message = {"role": "user", "content": " ".join(rnd.choice(vocab) for _ in range(args.words))}
+    t_add, _ = timed(lambda: index.on_append(chat_ids[0], store.append(chat_ids[0], [message]), [message]))
+    print(f"  append + index one message: {t_add * 1000:.2f}ms")
+
+
+def get_chat(base, path, etag=None):
+    # Returns (status, body bytes, ETag, seconds).
+    req = urllib.request.Request(base + path, headers={"If-None-Match": etag} if etag else {})
+    t0 = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=60) as res:
+            body = res.read()
+            code, tag = res.status, res.headers.get("ETag")
+    except urllib.error.HTTPError as e:
+        body, code, tag = e.read(), e.code, e.headers.get("ETag")
+    return code, body, tag, time.perf_counter() - t0
+
+
+def bench_chatpoll(args):
+    # The open chat's 3s poll: full reload (old) vs If-None-Match when nothing
+    # changed vs ?after=<seq> when one message arrived between polls.
+    fake = start_fake_ollama(0.0)
+    server = import_server(fake.server_address[1])
+    server.print = lambda *a, **k: None
+    srv, base = start_server(server, args.workers)
+    chat_id = http_json(base, "/api/chat/new", {})["id"]
+    text = " ".join(f"слово{i % 400}" for i in range(args.words))
+    server.append_chat_messages(chat_id, [{"role": "user", "content": f"{text} {i}"} for i in range(args.messages)])
+    path = f"/api/chat/{chat_id}"
+    print(f"chat with {args.messages} messages of {args.words} words, {args.polls} polls each")
+
+    def run(label, poll):
+        samples, sizes, codes = [], [], set()
+        for _ in range(args.polls):
+            code, body, dt = poll()
+            samples.append(dt)
+            sizes.append(len(body))
+            codes.add(code)
+        summarize(f"{label} {sorted(codes)}", samples)
+        print(f"  {'':<28} {statistics.mean(sizes) / 1024:8.1f}KB per poll")
+
+    def full():
+        code, body, _tag, dt = get_chat(base, path)
+        return code, body, dt
+
+    data = http_json(base, path)
+    etag = f'"{data["version"]}"'
+
+    def unchanged():
+        code, body, _tag, dt = get_chat(base, path, etag)
+        return code, body, dt
+
+    state = {"seq": len(data["messages"]), "graph": data["graph_version"], "etag": etag}
+
+    def one_new():
+        server.append_chat_messages(chat_id, [{"role": "assistant", "content": "[Bench] новый ответ"}])
+        code, body, tag, dt = get_chat(base, f"{path}?after={state['seq']}&graph={state['graph']}", state["etag"])
+        reply = json.loads(body)
+        state.update(seq=reply["message_count"], graph=reply["graph_version"], etag=tag)
+        return code, body, dt
+
+    run("full reload (old)", full)
+    run("If-None-Match, unchanged", unchanged)
+    run("?after, 1 new message", one_new)
+    srv.shutdown()
+    srv.server_close()
+
+
+def fetch_raw(base, path, payload=None, headers=None):
+    # Returns (status, body bytes as sent, response headers, seconds).
+    data = None if payload is None else json.dumps(payload).encode("utf-8")
+    req = urllib.request.Request(base + path, data=data, headers={"Content-Type": "application/json", **(headers or {})})
+    t0 = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=60) as res:
+            body, code, hdrs = res.read(), res.status, res.headers
+    except urllib.error.HTTPError as e:
+        body, code, hdrs = e.read(), e.code, e.headers
+    return code, body, hdrs, time.perf_counter() - t0
+
+
+def bench_wire(args):
+    # Bytes on the wire per response: the old encoding (json.dumps with
+    # \u escapes and spaces, uncompressed), compact JSON, gzip, and slim
+    # replies; then static files with and without a cached ETag.
+    fake = start_fake_ollama(0.0)
+    server = import_server(fake.server_address[1])
+    server.print = lambda *a, **k: None
+    import compress
+    srv, base = start_server(server, args.workers)
+    chat_id = http_json(base, "/api/chat/new", {})["id"]
+    text = " ".join(f"слово{i % 300} word{i % 70}" for i in range(args.words))
+    server.append_chat_messages(chat_id, [{"role": "user", "content": f"{text} {i}"} for i in range(args.messages)])
+    print(f"/api/bridge/ingest into a chat of {args.messages}+ messages, {args.sends} sends each "
+          f"(brotli {'installed' if compress.brotli else 'not installed'})")
+    gz = {"Accept-Encoding": "gzip, br"}
+    for label, slim, headers in (("compact JSON", False, {}),
+                                 ("compact + compressed", False, gz),
+                                 ("slim + compressed", True, gz)):
+        samples, sizes, legacy = [], [], []
+        for i in range(args.sends):
+            code, body, hdrs, dt = fetch_raw(base, "/api/bridge/ingest",
+                                             {"chat_id": chat_id, "source": "Bench", "text": f"ответ {i}", "slim": slim}, headers)
+            samples.append(dt)
+            sizes.append(len(body))
+            if not headers:
+                legacy.append(len(json.dumps(json.loads(body)).encode("utf-8")))
+        encoding = hdrs.get("Content-Encoding") or "identity"
+        summarize(f"{label} ({encoding})", samples)
+        old = f" (old encoding: {statistics.mean(legacy) / 1024:.1f}KB)" if legacy else ""
+        print(f"  {'':<28} {statistics.mean(sizes) / 1024:8.1f}KB per reply{old}")
+    for filename in ("app.js", "index.html", "styles.css"):
+        path = "/" if filename == "index.html" else f"/{filename}"
+        _code, plain, hdrs, _dt = fetch_raw(base, path)
+        _code, packed, packed_hdrs, _dt = fetch_raw(base, path, headers=gz)
+        t_304, (code, _body, _hdrs, _dt) = timed(lambda: fetch_raw(base, path, headers={"If-None-Match": hdrs["ETag"]}), repeat=20)
+        print(f"  {filename:<12} {len(plain) / 1024:6.1f}KB -> {len(packed) / 1024:5.1f}KB "
+              f"({packed_hdrs.get('Content-Encoding')})  revalidate: {code} in {t_304 * 1000:.2f}ms")
+    srv.shutdown()
+    srv.server_close()
+
+
+def bench_ingest(args):
+    # Replaying a backlog of bridge answers after a reconnect: one
+    # /api/bridge/ingest per item vs a single /api/bridge/ingest/batch.
+    fake = start_fake_ollama(0.0)
+    server = import_server(fake.server_address[1])
+    server.print = lambda *a, **k: None
+    srv, base = start_server(server, args.workers)
+    calls = {"append": 0, "graph": 0}
+
+    def counting(name, fn):
+        def wrapper(*a, **k):
+            calls[name] += 1
+            return fn(*a, **k)
+        return wrapper
+
+    server.CHAT_STORE.append = counting("append", server.CHAT_STORE.append)
+    server.GRAPH.add_batch = counting("graph", server.GRAPH.add_batch)
+    texts = synthetic_messages(args.items, words_per_message=40)
+    print(f"backlog of {args.items} bridge answers across {args.chats} chats")
+    for label, batch in (("one request per item", False), ("one batch request", True)):
+        chats = [f"ingest-{int(batch)}-{c}" for c in range(args.chats)]
+        items = [{"chat_id": chats[i % len(chats)], "source": "Bench", "text": t} for i, t in enumerate(texts)]
+        calls.update(append=0, graph=0)
+        t0 = time.perf_counter()
+        if batch:
+            res = http_json(base, "/api/bridge/ingest/batch", {"items": items})
+            ok = sum(1 for r in res["results"] if r["ok"])
+        else:
+            ok = sum(1 for item in items if http_json(base, "/api/bridge/ingest", {**item, "slim": True}).get("ok"))
+        dt = time.perf_counter() - t0
+        stored = sum(server.CHAT_STORE.count(chat_id) for chat_id in chats)
+        print(f"  {label:<22} {dt * 1000:8.1f}ms total  {dt * 1000 / args.items:6.2f}ms/item  "
+              f"ok={ok} stored={stored} chat appends={calls['append']} graph updates={calls['graph']}")
+    srv.shutdown()
+    srv.server_close()
+
+
+def metric_means(text):
+    # {(name, labels): (mean seconds, count)} from the _sum/_count lines of
+    # /api/metrics histograms.
+    sums, counts = {}, {}
+    for line in text.splitlines():
+        if line.startswith("#") or " " not in line:
+            continue
+        series, value = line.rsplit(" ", 1)
+        name, _, labels = series.partition("{")
+        labels = labels.rstrip("}")
+        if name.endswith("_sum"):
+            sums[(name[:-4], labels)] = float(value)
+        elif name.endswith("_count"):
+            counts[(name[:-6], labels)] = int(value)
+    return {key: (sums[key] / n, n) for key, n in counts.items() if n and key in sums}
+
+
+def bench_metrics(args):
+    # Cost of the always-on metrics, then where request time goes under a
+    # burst of generations, as read back from /api/metrics.
+    fake = start_fake_ollama(args.gen_delay)
+    server = import_server(fake.server_address[1])
+    server.print = lambda *a, **k: None
+    import metrics
+    srv, base = start_server(server, args.workers)
+    n = 200000
+    t_inc, _ = timed(lambda: [metrics.inc("local_bot_http_requests_total", method="GET", route="/bench", code="200") for _ in range(n)])
+    t_obs, _ = timed(lambda: [metrics.observe("local_bot_disk_seconds", 0.001, op="bench") for _ in range(n)])
+    print(f"inc {t_inc / n * 1e9:.0f}ns, observe {t_obs / n * 1e9:.0f}ns per update")
+    chat_id = http_json(base, "/api/chat/new", {})["id"]
+    server.append_chat_messages(chat_id, [{"role": "user", "content": t} for t in synthetic_messages(500)])
+    for label, headers in (("GET /api/chat/<id>", {}), ("  with X-Trace: 1", {"X-Trace": "1"})):
+        samples = [fetch_raw(base, f"/api/chat/{chat_id}", headers=headers)[3] for _ in range(args.reads)]
+        summarize(label, samples)
+    _code, _body, hdrs, _dt = fetch_raw(base, f"/api/chat/{chat_id}", headers={"X-Trace": "1"})
+    print(f"  Server-Timing: {hdrs.get('Server-Timing')}")
+    threads = [threading.Thread(target=http, args=(base, "/api/chat/send", {"chat_id": chat_id, "text": f"bench {i}", "model": "fake:latest"}))
+               for i in range(args.generations)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    t_render, (_code, body, _hdrs, _dt) = timed(lambda: fetch_raw(base, "/api/metrics"), repeat=20)
+    text = body.decode("utf-8")
+    print(f"/api/metrics: {len(text.splitlines())} lines in {t_render * 1000:.2f}ms, "
+          f"{args.generations} sends with fake Ollama delay {args.gen_delay}s:")
+    for (name, labels), (mean, count) in sorted(metric_means(text).items()):
+        if "bench" in labels:
+            continue
+        print(f"  {name[len('local_bot_'):]:<28} {labels:<44} n={count:<5} mean={mean * 1000:9.2f}ms")
+    srv.shutdown()
+    srv.server_close()
+
+
+def bench_stream(args):
+    fake = start_fake_ollama(args.gen_delay)
+    server = import_server(fake.server_address[1])
+    srv, base = start_server(server, args.workers)
+    chat_id = json.loads(urllib.request.urlopen(base + "/api/chat/new", data=b"{}").read())["id"]
+    print(f"time to first token vs full reply, fake Ollama delay {args.gen_delay}s")
+    for stream in (False, True):
+        body = json.dumps({"chat_id": chat_id, "text": "bench", "model": "fake:latest", "stream": stream}).encode("utf-8")
+        req = urllib.request.Request(base + "/api/chat/send", data=body, headers={"Content-Type": "application/json"})
+        t0 = time.perf_counter()
+        first = None
+        with urllib.request.urlopen(req, timeout=60) as res:
+            for line in res:
+                if first is None and line.strip():
+                    first = time.perf_counter() - t0
+        total = time.perf_counter() - t0
+        label = "stream (SSE)" if stream else "buffered JSON"
+        print(f"  {label:<14} first byte {first * 1000:8.1f}ms  complete {total * 1000:8.1f}ms")
+    srv.shutdown()
+    srv.server_close()
+
+
+def synthetic_messages(n, words_per_message=60, vocab_size=3000, seed=1):
+    rnd = random.Random(seed)
+    vocab = [f"word{i}" for i in range(vocab_size)]
+    return [" ".join(rnd.choice(vocab) for _ in range(words_per_message)) for _ in range(n)]
+
+
+def bench_graph(args):
+    sys.path.insert(0, BASE_DIR)
+    import graph
+    from graph import GraphEngine, build_graph_from_texts, merge_graph
+    graph.GRAPH_FLUSH_SEC = 3600
+    tmp = tempfile.mkdtemp(prefix="local-bot-bench-")
+    print("per-message graph update cost: full rebuild (old path) vs incremental engine")
+    for length in [int(x) for x in args.lengths.split(",")]:
+        texts = synthetic_messages(length + args.samples)
+        history, new = texts[:length], texts[length:]
+
+        global_graph = {"nodes": {}, "edges": {}}
+        old = []
+        for i, text in enumerate(new):
+            t0 = time.perf_counter()
+            current = history + new[:i + 1]
+            session = legacy_compact_graph(build_graph_from_texts(current), 80, 160)
+            global_graph = legacy_compact_graph(merge_graph(global_graph, session), 120, 240)
+            json.dumps(global_graph, ensure_ascii=False, indent=2)
+            old.append(time.perf_counter() - t0)
+
+        engine = GraphEngine(os.path.join(tmp, "global_graph.json"), lambda: {})
+        engine.add_messages("bench", 0, history)
+        engine.session("bench", lambda: history)
+        inc = []
+        views = []
+        for i, text in enumerate(new):
+            t0 = time.perf_counter()
+            engine.add_messages("bench", length + i, [text])
+            t1 = time.perf_counter()
+            engine.session("bench", lambda: history, 80, 160)
+            engine.global_graph(120, 240)
+            inc.append(t1 - t0)
+            views.append(time.perf_counter() - t1)
+        t0 = time.perf_counter()
+        engine.session("bench", lambda: history, 80, 160)
+        engine.global_graph(120, 240)
+        cached = time.perf_counter() - t0
+        print(f"  chat of {length:>5} messages: old {statistics.mean(old) * 1000:8.2f}ms  "
+              f"incremental update {statistics.mean(inc) * 1000:8.2f}ms  + top-K views {statistics.mean(views) * 1000:8.2f}ms  "
+              f"(unchanged re-read {cached * 1000:.3f}ms)")
+
+
+def bench_sessions(args):
+    # Opening a chat whose session graph is not in memory (server restart,
+    # evicted from the LRU, switching between many chats): rebuild from every
+    # message (old) vs the graph persisted when the messages were written.
+    # Writes flush every --flush-every appends, standing in for the debounce.
+    sys.path.insert(0, BASE_DIR)
+    import graph
+    from graph import GraphEngine
+    graph.GRAPH_FLUSH_SEC = 3600
+    tmp = tempfile.mkdtemp(prefix="local-bot-bench-")
+    session_dir = os.path.join(tmp, "graphs")
+    print("cold session graph read: rebuild from chat vs persisted graph")
+    for length in [int(x) for x in args.lengths.split(",")]:
+        texts = synthetic_messages(length, args.words)
+        chat_id = f"chat{length}"
+        writer = GraphEngine(os.path.join(tmp, "global_graph.json"), lambda: {}, session_dir)
+        t0 = time.perf_counter()
+        for i in range(0, length, args.batch):
+            writer.add_messages(chat_id, i, texts[i:i + args.batch])
+            if i == 0:
+                writer.session(chat_id, lambda: texts[:args.batch], count=min(args.batch, length))
+            if (i // args.batch) % args.flush_every == 0:
+                writer.flush()
+        t_write = (time.perf_counter() - t0) / max(1, length // args.batch)
+        writer.flush()
+
+        def cold(session_dir):
+            engine = GraphEngine(os.path.join(tmp, "global_graph.json"), lambda: {}, session_dir)
+            return engine.session(chat_id, lambda: texts, 80, 160, count=length)
+
+        t_old, view_old = timed(lambda: cold(None))
+        t_new, view_new = timed(lambda: cold(session_dir))
+        size = os.path.getsize(os.path.join(session_dir, f"{chat_id}.json"))
+        same = view_old["nodes"] == view_new["nodes"]
+        print(f"  {length:>6} messages: rebuild {t_old * 1000:8.1f}ms  persisted {t_new * 1000:7.1f}ms  "
+              f"x{t_old / t_new:6.1f}  same nodes={same}  file {size // 1024}KB  write {t_write * 1000:.2f}ms/append")
+
+
+def legacy_compact_graph(graph, max_nodes, max_edges):
+    nodes = dict(graph.get("nodes", {}))
+    edges = dict(graph.get("edges", {}))
+    if max_nodes and len(nodes) > max_nodes:
+        top = sorted(nodes.items(), key=lambda kv: kv[1], reverse=True)[:max_nodes]
+        keep = {k for k, _ in top}
+        nodes = {k: v for k, v in nodes.items() if k in keep}
+        edges = {k: v for k, v in edges.items() if all(part in keep for part in k.split("|"))}
+    if max_edges and len(edges) > max_edges:
+        edges = dict(sorted(edges.items(), key=lambda kv: kv[1], reverse=True)[:max_edges])
+    return {"nodes": nodes, "edges": edges}
+
+
+def legacy_tokenize(text, stopwords):
+    out = []
+    for raw in text.lower().replace("\n", " ").split(" "):
+        t = "".join(ch for ch in raw if ch.isalnum() or ch in ("-", "_"))
+        if len(t) < 3:
+            continue
+        if t in stopwords:
+            continue
+        out.append(t)
+    return out
+
+
+def legacy_build_graph(texts, stopwords):
+    nodes = {}
+    edges = {}
+    for text in texts:
+        unique = list(dict.fromkeys(legacy_tokenize(text, stopwords)))
+        for t in unique:
+            nodes[t] = nodes.get(t, 0) + 1
+        for i in range(len(unique)):
+            for j in range(i + 1, len(unique)):
+                key = "|".join(sorted([unique[i], unique[j]]))
+                edges[key] = edges.get(key, 0) + 1
+    return {"nodes": nodes, "edges": edges}
+
+
+def timed(fn, repeat=3):
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn()
+        dt = time.perf_counter() - t0
+        best = dt if best is None else min(best, dt)
+    return best, result
+
+
+def bench_tokenize(args):
+    sys.path.insert(0, BASE_DIR)
+    import graph
+    rnd = random.Random(2)
+    vocab = [f"слово{i}" for i in range(1500)] + [f"term-{i}" for i in range(1500)] + list(graph.STOPWORDS)
+    punct = ["", "", "", ",", ".", "!", ":", "\n"]
+    texts = [
+        " ".join(rnd.choice(vocab) + rnd.choice(punct) for _ in range(args.words))
+        for _ in range(args.messages)
+    ]
+    print(f"{args.messages} messages x {args.words} words")
+    t_old, tok_old = timed(lambda: [legacy_tokenize(t, graph.STOPWORDS) for t in texts])
+    t_new, tok_new = timed(lambda: [graph.tokenize(t) for t in texts])
+    print(f"  tokenize       old {t_old * 1000:8.1f}ms  new {t_new * 1000:8.1f}ms  x{t_old / t_new:5.1f}  same={tok_old == tok_new}")
+    t_old, g_old = timed(lambda: legacy_build_graph(texts, graph.STOPWORDS), repeat=1)
+    t_new, g_new = timed(lambda: graph.build_graph_from_texts(texts, window=None), repeat=1)
+    print(f"  build graph    old {t_old * 1000:8.1f}ms  new {t_new * 1000:8.1f}ms  x{t_old / t_new:5.1f}  same={g_old == g_new}  edges={len(g_new['edges'])}")
+    for window in (32, 8):
+        t_win, g_win = timed(lambda: graph.build_graph_from_texts(texts, window=window), repeat=1)
+        print(f"  window={window:<3}     new {t_win * 1000:8.1f}ms  edges={len(g_win['edges'])}")
+
+
+def synthetic_graph(n_edges, seed=1):
+    # Zipf-like counts so top-K has a realistic head; ~4 edges per node.
+    rnd = random.Random(seed)
+    n_nodes = max(10, n_edges // 4)
+    nodes = {f"w{i}": 1 + int(1000 / (1 + i) * rnd.random() * 10) for i in range(n_nodes)}
+    edges = {}
+    while len(edges) < n_edges:
+        a = int(n_nodes * rnd.random() ** 2)
+        b = rnd.randrange(n_nodes)
+        if a == b:
+            continue
+        key = (f"w{a}", f"w{b}") if f"w{a}" <= f"w{b}" else (f"w{b}", f"w{a}")
+        edges[key] = edges.get(key, 0) + 1 + int(100 / (1 + a + b) * rnd.random() * 10)
+    return {"nodes": nodes, "edges": edges}
+
+
+def bench_compact(args):
+    sys.path.insert(0, BASE_DIR)
+    import graph
+    print(f"top-K compaction to {args.nodes} nodes / {args.edges} edges: full sort vs heap selection")
+    for size in [int(x) for x in args.sizes.split(",")]:
+        structured = synthetic_graph(size)
+        strings = graph.to_json_graph(structured)
+        repeat = 3 if size <= 100000 else 1
+        t_old, g_old = timed(lambda: legacy_compact_graph(strings, args.nodes, args.edges), repeat)
+        t_str, g_str = timed(lambda: graph.compact_graph(strings, args.nodes, args.edges), repeat)
+        t_new, g_new = timed(lambda: graph.top_k(structured, args.nodes, args.edges), repeat)
+        same = g_old == g_str == graph.to_json_graph(g_new)
+        print(f"  {size:>8} edges: sort {t_old * 1000:9.1f}ms  heap on \"a|b\" {t_str * 1000:9.1f}ms  "
+              f"heap structured {t_new * 1000:9.1f}ms  ({t_old / t_new:5.1f}x)  same={same}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local Bot UI benchmarks")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("load", help="status/outbox latency while generations are in flight")
+    p.add_argument("--generations", type=int, default=4)
+    p.add_argument("--gen-delay", type=float, default=2.0)
+    p.add_argument("--workers", type=int, default=16)
+    p.set_defaults(func=bench_load)
+    p = sub.add_parser("poll", help="disk reads and latency of bridge/config polling")
+    p.add_argument("--tabs", type=int, default=4)
+    p.add_argument("--polls", type=int, default=50)
+    p.add_argument("--workers", type=int, default=16)
+    p.set_defaults(func=bench_poll)
+    p = sub.add_parser("outbox", help="exactly-once delivery of the bridge outbox under parallel pollers")
+    p.add_argument("--items", type=int, default=300)
+    p.add_argument("--pollers", type=int, default=12)
+    p.add_argument("--sources", type=int, default=3)
+    p.add_argument("--workers", type=int, default=16)
+    p.set_defaults(func=bench_outbox)
+    p = sub.add_parser("push", help="outbox dispatch latency and idle requests, polling vs long-poll/SSE")
+    p.add_argument("--items", type=int, default=5)
+    p.add_argument("--idle", type=float, default=10.0)
+    p.add_argument("--workers", type=int, default=16)
+    p.set_defaults(func=bench_push)
+    p = sub.add_parser("inbox", help="bridge inbox ingest/last-read cost vs history length")
+    p.add_argument("--sizes", default="100,1000,10000")
+    p.add_argument("--max-kb", type=int, default=2048)
+    p.set_defaults(func=bench_inbox)
+    p = sub.add_parser("storage", help="save_json throughput: in place vs atomic+fsync vs group commit")
+    p.add_argument("--threads", type=int, default=8)
+    p.add_argument("--writes", type=int, default=50)
+    p.add_argument("--files", type=int, default=4)
+    p.add_argument("--messages", type=int, default=50)
+    p.add_argument("--dir", default=None, help="where to write; fsync is free on tmpfs")
+    p.add_argument("--fsync-delay-ms", type=float, default=0.0)
+    p.set_defaults(func=bench_storage)
+    p = sub.add_parser("locks", help="concurrent appends to one chat from threads and processes")
+    p.add_argument("--threads", type=int, default=8)
+    p.add_argument("--processes", type=int, default=4)
+    p.add_argument("--appends", type=int, default=200)
+    p.set_defaults(func=bench_locks)
+    p = sub.add_parser("ollama", help="Ollama call latency, per-call urllib vs pooled client, and fail-fast when down")
+    p.add_argument("--calls", type=int, default=200)
+    p.add_argument("--down-calls", type=int, default=20)
+    p.add_argument("--legacy-timeout", type=float, default=5.0, help="urlopen timeout of the old /api/tags call")
+    p.set_defaults(func=bench_ollama)
+    p = sub.add_parser("models", help="/api/models latency, fetch per request vs cached catalog, Ollama up and stuck")
+    p.add_argument("--loads", type=int, default=50)
+    p.add_argument("--down-loads", type=int, default=3)
+    p.add_argument("--workers", type=int, default=16)
+    p.set_defaults(func=bench_models)
+    p = sub.add_parser("sched", help="bridge burst + UI send, no admission vs generation scheduler")
+    p.add_argument("--bridge", type=int, default=8)
+    p.add_argument("--gen-delay", type=float, default=1.0)
+    p.add_argument("--workers", type=int, default=16)
+    p.set_defaults(func=bench_sched)
+    p = sub.add_parser("gencache", help="repeated prompts, generation cache off vs on (memory, disk, bypass)")
+    p.add_argument("--prompts", type=int, default=5)
+    p.add_argument("--repeats", type=int, default=4)
+    p.add_argument("--gen-delay", type=float, default=0.5)
+    p.add_argument("--workers", type=int, default=16)
+    p.set_defaults(func=bench_gencache)
+    p = sub.add_parser("context", help="prompt tokens per turn, bounded context vs resending the whole chat")
+    p.add_argument("--turns", type=int, default=200)
+    p.add_argument("--words", type=int, default=60)
+    p.add_argument("--interleave", type=int, default=30)
+    p.add_argument("--workers", type=int, default=16)
+    p.set_defaults(func=bench_context)
+    p = sub.add_parser("search", help="full-text index vs scanning every chat")
+    p.add_argument("--messages", type=int, default=100000)
+    p.add_argument("--chats", type=int, default=200)
+    p.add_argument("--words", type=int, default=30)
+    p.add_argument("--vocab", type=int, default=20000)
+    p.add_argument("--repeats", type=int, default=5)
+    p.add_argument("--no-scan", dest="scan", action="store_false", help="skip the slow scan baseline")
+    p.set_defaults(func=bench_search)
+
+    p = sub.add_parser("chatpoll", help="chat poll: full reload vs ETag / ?after=")
+    p.add_argument("--messages", type=int, default=1000)
+    p.add_argument("--words", type=int, default=40)
+    p.add_argument("--polls", type=int, default=100)
+    p.add_argument("--workers", type=int, default=16)
+    p.set_defaults(func=bench_chatpoll)
+
+    p = sub.add_parser("sessions", help="cold session graph: rebuild vs persisted per chat")
+    p.add_argument("--lengths", default="100,1000,5000")
+    p.add_argument("--words", type=int, default=60)
+    p.add_argument("--batch", type=int, default=2)
+    p.add_argument("--flush-every", type=int, default=10)
+    p.set_defaults(func=bench_sessions)
+
+    p = sub.add_parser("wire", help="response sizes: encoding, compression, slim replies, static files")
+    p.add_argument("--messages", type=int, default=500)
+    p.add_argument("--words", type=int, default=40)
+    p.add_argument("--sends", type=int, default=50)
+    p.add_argument("--workers", type=int, default=16)
+    p.set_defaults(func=bench_wire)
+
+    p = sub.add_parser("ingest", help="bridge backlog replay: single ingests vs one batch request")
+    p.add_argument("--items", type=int, default=300)
+    p.add_argument("--chats", type=int, default=5)
+    p.add_argument("--workers", type=int, default=16)
+    p.set_defaults(func=bench_ingest)
+
+    p = sub.add_parser("metrics", help="metrics overhead and per-stage latency breakdown from /api/metrics")
+    p.add_argument("--generations", type=int, default=4)
+    p.add_argument("--gen-delay", type=float, default=0.5)
+    p.add_argument("--reads", type=int, default=200)
+    p.add_argument("--workers", type=int, default=16)
+    p.set_defaults(func=bench_metrics)
+
+    p = sub.add_parser("stream", help="time to first token, buffered vs streamed /api/chat/send")
+    p.add_argument("--gen-delay", type=float, default=2.0)
+    p.add_argument("--workers", type=int, default=16)
+    p.set_defaults(func=bench_stream)
+    p = sub.add_parser("graph", help="per-message graph update cost vs chat length")
+    p.add_argument("--lengths", default="10,100,1000")
+    p.add_argument("--samples", type=int, default=5)
+    p.set_defaults(func=bench_graph)
+    p = sub.add_parser("tokenize", help="tokenizer and pair counting micro-benchmarks")
+    p.add_argument("--messages", type=int, default=200)
+    p.add_argument("--words", type=int, default=300)
+    p.set_defaults(func=bench_tokenize)
+    p = sub.add_parser("compact", help="top-K graph compaction, full sort vs heap selection")
+    p.add_argument("--sizes", default="10000,100000,1000000")
+    p.add_argument("--nodes", type=int, default=120)
+    p.add_argument("--edges", type=int, default=240)
+    p.set_defaults(func=bench_compact)
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
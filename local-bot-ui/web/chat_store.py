@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+# Append-only chat storage.
+#
+# Each chat is a snapshot <id>.json ({"id", "title", "messages", "seq"}) plus an
+# append-only log <id>.log with one JSON message per line. Writing a message is a
+# single line append; once the log grows past COMPACT_LOG_BYTES it is folded
+# into a fresh snapshot. Every log line carries its position ("seq"), so lines
+# already covered by the snapshot are skipped if a crash hits between writing
+# the snapshot and removing the log.
+#
+# Writers hold the chat's lock (locks.ChatLocks, also a file lock), so appends
+# from several threads or processes never reuse a seq or drop a line.
+#
+# Legacy chats (a plain <id>.json written by older versions) are valid snapshots
+# with an empty log, so they load as-is; `python3 chat_store.py migrate` rewrites
+# them with an explicit "seq" and folds any pending logs.
+import json
+import os
+import re
+import sys
+import threading
+
+from locks import ChatLocks
+from metrics import timer
+from storage import load_json, save_json, sync_appended
+
+COMPACT_LOG_BYTES = 256 * 1024
+TAIL_BLOCK_BYTES = 8192
+INDEX_FLUSH_SEC = 2.0
+# Only the first two sentences (<= 200 chars) end up in a preview.
+INDEX_SEED_CHARS = 1000
+
+
+def new_chat(chat_id):
+    return {"id": chat_id, "title": "Новый чат", "messages": []}
+
+
+def parse_source_from_assistant(text):
+    if text.startswith("[") and "]" in text[:40]:
+        return text[1:text.index("]")]
+    return "Local"
+
+
+def chat_preview(chat):
+    messages = chat.get("messages", [])
+    text = ""
+    for m in messages:
+        if m.get("role") == "user":
+            text = m.get("content", "")
+            break
+    if not text and messages:
+        text = messages[0].get("content", "")
+    text = (text or "").replace("\n", " ").strip()
+    if not text:
+        return ""
+    parts = re.split(r'(?<=[.!?])\s+', text)
+    preview = " ".join(parts[:2]).strip()
+    if len(preview) > 200:
+        preview = preview[:200].rstrip() + "…"
+    return preview
+
+
+def chat_title(chat):
+    preview = chat_preview(chat)
+    if preview:
+        words = preview.split()
+        title = " ".join(words[:6]).strip()
+        return title if title else "Новый чат"
+    return chat.get("title") or "Новый чат"
+
+
+def chat_sources(chat):
+    sources = set()
+    for m in chat.get("messages", []):
+        if m.get("role") == "assistant":
+            sources.add(parse_source_from_assistant(m.get("content", "")))
+    return sorted(sources)
+
+
+class ChatStore:
+    def __init__(self, chats_dir, locks=None):
+        self.chats_dir = chats_dir
+        self.locks = locks or ChatLocks(os.path.join(chats_dir, ".locks"))
+        self._lock = threading.Lock()
+        # chat_id -> (message count, _stat_key at the time it was counted)
+        self._counts = {}
+
+    def snapshot_path(self, chat_id):
+        return os.path.join(self.chats_dir, f"{chat_id}.json")
+
+    def log_path(self, chat_id):
+        return os.path.join(self.chats_dir, f"{chat_id}.log")
+
+    def exists(self, chat_id):
+        return os.path.exists(self.snapshot_path(chat_id)) or os.path.exists(self.log_path(chat_id))
+
+    def mtime(self, chat_id):
+        ts = 0
+        for p in (self.snapshot_path(chat_id), self.log_path(chat_id)):
+            try:
+                ts = max(ts, os.path.getmtime(p))
+            except OSError:
+                pass
+        return ts
+
+    def _stat_key(self, chat_id):
+        key = []
+        for p in (self.snapshot_path(chat_id), self.log_path(chat_id)):
+            try:
+                st = os.stat(p)
+                key.append((st.st_mtime_ns, st.st_size))
+            except OSError:
+                key.append(None)
+        return tuple(key)
+
+    def _remember(self, chat_id, n, stat=None):
+        with self._lock:
+            self._counts[chat_id] = (n, stat if stat is not None else self._stat_key(chat_id))
+
+    def _read_log(self, chat_id, start_seq):
+        out = []
+        try:
+            with timer("local_bot_disk_seconds", op="read_log"), open(self.log_path(chat_id), "r", encoding="utf-8") as f:
+                for line in f:
+                    entry = _parse_line(line)
+                    if entry is None or entry[0] < start_seq:
+                        continue
+                    out.append(entry[1])
+        except FileNotFoundError:
+            pass
+        return out
+
+    def load(self, chat_id, default=None):
+        # Stat before reading: a line appended meanwhile makes the count stale.
+        stat = self._stat_key(chat_id)
+        snap = load_json(self.snapshot_path(chat_id), None)
+        if not isinstance(snap, dict):
+            if not os.path.exists(self.log_path(chat_id)):
+                return default
+            snap = new_chat(chat_id)
+        messages = snap.get("messages") or []
+        seq = snap.get("seq", len(messages))
+        messages.extend(self._read_log(chat_id, seq))
+        snap["messages"] = messages
+        snap.pop("seq", None)
+        self._remember(chat_id, len(messages), stat)
+        return snap
+
+    def count(self, chat_id):
+        # Cached while the files are unchanged since they were counted, which
+        # is always the case unless another process wrote to this chat.
+        with self._lock:
+            cached = self._counts.get(chat_id)
+        if cached is not None and cached[1] == self._stat_key(chat_id):
+            return cached[0]
+        chat = self.load(chat_id, new_chat(chat_id))
+        return len(chat["messages"])
+
+    def create(self, chat_id, title="Новый чат"):
+        chat = {"id": chat_id, "title": title, "messages": []}
+        with self.locks.hold(chat_id):
+            save_json(self.snapshot_path(chat_id), {**chat, "seq": 0})
+            self._remember(chat_id, 0)
+        return chat
+
+    def append(self, chat_id, messages):
+        # O(1) in chat size once the message count is known (it is cached after
+        # the first load). Returns the seq of the first appended message.
+        with self.locks.hold(chat_id):
+            if not self.exists(chat_id):
+                self.create(chat_id)
+            start = self.count(chat_id)
+            lines = []
+            for i, m in enumerate(messages):
+                lines.append(json.dumps({"seq": start + i, **m}, ensure_ascii=False) + "\n")
+            path = self.log_path(chat_id)
+            with timer("local_bot_disk_seconds", op="append_log"), open(path, "a", encoding="utf-8") as f:
+                f.write("".join(lines))
+            sync_appended(path)
+            self._remember(chat_id, start + len(messages))
+            try:
+                if os.path.getsize(path) > COMPACT_LOG_BYTES:
+                    self.compact(chat_id)
+            except OSError:
+                pass
+        return start
+
+    def compact(self, chat_id):
+        with self.locks.hold(chat_id):
+            chat = self.load(chat_id)
+            if chat is None:
+                return None
+            save_json(self.snapshot_path(chat_id), {**chat, "seq": len(chat["messages"])})
+            try:
+                os.remove(self.log_path(chat_id))
+            except FileNotFoundError:
+                pass
+            self._remember(chat_id, len(chat["messages"]))
+        return chat
+
+    def since(self, chat_id, seq):
+        # Messages from position seq on, read from the end of the log; the
+        # snapshot is only parsed when the log does not reach back to seq.
+        n = self.count(chat_id) - seq
+        if n <= 0:
+            return []
+        entries = _read_tail_lines(self.log_path(chat_id), n)
+        if entries and entries[0][0] <= seq:
+            return [m for s, m in entries if s >= seq]
+        chat = self.load(chat_id)
+        if chat is None:
+            return []
+        return chat["messages"][seq:]
+
+    def delete(self, chat_id):
+        with self.locks.hold(chat_id):
+            for p in (self.snapshot_path(chat_id), self.log_path(chat_id)):
+                try:
+                    os.remove(p)
+                except FileNotFoundError:
+                    pass
+            with self._lock:
+                self._counts.pop(chat_id, None)
+
+
+class ChatIndex:
+    # One metadata row per chat, kept in memory and persisted to a single small
+    # file. Rows are updated incrementally on every append; at startup they are
+    # checked against the chat files' mtimes and stale rows are rebuilt.
+    def __init__(self, path, store):
+        self.path = path
+        self.store = store
+        self._lock = threading.Lock()
+        self._rows = None
+        self._timer = None
+
+    def load(self):
+        saved = load_json(self.path, {})
+        rows = saved.get("rows", {}) if isinstance(saved, dict) else {}
+        ids = [f[:-5] for f in os.listdir(self.store.chats_dir) if f.endswith(".json")]
+        fresh = {}
+        rebuilt = 0
+        for chat_id in ids:
+            row = rows.get(chat_id)
+            if not row or row.get("updated_ts") != self.store.mtime(chat_id):
+                row = self._build_row(chat_id)
+                rebuilt += 1
+            fresh[chat_id] = row
+        with self._lock:
+            self._rows = fresh
+        if rebuilt or len(rows) != len(fresh):
+            self.flush()
+        print(f"[ChatIndex] {len(fresh)} chats, {rebuilt} rebuilt")
+
+    def _ensure_loaded(self):
+        if self._rows is None:
+            self.load()
+
+    def _build_row(self, chat_id):
+        chat = self.store.load(chat_id, new_chat(chat_id))
+        row = {
+            "id": chat_id,
+            "title": chat.get("title") or "Новый чат",
+            "sources": [],
+            "message_count": 0,
+            "seed": {},
+        }
+        _apply_messages(row, chat.get("messages", []))
+        row["updated_ts"] = self.store.mtime(chat_id)
+        return row
+
+    def on_create(self, chat):
+        # Keys stay str, like the file names they come from: list() sorts them.
+        self._ensure_loaded()
+        row = {"id": str(chat["id"]), "title": chat.get("title") or "Новый чат", "sources": [], "message_count": 0, "seed": {}}
+        _apply_messages(row, chat.get("messages", []))
+        row["updated_ts"] = self.store.mtime(row["id"])
+        with self._lock:
+            self._rows[row["id"]] = row
+        self._schedule_flush()
+
+    def on_append(self, chat_id, messages):
+        chat_id = str(chat_id)
+        self._ensure_loaded()
+        with self._lock:
+            row = self._rows.get(chat_id)
+        if row is None:
+            row = self._build_row(chat_id)
+        else:
+            _apply_messages(row, messages)
+            row["updated_ts"] = self.store.mtime(chat_id)
+        with self._lock:
+            self._rows[chat_id] = row
+        self._schedule_flush()
+
+    def list(self, offset=0, limit=None, since=None):
+        # Newest first: chat ids are timestamps, same order as the file listing.
+        self._ensure_loaded()
+        with self._lock:
+            rows = [self._rows[i] for i in sorted(self._rows, reverse=True)]
+        if since is not None:
+            rows = [r for r in rows if r.get("updated_ts", 0) > since]
+        total = len(rows)
+        rows = rows[offset:offset + limit] if limit is not None else rows[offset:]
+        return [{k: v for k, v in r.items() if k != "seed"} for r in rows], total
+
+    def _schedule_flush(self):
+        with self._lock:
+            if self._timer is not None:
+                return
+            self._timer = threading.Timer(INDEX_FLUSH_SEC, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self):
+        with self._lock:
+            self._timer = None
+            if self._rows is None:
+                return
+            rows = {k: dict(v) for k, v in self._rows.items()}
+        save_json(self.path, {"rows": rows}, compact=True)
+
+
+def _apply_messages(row, messages):
+    # Title and preview only depend on the first message and the first user
+    # message, so those two are all a row has to remember.
+    seed = row.setdefault("seed", {})
+    sources = set(row.get("sources", []))
+    for m in messages:
+        trimmed = {"role": m.get("role"), "content": (m.get("content") or "")[:INDEX_SEED_CHARS]}
+        if "first" not in seed:
+            seed["first"] = trimmed
+        if "first_user" not in seed and m.get("role") == "user":
+            seed["first_user"] = trimmed
+        if m.get("role") == "assistant":
+            sources.add(parse_source_from_assistant(m.get("content", "")))
+    row["message_count"] = row.get("message_count", 0) + len(messages)
+    row["sources"] = sorted(sources)
+    stub = {"title": row.get("title"), "messages": [seed[k] for k in ("first", "first_user") if k in seed]}
+    row["preview"] = chat_preview(stub)
+    row["title"] = chat_title(stub)
+
+
+def _parse_line(line):
+    line = line.strip()
+    if not line:
+        return None
+    try:
+        entry = json.loads(line)
+    except ValueError:
+        # A torn last line from a crash mid-append: ignore it.
+        return None
+    seq = entry.pop("seq", -1)
+    return seq, entry
+
+
+def _read_tail_lines(path, n):
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return []
+    with f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        data = b""
+        while pos > 0 and data.count(b"\n") <= n:
+            step = min(TAIL_BLOCK_BYTES, pos)
+            pos -= step
+            f.seek(pos)
+            data = f.read(step) + data
+    lines = data.split(b"\n")
+    if pos > 0:
+        lines = lines[1:]
+    entries = [_parse_line(line.decode("utf-8", "replace")) for line in lines]
+    entries = [e for e in entries if e is not None]
+    # Seqs must be contiguous; anything else means a compaction raced us.
+    seqs = [seq for seq, _m in entries]
+    if seqs and seqs != list(range(seqs[0], seqs[0] + len(seqs))):
+        return []
+    return entries
+
+
+def migrate(chats_dir):
+    store = ChatStore(chats_dir)
+    ids = sorted({os.path.splitext(f)[0] for f in os.listdir(chats_dir) if f.endswith((".json", ".log"))})
+    for chat_id in ids:
+        chat = store.compact(chat_id)
+        if chat is not None:
+            print(f"[ChatStore] {chat_id}: {len(chat['messages'])} messages")
+    return len(ids)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == "migrate":
+        base = os.path.dirname(os.path.abspath(__file__))
+        default_dir = os.path.join(os.environ.get("LOCAL_BOT_DATA_DIR") or os.path.join(base, "data"), "chats")
+        target = sys.argv[2] if len(sys.argv) > 2 else default_dir
+        print(f"[ChatStore] migrated {migrate(target)} chats in {target}")
+    else:
+        print("usage: chat_store.py migrate [chats_dir]")
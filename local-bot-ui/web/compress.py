@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# Response bodies for server.py: compact JSON, Accept-Encoding negotiation and
+# in-memory static assets.
+#
+# JSON is written without spaces and with UTF-8 text as is (Cyrillic takes 2
+# bytes instead of a 6-byte \u escape). Bodies of COMPRESS_MIN_BYTES or more
+# are compressed with brotli when the `brotli` package is installed and the
+# client accepts it, otherwise gzip. Static files are read once (re-read when
+# their mtime or size changes) and kept with precompressed variants and a
+# strong ETag per encoding ("<hash>", "<hash>-gz", "<hash>-br": the bytes
+# differ, so they must not validate each other), so a page load reads nothing
+# from disk.
+import gzip
+import hashlib
+import json
+import os
+import threading
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESS_MIN_BYTES = 1024
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4
+# Static files are compressed once, so they get the slowest settings.
+STATIC_GZIP_LEVEL = 9
+STATIC_BROTLI_QUALITY = 11
+
+
+def json_bytes(data):
+    try:
+        return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    except UnicodeEncodeError:
+        # Lone surrogates cannot be UTF-8; escaped output is still valid JSON.
+        return json.dumps(data, separators=(",", ":")).encode("utf-8")
+
+
+def negotiate(accept_encoding):
+    # "br", "gzip" or None for an Accept-Encoding header; q=0 excludes.
+    accepted = set()
+    for part in (accept_encoding or "").lower().split(","):
+        name, _, params = part.partition(";")
+        q = params.strip().replace(" ", "")
+        if q.startswith("q=") and not q[2:].strip("0."):
+            continue
+        accepted.add(name.strip())
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted or "*" in accepted:
+        return "gzip"
+    return None
+
+
+def compress(body, encoding, static=False):
+    if encoding == "br":
+        return brotli.compress(body, quality=STATIC_BROTLI_QUALITY if static else BROTLI_QUALITY)
+    return gzip.compress(body, STATIC_GZIP_LEVEL if static else GZIP_LEVEL, mtime=0)
+
+
+class StaticFiles:
+    def __init__(self, base_dir):
+        self.base_dir = base_dir
+        self._lock = threading.Lock()
+        # filename -> {"key", "body", "etags", "variants"}; etags by encoding,
+        # None for identity.
+        self._files = {}
+        self.loads = 0
+
+    def get(self, filename):
+        # None if the file does not exist.
+        path = os.path.join(self.base_dir, filename)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        key = (st.st_mtime_ns, st.st_size)
+        with self._lock:
+            entry = self._files.get(filename)
+        if entry is not None and entry["key"] == key:
+            return entry
+        with open(path, "rb") as f:
+            body = f.read()
+        variants = {"gzip": compress(body, "gzip", static=True)}
+        if brotli is not None:
+            variants["br"] = compress(body, "br", static=True)
+        digest = hashlib.sha256(body).hexdigest()[:32]
+        entry = {
+            "key": key,
+            "body": body,
+            "etags": {None: f'"{digest}"', "gzip": f'"{digest}-gz"', "br": f'"{digest}-br"'},
+            "variants": variants,
+        }
+        with self._lock:
+            self._files[filename] = entry
+            self.loads += 1
+        return entry
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# Multi-turn prompts for Ollama with a bounded history.
+#
+# A turn is built one of two ways:
+# - "ollama": the chat's previous turn went through here, nothing was appended
+#   since, and Ollama returned its "context" (the encoded conversation). Only
+#   the new user text is sent, with that context.
+# - "window": the most recent messages that fit max_tokens, preceded by a
+#   rolling summary of everything older. The summary is extractive (the first
+#   sentence of each message that left the window, newest lines kept within
+#   SUMMARY_TOKENS) and is extended incrementally, so it costs no generation.
+# Once the Ollama context would exceed max_tokens, the next turn falls back to
+# a window, so prompts stay bounded however long the chat gets.
+#
+# Token counts are estimates (CHARS_PER_TOKEN). Each turn reports how many it
+# saved against resending the whole chat; that total is kept running per chat.
+#
+# build() is given the chat's message count and a reader, not the messages, and
+# reads only what the turn needs: the messages since the previous turn, plus in
+# "window" mode the window (read backwards from the end in growing steps) and
+# the messages that newly left it. Only the first turn of a chat this process
+# has not seen reads the whole chat, to start the running total.
+import os
+import re
+import threading
+from collections import OrderedDict
+
+MAX_TOKENS = int(os.environ.get("LOCAL_BOT_CONTEXT_TOKENS") or 2048)
+SUMMARY_TOKENS = 256
+SUMMARY_LINE_CHARS = 200
+# Messages read from the end of the chat at first when looking for the window.
+WINDOW_READ = 32
+CHARS_PER_TOKEN = 3.5
+MAX_CHATS = 64
+ROLE_LABELS = {"user": "User", "assistant": "Assistant"}
+_SENTENCE_END_RE = re.compile(r"(?<=[.!?…])\s")
+
+
+def estimate_tokens(text):
+    return int(len(text) / CHARS_PER_TOKEN) + 1 if text else 0
+
+
+def format_message(m):
+    return f"{ROLE_LABELS.get(m.get('role'), 'User')}: {m.get('content', '')}"
+
+
+def summary_line(m):
+    text = " ".join((m.get("content") or "").split())
+    first = _SENTENCE_END_RE.split(text, 1)[0][:SUMMARY_LINE_CHARS]
+    return f"{ROLE_LABELS.get(m.get('role'), 'User')}: {first}"
+
+
+class ContextWindow:
+    def __init__(self, max_tokens=MAX_TOKENS, summary_tokens=SUMMARY_TOKENS):
+        self.max_tokens = max_tokens
+        self.summary_tokens = summary_tokens
+        self._lock = threading.Lock()
+        # chat_id -> {"model", "context", "covered", "summary", "summary_upto",
+        #             "full_tokens", "full_upto"}
+        self._chats = OrderedDict()
+        self.turns = {"ollama": 0, "window": 0}
+        self.prompt_tokens = 0
+        self.full_tokens = 0
+
+    def _state(self, chat_id):
+        state = self._chats.get(chat_id)
+        if state is None:
+            state = self._chats[chat_id] = {"model": None, "context": None, "covered": 0, "summary": [], "summary_upto": 0,
+                                            "full_tokens": 0, "full_upto": 0}
+        self._chats.move_to_end(chat_id)
+        while len(self._chats) > MAX_CHATS:
+            self._chats.popitem(last=False)
+        return state
+
+    def build(self, chat_id, model, count, text, read_since):
+        # Returns (prompt, ollama_context or None, report). count is the
+        # chat's message count before this turn; read_since(seq) returns its
+        # messages from position seq on. Disk reads happen outside the lock.
+        with self._lock:
+            state = dict(self._state(chat_id))
+        fetch = _Reader(count, read_since).fetch
+        upto, full = state["full_upto"], state["full_tokens"]
+        if upto > count:
+            upto, full = 0, 0
+        full += sum(estimate_tokens(format_message(m)) for m in fetch(upto, count))
+        state["full_upto"], state["full_tokens"] = count, full
+        full += estimate_tokens(text)
+        context = state["context"]
+        if (context and state["model"] == model and state["covered"] == count
+                and len(context) + estimate_tokens(text) <= self.max_tokens):
+            prompt, mode, window, summarized = text, "ollama", 0, 0
+        else:
+            context = None
+            prompt, window, summarized = self._window(state, count, text, fetch)
+            mode = "window"
+        # Ollama's context comes back as token ids whose evaluation it
+        # keeps cached; only the prompt text is new work.
+        sent = estimate_tokens(prompt)
+        with self._lock:
+            current = self._state(chat_id)
+            for key in ("summary", "summary_upto", "full_tokens", "full_upto"):
+                current[key] = state[key]
+            self.turns[mode] += 1
+            self.prompt_tokens += sent
+            self.full_tokens += full
+        report = {
+            "mode": mode,
+            "prompt_tokens": sent,
+            "context_tokens": len(context) if context else 0,
+            "full_tokens": full,
+            "saved_tokens": max(0, full - sent),
+            "window_messages": window,
+            "summarized_messages": summarized,
+        }
+        return prompt, context, report
+
+    def _window(self, state, count, text, fetch):
+        if not count:
+            return text, 0, 0
+        budget = self.max_tokens - self.summary_tokens - estimate_tokens(text)
+        start = count
+        used = 0
+        step = min(count, WINDOW_READ)
+        while True:
+            lo = count - step
+            messages = fetch(lo, count)
+            full_window = False
+            while start > lo:
+                cost = estimate_tokens(format_message(messages[start - 1 - lo]))
+                if used + cost > budget:
+                    full_window = True
+                    break
+                used += cost
+                start -= 1
+            if full_window or lo == 0:
+                break
+            step = min(count, step * 2)
+        summary = self._summary(state, start, fetch)
+        parts = []
+        if summary:
+            parts.append("Summary of the earlier conversation:\n" + "\n".join(summary))
+        parts.extend(format_message(m) for m in fetch(start, count))
+        parts.append(format_message({"role": "user", "content": text}))
+        return "\n\n".join(parts), count - start, start
+
+    def _summary(self, state, upto, fetch):
+        # Lines for the messages before upto; only messages that left the
+        # window since the last call are added. Starts over if the chat got
+        # shorter.
+        if upto < state["summary_upto"]:
+            state["summary"], state["summary_upto"] = [], 0
+        # Every line costs at least one token, so messages further back than
+        # summary_tokens could not survive the trimming below and are not read.
+        lo = max(state["summary_upto"], upto - self.summary_tokens)
+        lines = state["summary"] if lo == state["summary_upto"] else []
+        # Only the newest lines survive trimming, so older ones are never built.
+        new = []
+        used = 0
+        for m in reversed(fetch(lo, upto)):
+            line = summary_line(m)
+            used += estimate_tokens(line)
+            if used > self.summary_tokens:
+                lines = []
+                break
+            new.append(line)
+        lines = lines + new[::-1]
+        while lines and sum(estimate_tokens(line) for line in lines) > self.summary_tokens:
+            lines.pop(0)
+        state["summary"], state["summary_upto"] = lines, upto
+        return lines
+
+    def commit(self, chat_id, model, covered, context):
+        # After a generation: covered is the chat's message count including this
+        # turn, context what Ollama returned (None drops the Ollama state).
+        with self._lock:
+            state = self._state(chat_id)
+            state["model"] = model
+            state["context"] = context or None
+            state["covered"] = covered
+
+    def stats(self):
+        with self._lock:
+            return {
+                "turns": dict(self.turns),
+                "prompt_tokens": self.prompt_tokens,
+                "full_tokens": self.full_tokens,
+                "saved_tokens": max(0, self.full_tokens - self.prompt_tokens),
+                "chats": len(self._chats),
+            }
+
+
+class _Reader:
+    # messages[lo:hi] of a chat with `count` messages, through read_since. The
+    # last read is kept and serves any range inside it.
+    def __init__(self, count, read_since):
+        self.count = count
+        self.read_since = read_since
+        self.lo = None
+        self.messages = []
+
+    def fetch(self, lo, hi):
+        if lo >= hi:
+            return []
+        if self.lo is None or lo < self.lo:
+            self.lo = lo
+            self.messages = self.read_since(lo)[:self.count - lo]
+        return self.messages[lo - self.lo:hi - self.lo]
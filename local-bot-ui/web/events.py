@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# In-process event hub behind long-polling and /api/events (SSE).
+#
+# Every state change that a client would otherwise poll for (outbox, inbox,
+# chat updates) is published as (seq, kind, data). Waiters block on a condition
+# until something newer than the seq they already saw arrives. A ring buffer
+# of recent events lets a reconnecting client resume from Last-Event-ID.
+import threading
+import time
+from collections import deque
+
+HISTORY_SIZE = 512
+
+
+class EventHub:
+    def __init__(self, history=HISTORY_SIZE):
+        self._cond = threading.Condition()
+        self._events = deque(maxlen=history)
+        self._seq = 0
+        self.closed = False
+
+    @property
+    def seq(self):
+        with self._cond:
+            return self._seq
+
+    def publish(self, kind, data=None):
+        with self._cond:
+            self._seq += 1
+            self._events.append((self._seq, kind, data or {}))
+            self._cond.notify_all()
+            return self._seq
+
+    def since(self, seq, match=None):
+        with self._cond:
+            return [e for e in self._events if e[0] > seq and (match is None or match(e[1], e[2]))]
+
+    def wait(self, seq, timeout, match=None):
+        # Events newer than seq (optionally filtered), waiting up to timeout
+        # seconds for the first one. Returns [] on timeout or close().
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while not self.closed:
+                found = [e for e in self._events if e[0] > seq and (match is None or match(e[1], e[2]))]
+                if found:
+                    return found
+                # Skip everything already seen so the next scan stays short.
+                seq = max(seq, self._seq)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return []
+
+    def close(self):
+        # Wakes every waiter so long-polls and SSE streams finish on shutdown.
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# Opt-in cache of finished Ollama generations, keyed by (model, prompt, options).
+#
+# Two tiers: an in-memory LRU of max_entries, and one file per entry under
+# data/gen_cache/<key>.json capped at max_bytes (oldest files go first).
+# Entries older than ttl_sec are misses on either tier and are deleted. A disk
+# hit is promoted to memory. Only complete, successful generations are stored.
+#
+# Settings come from "gen_cache" in config.json (see DEFAULT_SETTINGS); the
+# cache is off unless "enabled" is true.
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from storage import load_json, save_json
+
+DEFAULT_SETTINGS = {
+    "enabled": False,
+    "ttl_sec": 7 * 24 * 3600,
+    "max_entries": 256,
+    "max_bytes": 50 * 1024 * 1024,
+}
+
+
+def settings_from_config(config):
+    out = dict(DEFAULT_SETTINGS)
+    custom = config.get("gen_cache") if isinstance(config, dict) else None
+    if isinstance(custom, dict):
+        out["enabled"] = bool(custom.get("enabled", out["enabled"]))
+        for k in ("ttl_sec", "max_entries", "max_bytes"):
+            try:
+                out[k] = max(0, float(custom[k])) if k in custom else out[k]
+            except (TypeError, ValueError):
+                pass
+    return out
+
+
+def cache_key(model, prompt, options=None):
+    raw = json.dumps([model, prompt, options or {}], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class GenCache:
+    def __init__(self, cache_dir, settings=None):
+        self.cache_dir = cache_dir
+        self.settings = settings or DEFAULT_SETTINGS
+        self._lock = threading.Lock()
+        # key -> (ts, response), least recently used first
+        self._memory = OrderedDict()
+        # key -> [size, ts] of every file on disk, oldest first; loaded lazily
+        self._disk = None
+        self._disk_bytes = 0
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".json")
+
+    def _load_disk(self):
+        if self._disk is not None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        files = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".json"):
+                continue
+            try:
+                st = os.stat(os.path.join(self.cache_dir, name))
+            except OSError:
+                continue
+            files.append((st.st_mtime, name[:-5], st.st_size))
+        self._disk = OrderedDict((key, [size, ts]) for ts, key, size in sorted(files))
+        self._disk_bytes = sum(size for size, _ts in self._disk.values())
+
+    def _expired(self, ts):
+        return time.time() - ts > self.settings["ttl_sec"]
+
+    def get(self, model, prompt, options=None):
+        key = cache_key(model, prompt, options)
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and not self._expired(entry[0]):
+                self._memory.move_to_end(key)
+                self.hits_memory += 1
+                return entry[1]
+            self._memory.pop(key, None)
+            self._load_disk()
+            on_disk = key in self._disk
+        if on_disk:
+            data = load_json(self._path(key), None)
+            with self._lock:
+                if isinstance(data, dict) and not self._expired(data.get("ts", 0)):
+                    self.hits_disk += 1
+                    self._remember(key, data["ts"], data.get("response", ""))
+                    return data.get("response", "")
+                self._drop_file(key)
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, model, prompt, response, options=None):
+        key = cache_key(model, prompt, options)
+        ts = time.time()
+        data = {"model": model, "prompt": prompt, "options": options or {}, "response": response, "ts": ts}
+        save_json(self._path(key), data, compact=True)
+        size = len(json.dumps(data, ensure_ascii=False).encode("utf-8"))
+        with self._lock:
+            self._load_disk()
+            self.stores += 1
+            self._remember(key, ts, response)
+            old = self._disk.pop(key, None)
+            if old is not None:
+                self._disk_bytes -= old[0]
+            self._disk[key] = [size, ts]
+            self._disk_bytes += size
+            while self._disk_bytes > self.settings["max_bytes"] and len(self._disk) > 1:
+                self._drop_file(next(iter(self._disk)))
+                self.evictions += 1
+
+    def _remember(self, key, ts, response):
+        # Caller holds self._lock.
+        self._memory[key] = (ts, response)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.settings["max_entries"]:
+            self._memory.popitem(last=False)
+
+    def _drop_file(self, key):
+        # Caller holds self._lock.
+        old = self._disk.pop(key, None)
+        if old is not None:
+            self._disk_bytes -= old[0]
+        self._memory.pop(key, None)
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": bool(self.settings["enabled"]),
+                "hits_memory": self.hits_memory,
+                "hits_disk": self.hits_disk,
+                "misses": self.misses,
+                "stores": self.stores,
+                "evictions": self.evictions,
+                "memory_entries": len(self._memory),
+                "disk_entries": len(self._disk or {}),
+                "disk_bytes": self._disk_bytes,
+            }
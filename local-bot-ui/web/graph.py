@@ -0,0 +1,331 @@
+import heapq
+import os
+import re
+import threading
+from collections import Counter, OrderedDict
+from itertools import combinations
+from operator import itemgetter
+
+from metrics import timer
+from storage import load_json, save_json
+
+# Stored global counters are pruned to half of these limits when exceeded;
+# display limits (MAX_GLOBAL_NODES etc.) live in server.py.
+GLOBAL_STORE_MAX_NODES = 20000
+GLOBAL_STORE_MAX_EDGES = 100000
+# Same for each chat's persisted session counters.
+SESSION_STORE_MAX_NODES = 20000
+SESSION_STORE_MAX_EDGES = 20000
+SESSION_CACHE_SIZE = 64
+GRAPH_FLUSH_SEC = 2.0
+# Co-occurrence window over a message's unique tokens (in first-seen order).
+# None counts every pair in the message, as the graph always has.
+PAIR_WINDOW = None
+
+# Everything except word chars, "-" and the space separator is dropped, which
+# is what the old per-character filter did.
+_STRIP_RE = re.compile(r"[^\w\- ]+")
+
+STOPWORDS = set([
+    "и","в","во","не","что","он","на","я","с","со","как","а","то","все","она",
+    "так","его","но","да","ты","к","у","же","вы","за","бы","по","только","ее",
+    "мне","было","вот","от","меня","еще","нет","о","из","ему","теперь","когда",
+    "даже","ну","вдруг","ли","если","уже","или","ни","быть","был","него","до",
+    "вас","нибудь","опять","уж","вам","ведь","там","потом","себя","ничего","ей",
+    "может","они","тут","где","есть","надо","ней","для","мы","тебя","их","чем",
+    "была","сам","чтоб","без","будто","чего","раз","тоже","себе","под","будет",
+    "ж","тогда","кто","этот","того","потому","этого","какой","совсем","ним","здесь",
+    "этом","один","почти","мой","тем","чтобы","нее","сейчас","были","куда","зачем",
+    "сказать","всех","никогда","сегодня","можно","при","наконец","два","об","другой",
+    "хоть","после","над","больше","тот","через","эти","нас","про","всего","них","какая",
+    "много","разве","три","эту","моя","впрочем","хорошо","свою","этой","перед","иногда",
+    "лучше","чуть","том","нельзя","такой","им","более","всегда","конечно","всю","между",
+    "and","the","to","of","in","is","it","for","on","with","as","that","this",
+    "are","be","or","an","by","from","at","was","were","but","not","we","you","your",
+    "i","me","my","they","them","their","our","us","so","if","then","than","about"
+])
+
+
+def tokenize(text):
+    words = _STRIP_RE.sub("", text.lower().replace("\n", " ")).split(" ")
+    return [t for t in words if len(t) >= 3 and t not in STOPWORDS]
+
+
+def count_cooccurrences(texts, window=PAIR_WINDOW):
+    # Words are interned to ints; pairs are (id, id) tuples with the smaller id
+    # first, counted by Counter.update so the pair loop runs in C.
+    vocab = {}
+    node_counts = Counter()
+    pair_counts = Counter()
+    for text in texts:
+        ids = []
+        for t in dict.fromkeys(tokenize(text)):
+            i = vocab.get(t)
+            if i is None:
+                i = vocab[t] = len(vocab)
+            ids.append(i)
+        node_counts.update(ids)
+        if window is None or window >= len(ids) - 1:
+            pair_counts.update(combinations(sorted(ids), 2))
+        else:
+            for d in range(1, window + 1):
+                pair_counts.update(zip(map(min, ids, ids[d:]), map(max, ids, ids[d:])))
+    words = list(vocab)
+    return words, node_counts, pair_counts
+
+
+# Internally a graph is {"nodes": {word: n}, "edges": {(a, b): n}} with a < b,
+# so filtering edges by node never re-parses a key. The "a|b" string form is
+# only produced for JSON (API responses and global_graph.json).
+def count_graph(texts, window=PAIR_WINDOW):
+    words, node_counts, pair_counts = count_cooccurrences(texts, window)
+    nodes = {words[i]: c for i, c in node_counts.items()}
+    edges = {}
+    for (a, b), c in pair_counts.items():
+        wa, wb = words[a], words[b]
+        edges[(wa, wb) if wa <= wb else (wb, wa)] = c
+    return {"nodes": nodes, "edges": edges}
+
+
+def to_json_graph(graph):
+    return {
+        "nodes": dict(graph.get("nodes", {})),
+        "edges": {f"{a}|{b}": c for (a, b), c in graph.get("edges", {}).items()},
+    }
+
+
+def from_json_graph(graph):
+    edges = {}
+    for k, c in graph.get("edges", {}).items():
+        a, sep, b = k.partition("|")
+        if sep:
+            key = (a, b) if a <= b else (b, a)
+            edges[key] = edges.get(key, 0) + c
+    return {"nodes": dict(graph.get("nodes", {})), "edges": edges}
+
+
+def build_graph_from_texts(texts, window=PAIR_WINDOW):
+    return to_json_graph(count_graph(texts, window))
+
+
+def merge_graph(g1, g2):
+    nodes = dict(g1.get("nodes", {}))
+    edges = dict(g1.get("edges", {}))
+    for k, v in g2.get("nodes", {}).items():
+        nodes[k] = nodes.get(k, 0) + v
+    for k, v in g2.get("edges", {}).items():
+        edges[k] = edges.get(k, 0) + v
+    return {"nodes": nodes, "edges": edges}
+
+
+def top_k(graph, max_nodes, max_edges):
+    # Partial selection instead of full sorts: O(n log k) per pass. nlargest is
+    # stable like sorted(..., reverse=True), so ties keep insertion order and
+    # the result is the same as the old sort-based compaction.
+    nodes = graph.get("nodes", {})
+    edges = graph.get("edges", {})
+    if max_nodes and len(nodes) > max_nodes:
+        keep = {k for k, _ in heapq.nlargest(max_nodes, nodes.items(), key=itemgetter(1))}
+        nodes = {k: v for k, v in nodes.items() if k in keep}
+        edges = {k: v for k, v in edges.items() if k[0] in keep and k[1] in keep}
+    if max_edges and len(edges) > max_edges:
+        edges = dict(heapq.nlargest(max_edges, edges.items(), key=itemgetter(1)))
+    return {"nodes": dict(nodes), "edges": dict(edges)}
+
+
+def compact_graph(graph, max_nodes, max_edges):
+    # Same contract as before for "a|b"-keyed graphs.
+    return to_json_graph(top_k(from_json_graph(graph), max_nodes, max_edges))
+
+
+def add_counts(target, delta):
+    # In-place merge_graph: folds delta's counts into target.
+    nodes = target.setdefault("nodes", {})
+    edges = target.setdefault("edges", {})
+    for k, v in delta.get("nodes", {}).items():
+        nodes[k] = nodes.get(k, 0) + v
+    for k, v in delta.get("edges", {}).items():
+        edges[k] = edges.get(k, 0) + v
+    return target
+
+
+class GraphEngine:
+    # Persistent co-occurrence counters for the global graph plus per-chat
+    # session counters. Each new message is tokenized once and its counts are
+    # folded into both, so an update costs O(message) instead of O(chat).
+    # Compaction to top-K only happens when a graph is read for display, or
+    # when stored counters outgrow GLOBAL_STORE_MAX_* / SESSION_STORE_MAX_*.
+    #
+    # With session_dir set, session counters are also persisted per chat as
+    # <session_dir>/<chat_id>.json ({"count", "nodes", "edges"}), written
+    # (debounced) whenever messages are added. "count" is the number of
+    # messages they cover; a file whose count differs from the chat's is
+    # stale and rebuilt, so reads after a restart are a file load instead of a
+    # pass over the whole chat.
+    def __init__(self, global_path, load_global, session_dir=None):
+        self.global_path = global_path
+        self._load_global = load_global
+        self.session_dir = session_dir
+        self._lock = threading.RLock()
+        self._global = None
+        self._global_views = {}
+        # Bumped on every change to the global counters, so readers can tell
+        # whether a global view they hold is still current.
+        self.global_version = 0
+        self._sessions = OrderedDict()
+        # chat_id -> session entry not yet written to session_dir
+        self._dirty = {}
+        self._timer = None
+
+    def _global_counts(self):
+        if self._global is None:
+            self._global = from_json_graph(self._load_global() or {})
+        return self._global
+
+    def _session_path(self, chat_id):
+        return os.path.join(self.session_dir, f"{chat_id}.json")
+
+    def _load_session(self, chat_id, count):
+        # Persisted counters covering exactly `count` messages, or None.
+        if not self.session_dir or count is None:
+            return None
+        data = load_json(self._session_path(chat_id), None)
+        if not isinstance(data, dict) or data.get("count") != count:
+            return None
+        return {"graph": from_json_graph(data), "count": count, "views": {}}
+
+    def _remember_session(self, chat_id, entry, dirty):
+        # Caller holds self._lock.
+        self._sessions[chat_id] = entry
+        self._sessions.move_to_end(chat_id)
+        while len(self._sessions) > SESSION_CACHE_SIZE:
+            self._sessions.popitem(last=False)
+        if dirty and self.session_dir:
+            self._dirty[chat_id] = entry
+
+    def session(self, chat_id, load_texts, max_nodes=None, max_edges=None, count=None):
+        # Top-K view of one chat's counters. count is the chat's message
+        # count, if known; cached or persisted counters covering a different
+        # count are stale. Counters are built from the full chat only when
+        # neither is usable (load_texts returns every message text). Views
+        # are cached until the next update, so polling reads are free.
+        with self._lock:
+            entry = self._sessions.get(chat_id)
+            if entry is not None and count is not None and entry["count"] != count:
+                entry = None
+            if entry is not None:
+                self._sessions.move_to_end(chat_id)
+        if entry is None:
+            with timer("local_bot_graph_seconds", op="session"):
+                entry = self._load_session(chat_id, count)
+                dirty = entry is None
+                if entry is None:
+                    texts = load_texts()
+                    entry = {"graph": count_graph(texts), "count": len(texts), "views": {}}
+            with self._lock:
+                self._remember_session(chat_id, entry, dirty)
+            if dirty:
+                self._schedule_flush()
+        with self._lock:
+            key = (max_nodes, max_edges)
+            view = entry["views"].get(key)
+            if view is None:
+                with timer("local_bot_graph_seconds", op="view"):
+                    view = entry["views"][key] = to_json_graph(top_k(entry["graph"], max_nodes, max_edges))
+            return view
+
+    def global_graph(self, max_nodes=None, max_edges=None):
+        with self._lock:
+            key = (max_nodes, max_edges)
+            view = self._global_views.get(key)
+            if view is None:
+                with timer("local_bot_graph_seconds", op="view"):
+                    view = self._global_views[key] = to_json_graph(top_k(self._global_counts(), max_nodes, max_edges))
+            return view
+
+    def add_messages(self, chat_id, start_seq, texts):
+        return self.add_batch([(chat_id, start_seq, texts)])
+
+    def add_batch(self, appends):
+        with timer("local_bot_graph_seconds", op="add"):
+            return self._add_batch(appends)
+
+    def _add_batch(self, appends):
+        # appends: [(chat_id, start_seq, texts)], start_seq being the position
+        # of texts[0] in that chat. If a cached session does not end right
+        # before it, it is dropped and rebuilt later. The chats' deltas are
+        # summed into one delta for the global counters: one merge and one
+        # version bump per batch.
+        counted = []
+        for chat_id, start_seq, texts in appends:
+            delta = count_graph(texts)
+            with self._lock:
+                entry = self._sessions.get(chat_id)
+            if entry is None:
+                entry = self._load_session(chat_id, start_seq)
+            counted.append((chat_id, start_seq, len(texts), delta, entry))
+        total = {"nodes": {}, "edges": {}}
+        with self._lock:
+            for chat_id, start_seq, n, delta, entry in counted:
+                if entry is not None:
+                    if entry["count"] == start_seq:
+                        add_counts(entry["graph"], delta)
+                        entry["count"] += n
+                        entry["views"] = {}
+                        self._remember_session(chat_id, entry, True)
+                    else:
+                        self._sessions.pop(chat_id, None)
+                        self._dirty.pop(chat_id, None)
+                add_counts(total, delta)
+            add_counts(self._global_counts(), total)
+            self._global_views = {}
+            self.global_version += 1
+        self._schedule_flush()
+        return total
+
+    def reset(self):
+        with self._lock:
+            self._global = {"nodes": {}, "edges": {}}
+            self._global_views = {}
+            self.global_version += 1
+            self._sessions.clear()
+        self.flush()
+
+    def _schedule_flush(self):
+        with self._lock:
+            if self._timer is not None:
+                return
+            self._timer = threading.Timer(GRAPH_FLUSH_SEC, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self):
+        with timer("local_bot_graph_seconds", op="flush"):
+            self._flush()
+
+    def _flush(self):
+        with self._lock:
+            self._timer = None
+            sessions = []
+            for chat_id, entry in self._dirty.items():
+                graph = entry["graph"]
+                if len(graph["nodes"]) > SESSION_STORE_MAX_NODES or len(graph["edges"]) > SESSION_STORE_MAX_EDGES:
+                    graph = entry["graph"] = top_k(graph, SESSION_STORE_MAX_NODES // 2, SESSION_STORE_MAX_EDGES // 2)
+                    entry["views"] = {}
+                sessions.append((chat_id, {"count": entry["count"], **to_json_graph(graph)}))
+            self._dirty = {}
+        if sessions:
+            os.makedirs(self.session_dir, exist_ok=True)
+            for chat_id, data in sessions:
+                save_json(self._session_path(chat_id), data, compact=True)
+        with self._lock:
+            if self._global is None:
+                return
+            graph = self._global
+            if len(graph["nodes"]) > GLOBAL_STORE_MAX_NODES or len(graph["edges"]) > GLOBAL_STORE_MAX_EDGES:
+                graph = top_k(graph, GLOBAL_STORE_MAX_NODES // 2, GLOBAL_STORE_MAX_EDGES // 2)
+                self._global = graph
+                self._global_views = {}
+                self.global_version += 1
+            snapshot = to_json_graph(graph)
+        save_json(self.global_path, snapshot, compact=True)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# Bridge inbox: every ingested answer, as a segmented append-only log.
+#
+# Segments are data/bridge_inbox/<created_ms>.jsonl, one JSON item per line.
+# The newest segment takes appends until it exceeds segment_bytes or is older
+# than segment_sec; then a new one is started and whole old segments are
+# deleted while the inbox is over max_bytes or they are older than max_age_sec.
+# The last item is kept in memory, so last() never touches the disk.
+#
+# Limits come from "inbox_retention" in config.json (see DEFAULT_RETENTION).
+import json
+import os
+import threading
+import time
+
+from storage import load_json, sync_appended
+
+DEFAULT_RETENTION = {
+    "max_bytes": 20 * 1024 * 1024,
+    "max_age_sec": 30 * 24 * 3600,
+    "segment_bytes": 1024 * 1024,
+    "segment_sec": 24 * 3600,
+}
+TAIL_BLOCK_BYTES = 65536
+
+
+def retention_from_config(config):
+    out = dict(DEFAULT_RETENTION)
+    custom = config.get("inbox_retention") if isinstance(config, dict) else None
+    if isinstance(custom, dict):
+        for k in out:
+            try:
+                out[k] = max(0, float(custom[k])) if k in custom else out[k]
+            except (TypeError, ValueError):
+                pass
+    return out
+
+
+class Inbox:
+    def __init__(self, inbox_dir):
+        self.inbox_dir = inbox_dir
+        self._lock = threading.Lock()
+        self._segments = None
+        self._size = 0
+        self._last = None
+
+    def _segment_path(self, name):
+        return os.path.join(self.inbox_dir, name)
+
+    def _load(self):
+        if self._segments is not None:
+            return
+        os.makedirs(self.inbox_dir, exist_ok=True)
+        names = sorted((f for f in os.listdir(self.inbox_dir) if f.endswith(".jsonl")), key=lambda f: int(f[:-6]))
+        self._segments = []
+        for name in names:
+            try:
+                self._segments.append([name, os.path.getsize(self._segment_path(name))])
+            except OSError:
+                pass
+        self._size = sum(size for _name, size in self._segments)
+        for name, _size in reversed(self._segments):
+            self._last = _read_last_line(self._segment_path(name))
+            if self._last is not None:
+                break
+
+    def _new_segment(self):
+        name = f"{int(time.time() * 1000)}.jsonl"
+        if self._segments and name <= self._segments[-1][0]:
+            name = f"{int(self._segments[-1][0][:-6]) + 1}.jsonl"
+        self._segments.append([name, 0])
+        return self._segments[-1]
+
+    def append(self, item, retention=None):
+        self.extend([item], retention)
+
+    def extend(self, items, retention=None):
+        # One write and one sync for all items; they share a segment.
+        if not items:
+            return
+        retention = retention or DEFAULT_RETENTION
+        lines = "".join(json.dumps(item, ensure_ascii=False) + "\n" for item in items).encode("utf-8")
+        with self._lock:
+            self._load()
+            segment = self._segments[-1] if self._segments else None
+            if segment is None or segment[1] >= retention["segment_bytes"] or (
+                    time.time() - int(segment[0][:-6]) / 1000 >= retention["segment_sec"]):
+                segment = self._new_segment()
+                self._enforce(retention)
+            path = self._segment_path(segment[0])
+            with open(path, "ab") as f:
+                f.write(lines)
+            segment[1] += len(lines)
+            self._size += len(lines)
+            self._last = items[-1]
+        sync_appended(path)
+
+    def _enforce(self, retention):
+        # Only sealed segments are dropped; the one being written always stays.
+        now = time.time()
+        while len(self._segments) > 1:
+            name, size = self._segments[0]
+            try:
+                age = now - os.path.getmtime(self._segment_path(name))
+            except OSError:
+                age = 0
+            if self._size <= retention["max_bytes"] and age <= retention["max_age_sec"]:
+                break
+            try:
+                os.remove(self._segment_path(name))
+            except FileNotFoundError:
+                pass
+            self._segments.pop(0)
+            self._size -= size
+            print(f"[Inbox] dropped segment {name} ({size} bytes)")
+
+    def last(self):
+        with self._lock:
+            self._load()
+            return self._last
+
+    def stats(self):
+        with self._lock:
+            self._load()
+            return {"segments": len(self._segments), "bytes": self._size}
+
+    def import_json(self, path, retention=None):
+        # One-time migration of the old bridge_inbox.json list: one batch
+        # append (one write, one sync), then the old file is renamed.
+        items = load_json(path, None)
+        if not isinstance(items, list):
+            return 0
+        self.extend(items, retention)
+        os.replace(path, path + ".migrated")
+        print(f"[Inbox] imported {len(items)} items from {os.path.basename(path)}")
+        return len(items)
+
+
+def _read_last_line(path):
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return None
+    with f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        data = b""
+        while pos > 0 and data.rstrip(b"\n").count(b"\n") < 1:
+            step = min(TAIL_BLOCK_BYTES, pos)
+            pos -= step
+            f.seek(pos)
+            data = f.read(step) + data
+    for line in reversed(data.split(b"\n")):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            return json.loads(line.decode("utf-8"))
+        except ValueError:
+            # Torn last line from a crash mid-append.
+            continue
+    return None
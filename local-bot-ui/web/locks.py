@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# Per-chat write locks, in-process and across processes.
+#
+# hold(chat_id) takes a thread lock for the chat, then an exclusive OS lock on
+# <lock_dir>/<chat_id>.lock (flock on POSIX, msvcrt.locking on Windows), so the
+# web server, app.py or a migration run can share one chats dir. The lock is
+# re-entrant per thread. Wait times are kept for /api/status.
+import os
+import statistics
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
+WAIT_SAMPLES = 1024
+
+
+def _lock_file(f, blocking):
+    # True if the lock was taken; False only when blocking is False and it is busy.
+    if fcntl is not None:
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            return False
+        return True
+    if msvcrt is not None:
+        f.seek(0)
+        while True:
+            try:
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+                return True
+            except OSError:
+                if not blocking:
+                    return False
+                time.sleep(0.01)
+    return True
+
+
+def _unlock_file(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    elif msvcrt is not None:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class ChatLocks:
+    def __init__(self, lock_dir):
+        self.lock_dir = lock_dir
+        self._guard = threading.Lock()
+        # chat_id -> [threading.Lock, number of threads using or waiting on it]
+        self._locks = {}
+        self._local = threading.local()
+        self._waits = deque(maxlen=WAIT_SAMPLES)
+        self.acquired = 0
+        self.contended = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    @contextmanager
+    def hold(self, chat_id):
+        depth = self._local.__dict__.setdefault("depth", {})
+        if depth.get(chat_id):
+            depth[chat_id] += 1
+            try:
+                yield
+            finally:
+                depth[chat_id] -= 1
+            return
+        with self._guard:
+            entry = self._locks.get(chat_id)
+            if entry is None:
+                entry = self._locks[chat_id] = [threading.Lock(), 0]
+            entry[1] += 1
+        t0 = time.perf_counter()
+        contended = not entry[0].acquire(blocking=False)
+        if contended:
+            entry[0].acquire()
+        f = None
+        try:
+            os.makedirs(self.lock_dir, exist_ok=True)
+            f = open(os.path.join(self.lock_dir, f"{chat_id}.lock"), "a+b")
+            if not _lock_file(f, False):
+                contended = True
+                _lock_file(f, True)
+            self._record(time.perf_counter() - t0, contended)
+            depth[chat_id] = 1
+            yield
+        finally:
+            depth.pop(chat_id, None)
+            if f is not None:
+                try:
+                    _unlock_file(f)
+                finally:
+                    f.close()
+            entry[0].release()
+            with self._guard:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    self._locks.pop(chat_id, None)
+
+    def _record(self, wait, contended):
+        with self._guard:
+            self.acquired += 1
+            self.contended += 1 if contended else 0
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            self._waits.append(wait)
+
+    def stats(self):
+        with self._guard:
+            waits = sorted(self._waits)
+            out = {
+                "acquired": self.acquired,
+                "contended": self.contended,
+                "wait_total_ms": round(self.wait_total * 1000, 3),
+                "wait_max_ms": round(self.wait_max * 1000, 3),
+            }
+        if waits:
+            out["wait_p50_ms"] = round(statistics.median(waits) * 1000, 3)
+            out["wait_p95_ms"] = round(waits[min(len(waits) - 1, int(len(waits) * 0.95))] * 1000, 3)
+        return out
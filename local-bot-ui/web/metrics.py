@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# Process-wide metrics for /api/metrics, in the Prometheus text format (0.0.4),
+# without the prometheus_client dependency.
+#
+# Counters and histograms are declared once below and updated with inc(),
+# observe() or `with timer(...)`; one lock, a dict lookup and a bisect per
+# update. Gauges (queue depths, cache sizes) are not stored: collectors
+# registered with collector() read them from the owning objects at scrape time.
+#
+# Tracing: between trace_start() and trace_stop() on a thread, every histogram
+# that has a span name also adds its observations to that thread's trace, so a
+# request can report where its time went (server.py sends it as Server-Timing).
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+_local = threading.local()
+
+
+def _labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(pairs):
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # name -> {"type", "help", "buckets", "span", "values": {labels: value}};
+        # a histogram value is [count per bucket (+Inf last), sum, count].
+        self._families = {}
+        self._collectors = []
+
+    def counter(self, name, help_text):
+        self._families[name] = {"type": "counter", "help": help_text, "span": None, "values": {}}
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS, span=None):
+        self._families[name] = {"type": "histogram", "help": help_text, "buckets": buckets, "span": span, "values": {}}
+
+    def collector(self, fn):
+        # fn() returns [(name, type, help, [(labels dict, value)])].
+        self._collectors.append(fn)
+
+    def inc(self, name, value=1, **labels):
+        family = self._families[name]
+        key = _labels_key(labels)
+        with self._lock:
+            values = family["values"]
+            values[key] = values.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        family = self._families[name]
+        key = _labels_key(labels)
+        i = bisect.bisect_left(family["buckets"], value)
+        with self._lock:
+            h = family["values"].get(key)
+            if h is None:
+                h = family["values"][key] = [[0] * (len(family["buckets"]) + 1), 0.0, 0]
+            h[0][i] += 1
+            h[1] += value
+            h[2] += 1
+        spans = getattr(_local, "spans", None)
+        if spans is not None and family["span"]:
+            span = spans.get(family["span"])
+            if span is None:
+                spans[family["span"]] = [value, 1]
+            else:
+                span[0] += value
+                span[1] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - t0, **labels)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            snapshot = []
+            for name, family in self._families.items():
+                if family["type"] == "histogram":
+                    values = {k: (list(v[0]), v[1], v[2]) for k, v in family["values"].items()}
+                else:
+                    values = dict(family["values"])
+                snapshot.append((name, family, values))
+        for name, family, values in snapshot:
+            kind = family["type"]
+            buckets = family.get("buckets")
+            lines.append(f"# HELP {name} {family['help']}")
+            lines.append(f"# TYPE {name} {kind}")
+            for key in sorted(values):
+                if kind != "histogram":
+                    lines.append(f"{name}{_format_labels(key)} {_format_value(values[key])}")
+                    continue
+                counts, total, n = values[key]
+                cumulative = 0
+                for bound, c in zip(buckets + (float("inf"),), counts):
+                    cumulative += c
+                    le = key + (("le", _format_value(float(bound))),)
+                    lines.append(f"{name}_bucket{_format_labels(le)} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(key)} {_format_value(total)}")
+                lines.append(f"{name}_count{_format_labels(key)} {n}")
+        for fn in self._collectors:
+            try:
+                collected = fn()
+            except Exception as e:
+                lines.append(f"# collector {getattr(fn, '__name__', fn)} failed: {_escape(e)}")
+                continue
+            for name, kind, help_text, samples in collected:
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    if value is None:
+                        continue
+                    lines.append(f"{name}{_format_labels(_labels_key(labels))} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def trace_start():
+    _local.spans = {}
+
+
+def trace_spans():
+    # {span: (seconds, observations)} of this thread's running trace, or None.
+    spans = getattr(_local, "spans", None)
+    if spans is None:
+        return None
+    return {name: (s[0], s[1]) for name, s in spans.items()}
+
+
+def trace_stop():
+    spans = trace_spans()
+    _local.spans = None
+    return spans
+
+
+REGISTRY = Registry()
+inc = REGISTRY.inc
+observe = REGISTRY.observe
+timer = REGISTRY.timer
+collector = REGISTRY.collector
+render = REGISTRY.render
+
+REGISTRY.counter("local_bot_http_requests_total", "HTTP requests by method, route and status code.")
+REGISTRY.histogram("local_bot_http_request_seconds", "HTTP request handling time, from dispatch to the last byte written.")
+REGISTRY.histogram("local_bot_gen_queue_wait_seconds", "Time a generation waited for a scheduler slot.", span="queue")
+REGISTRY.histogram("local_bot_ollama_generation_seconds", "Ollama /api/generate time, request to last chunk.", span="ollama")
+REGISTRY.histogram("local_bot_ollama_first_token_seconds", "Ollama streaming: request to first response piece.")
+REGISTRY.counter("local_bot_ollama_generation_errors_total", "Ollama generations that failed or were abandoned.")
+REGISTRY.histogram("local_bot_disk_seconds", "Disk time by op: load/save of JSON files (save includes the group-commit fsync), sync of appended logs, read_log/append_log of chat logs.", span="disk")
+REGISTRY.histogram("local_bot_graph_seconds", "Graph engine time by op: add (counting new messages), session (cold load or rebuild), view (top-K), flush.", span="graph")
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# Cached Ollama model catalog behind /api/models.
+#
+# get() never waits for Ollama once a list is known: within ttl it is served as
+# is, after that it is still served (marked stale) while one background thread
+# refreshes it. A failed refresh keeps the last good list and is retried after
+# ERROR_TTL_SEC. The catalog is saved to disk, so a restarted server answers
+# before Ollama has been asked at all; only a cold start waits, at most
+# COLD_WAIT_SEC.
+import threading
+import time
+
+from storage import load_json, save_json
+
+TTL_SEC = 60.0
+ERROR_TTL_SEC = 10.0
+COLD_WAIT_SEC = 1.0
+REFRESH_WAIT_SEC = 5.0
+
+
+def model_info(m):
+    # The /api/tags fields the UI shows next to a model name.
+    details = m.get("details") or {}
+    return {
+        "name": m.get("name"),
+        "size": m.get("size"),
+        "modified_at": m.get("modified_at"),
+        "family": details.get("family"),
+        "parameter_size": details.get("parameter_size"),
+        "quantization": details.get("quantization_level"),
+    }
+
+
+class ModelCatalog:
+    def __init__(self, fetch, path=None, ttl=TTL_SEC, on_change=None):
+        # fetch() returns the raw /api/tags "models" list or raises.
+        self.fetch = fetch
+        self.path = path
+        self.ttl = ttl
+        self.on_change = on_change
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._done.set()
+        self._refreshing = False
+        self._models = None
+        self._fetched_at = 0.0
+        self._checked_at = 0.0
+        self._error = None
+        self.fetches = 0
+        self.failures = 0
+        if path:
+            cached = load_json(path, None)
+            if isinstance(cached, dict) and isinstance(cached.get("models"), list):
+                self._models = cached["models"]
+                self._fetched_at = float(cached.get("fetched_at") or 0)
+
+    def get(self, wait=COLD_WAIT_SEC):
+        with self._lock:
+            cold = self._models is None
+            interval = ERROR_TTL_SEC if self._error else self.ttl
+            if time.time() - self._checked_at >= interval:
+                self._start_refresh()
+        if cold and wait:
+            self._done.wait(wait)
+        return self.snapshot()
+
+    def refresh(self, wait=REFRESH_WAIT_SEC):
+        # Explicit refresh (button, /api/models/refresh): always asks Ollama.
+        with self._lock:
+            self._start_refresh()
+        self._done.wait(wait)
+        return self.snapshot()
+
+    def _start_refresh(self):
+        # Caller holds self._lock. At most one refresh runs at a time.
+        if self._refreshing:
+            return
+        self._refreshing = True
+        self._done.clear()
+        threading.Thread(target=self._refresh, daemon=True).start()
+
+    def _refresh(self):
+        models, error = None, None
+        try:
+            models = sorted((model_info(m) for m in self.fetch() if m.get("name")), key=lambda m: m["name"])
+        except Exception as e:
+            error = str(e) or e.__class__.__name__
+        with self._lock:
+            self.fetches += 1
+            self._checked_at = time.time()
+            self._error = error
+            changed = models is not None and models != self._models
+            if models is not None:
+                self._models = models
+                self._fetched_at = self._checked_at
+            else:
+                self.failures += 1
+            self._refreshing = False
+            self._done.set()
+            saved = {"models": self._models, "fetched_at": self._fetched_at}
+        if error:
+            print(f"[Models] refresh failed: {error}")
+        if changed:
+            if self.path:
+                save_json(self.path, saved, compact=True)
+            if self.on_change:
+                self.on_change()
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "models": list(self._models or []),
+                "fetched_at": self._fetched_at or None,
+                "stale": self._models is None or time.time() - self._fetched_at >= self.ttl,
+                "refreshing": self._refreshing,
+                "error": self._error,
+            }
+
+    def stats(self):
+        with self._lock:
+            return {
+                "models": len(self._models or []),
+                "age_sec": round(time.time() - self._fetched_at, 1) if self._fetched_at else None,
+                "fetches": self.fetches,
+                "failures": self.failures,
+                "error": self._error,
+            }
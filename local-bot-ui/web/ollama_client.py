@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+# Shared HTTP client for Ollama (web server, bridge).
+#
+# - Keep-alive connections are pooled per client instead of one TCP connect
+#   per call.
+# - Connect and read timeouts are separate: a dead host fails after
+#   CONNECT_TIMEOUT, a slow generation may take READ_TIMEOUT.
+# - A refused or reset connect is retried with exponential backoff. Nothing is
+#   retried once the request was sent (a generation never runs twice), except
+#   on a pooled connection the server had already closed.
+# - A circuit breaker opens after BREAKER_THRESHOLD consecutive connection
+#   failures: calls then fail at once with OllamaUnavailable until
+#   BREAKER_RESET_SEC have passed, when one trial call is let through.
+# - Generation time, time to first token and failed generations are recorded
+#   in metrics.py.
+#
+# Errors subclass urllib.error.URLError, as urlopen raised before.
+import http.client
+import json
+import os
+import queue
+import socket
+import threading
+import time
+import urllib.error
+from urllib.parse import urlparse
+
+from metrics import inc, observe
+
+CONNECT_TIMEOUT = float(os.environ.get("OLLAMA_CONNECT_TIMEOUT") or 2.0)
+READ_TIMEOUT = float(os.environ.get("OLLAMA_TIMEOUT") or 120.0)
+RETRIES = int(os.environ.get("OLLAMA_RETRIES") or 2)
+BACKOFF_SEC = 0.2
+POOL_SIZE = 8
+BREAKER_THRESHOLD = 3
+BREAKER_RESET_SEC = 10.0
+
+# A pooled keep-alive connection the server already closed; retried at once.
+_STALE_ERRORS = (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError, ConnectionAbortedError)
+
+
+class OllamaUnavailable(urllib.error.URLError):
+    pass
+
+
+class OllamaClient:
+    def __init__(self, base_url, pool_size=POOL_SIZE, connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT, retries=RETRIES):
+        parsed = urlparse(base_url.rstrip("/"))
+        self.base_url = base_url.rstrip("/")
+        self.host = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port or (443 if parsed.scheme == "https" else 80)
+        self.https = parsed.scheme == "https"
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._open_until = 0.0
+        self._trial = False
+        self.requests = 0
+        self.connects = 0
+        self.errors = 0
+        self.rejected = 0
+
+    def _connect(self):
+        cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+        conn = cls(self.host, self.port, timeout=self.connect_timeout)
+        conn.connect()
+        # Small request bodies must not wait for a delayed ACK.
+        conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self._lock:
+            self.connects += 1
+        return conn
+
+    def _get_conn(self):
+        try:
+            return self._pool.get_nowait(), True
+        except queue.Empty:
+            return self._connect(), False
+
+    def _release(self, conn, res):
+        # Only a fully read keep-alive response leaves the connection reusable.
+        if res.will_close:
+            conn.close()
+        else:
+            self._put_conn(conn)
+
+    def _put_conn(self, conn):
+        try:
+            self._pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def close(self):
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def _admit(self):
+        with self._lock:
+            if self._open_until and time.monotonic() < self._open_until:
+                self.rejected += 1
+                raise OllamaUnavailable("Ollama недоступна (повтор через %.0fс)" % (self._open_until - time.monotonic()))
+            if self._open_until:
+                # Half-open: exactly one trial request until it succeeds or fails.
+                if self._trial:
+                    self.rejected += 1
+                    raise OllamaUnavailable("Ollama недоступна (идёт проверка)")
+                self._trial = True
+
+    def _succeeded(self):
+        with self._lock:
+            self._failures = 0
+            self._open_until = 0.0
+            self._trial = False
+
+    def _failed(self):
+        with self._lock:
+            self.errors += 1
+            self._failures += 1
+            self._trial = False
+            if self._failures >= BREAKER_THRESHOLD or self._open_until:
+                self._open_until = time.monotonic() + BREAKER_RESET_SEC
+                print(f"[Ollama] circuit open for {BREAKER_RESET_SEC:.0f}s after {self._failures} failures")
+
+    def state(self):
+        with self._lock:
+            if not self._open_until:
+                return "closed"
+            return "open" if time.monotonic() < self._open_until else "half-open"
+
+    def stats(self):
+        return {
+            "state": self.state(),
+            "requests": self.requests,
+            "connects": self.connects,
+            "errors": self.errors,
+            "rejected": self.rejected,
+            "idle_connections": self._pool.qsize(),
+        }
+
+    def _open(self, method, path, body, timeout):
+        # Returns (conn, response) with the status already checked.
+        self._admit()
+        headers = {"Content-Type": "application/json"} if body is not None else {}
+        attempt = 0
+        while True:
+            conn = None
+            sent = False
+            try:
+                conn, reused = self._get_conn()
+                conn.sock.settimeout(timeout or self.read_timeout)
+                try:
+                    sent = True
+                    conn.request(method, path, body=body, headers=headers)
+                    res = conn.getresponse()
+                except _STALE_ERRORS:
+                    if not reused:
+                        raise
+                    conn.close()
+                    sent = False
+                    conn = self._connect()
+                    conn.sock.settimeout(timeout or self.read_timeout)
+                    sent = True
+                    conn.request(method, path, body=body, headers=headers)
+                    res = conn.getresponse()
+            except (OSError, http.client.HTTPException) as e:
+                if conn is not None:
+                    conn.close()
+                if sent and isinstance(e, socket.timeout):
+                    # Ollama took the request but is slow: not held against
+                    # the breaker.
+                    self._succeeded()
+                    raise urllib.error.URLError(e)
+                # A connect timeout means the host does not answer at all;
+                # waiting for it again would only multiply the delay.
+                if sent or attempt >= self.retries or isinstance(e, socket.timeout):
+                    self._failed()
+                    raise OllamaUnavailable(e)
+                attempt += 1
+                time.sleep(BACKOFF_SEC * (2 ** (attempt - 1)))
+                continue
+            with self._lock:
+                self.requests += 1
+            self._succeeded()
+            if res.status >= 400:
+                data = res.read()
+                self._release(conn, res)
+                raise urllib.error.HTTPError(self.base_url + path, res.status, data.decode("utf-8", "replace")[:200], res.headers, None)
+            return conn, res
+
+    def request_json(self, method, path, payload=None, timeout=None):
+        body = json.dumps(payload).encode("utf-8") if payload is not None else None
+        conn, res = self._open(method, path, body, timeout)
+        try:
+            data = json.loads(res.read().decode("utf-8") or "{}")
+        except BaseException:
+            conn.close()
+            raise
+        self._release(conn, res)
+        return data
+
+    def stream_json(self, path, payload, timeout=None):
+        # Yields one parsed object per NDJSON line. The connection goes back to
+        # the pool only if the stream was read to the end.
+        conn, res = self._open("POST", path, json.dumps(payload).encode("utf-8"), timeout)
+        finished = False
+        try:
+            while True:
+                line = res.readline()
+                if not line:
+                    finished = True
+                    break
+                line = line.strip()
+                if line:
+                    yield json.loads(line.decode("utf-8"))
+        finally:
+            if finished:
+                self._release(conn, res)
+            else:
+                conn.close()
+
+    def tags(self, timeout=None):
+        return self.request_json("GET", "/api/tags", timeout=timeout).get("models", [])
+
+    def generate(self, model, prompt, options=None, timeout=None, context=None, final=None):
+        # final, if a dict, receives Ollama's whole reply (context, counts).
+        t0 = time.perf_counter()
+        try:
+            data = self.request_json("POST", "/api/generate", _payload(model, prompt, False, options, context), timeout)
+        except BaseException:
+            inc("local_bot_ollama_generation_errors_total", model=model, mode="json")
+            raise
+        observe("local_bot_ollama_generation_seconds", time.perf_counter() - t0, model=model, mode="json")
+        if final is not None:
+            final.update(data)
+        return data.get("response", "")
+
+    def generate_stream(self, model, prompt, options=None, timeout=None, context=None, final=None):
+        # Yields response pieces as Ollama emits them; final, if a dict,
+        # receives the closing "done" chunk. A stream closed early (client
+        # gone) counts as a failed generation.
+        t0 = time.perf_counter()
+        first = True
+        finished = False
+        try:
+            for chunk in self.stream_json("/api/generate", _payload(model, prompt, True, options, context), timeout):
+                if chunk.get("error"):
+                    raise RuntimeError(chunk["error"])
+                piece = chunk.get("response", "")
+                if piece:
+                    if first:
+                        first = False
+                        observe("local_bot_ollama_first_token_seconds", time.perf_counter() - t0, model=model)
+                    yield piece
+                if chunk.get("done") and final is not None:
+                    final.update(chunk)
+            finished = True
+        finally:
+            if finished:
+                observe("local_bot_ollama_generation_seconds", time.perf_counter() - t0, model=model, mode="stream")
+            else:
+                inc("local_bot_ollama_generation_errors_total", model=model, mode="stream")
+
+
+def _payload(model, prompt, stream, options, context):
+    payload = {"model": model, "prompt": prompt, "stream": stream}
+    if options:
+        payload["options"] = options
+    if context:
+        payload["context"] = context
+    return payload
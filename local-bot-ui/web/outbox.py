@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# Durable bridge outbox: per-source FIFO queues in SQLite (WAL).
+#
+# A poller claims the oldest visible item of its source; the item stays in the
+# queue but is hidden for VISIBILITY_SEC. ack() deletes it, nack() makes it
+# visible again right away. If the tab dies before acking, the claim simply
+# expires and the item is redelivered to the next poller. Each claim carries a
+# random token, so a late ack for an expired claim cannot delete an item that
+# was handed to someone else in the meantime.
+#
+# The old pop-style dequeue is kept as take() (claim + ack in one transaction).
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from storage import load_json
+
+VISIBILITY_SEC = 60.0
+# Items that were claimed this many times without an ack are dropped.
+MAX_ATTEMPTS = 5
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    source TEXT NOT NULL,
+    chat_id TEXT NOT NULL,
+    text TEXT NOT NULL,
+    ts REAL NOT NULL,
+    visible_at REAL NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    token TEXT
+);
+CREATE INDEX IF NOT EXISTS outbox_source ON outbox (source, id);
+"""
+
+
+class Outbox:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(_SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _tx(self, fn):
+        # BEGIN IMMEDIATE takes the write lock up front, so claims are atomic
+        # even if another process opens the same database.
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(self._db)
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+            return result
+
+    def enqueue(self, chat_id, source, text, ts=None):
+        def run(db):
+            cur = db.execute(
+                "INSERT INTO outbox (source, chat_id, text, ts) VALUES (?, ?, ?, ?)",
+                (source, chat_id, text, time.time() if ts is None else ts),
+            )
+            return cur.lastrowid
+        return self._tx(run)
+
+    def _claim(self, db, source, visibility):
+        now = time.time()
+        while True:
+            if source:
+                row = db.execute(
+                    "SELECT id, source, chat_id, text, ts, attempts FROM outbox "
+                    "WHERE source = ? AND visible_at <= ? ORDER BY id LIMIT 1",
+                    (source, now),
+                ).fetchone()
+            else:
+                row = db.execute(
+                    "SELECT id, source, chat_id, text, ts, attempts FROM outbox "
+                    "WHERE visible_at <= ? ORDER BY id LIMIT 1",
+                    (now,),
+                ).fetchone()
+            if row is None:
+                return None
+            item_id, src, chat_id, text, ts, attempts = row
+            if attempts >= MAX_ATTEMPTS:
+                db.execute("DELETE FROM outbox WHERE id = ?", (item_id,))
+                print(f"[Outbox] dropped after {attempts} attempts: id={item_id} source={src}")
+                continue
+            token = uuid.uuid4().hex
+            db.execute(
+                "UPDATE outbox SET visible_at = ?, attempts = attempts + 1, token = ? WHERE id = ?",
+                (now + visibility, token, item_id),
+            )
+            return {"id": item_id, "token": token, "source": src, "chat_id": chat_id, "text": text, "ts": ts, "attempt": attempts + 1}
+
+    def claim(self, source="", visibility=VISIBILITY_SEC):
+        # Oldest visible item for source ("" = any source), or None.
+        return self._tx(lambda db: self._claim(db, source, visibility))
+
+    def ack(self, item_id, token):
+        # Returns the item's source, or None if the lease is gone.
+        def run(db):
+            row = db.execute("SELECT source FROM outbox WHERE id = ? AND token = ?", (item_id, token)).fetchone()
+            if row is not None:
+                db.execute("DELETE FROM outbox WHERE id = ?", (item_id,))
+            return row[0] if row else None
+        return self._tx(run)
+
+    def nack(self, item_id, token):
+        def run(db):
+            row = db.execute("SELECT source FROM outbox WHERE id = ? AND token = ?", (item_id, token)).fetchone()
+            if row is not None:
+                db.execute("UPDATE outbox SET visible_at = 0, token = NULL WHERE id = ?", (item_id,))
+            return row[0] if row else None
+        return self._tx(run)
+
+    def take(self, source=""):
+        def run(db):
+            item = self._claim(db, source, VISIBILITY_SEC)
+            if item is not None:
+                db.execute("DELETE FROM outbox WHERE id = ?", (item["id"],))
+            return item
+        return self._tx(run)
+
+    def count(self, source=""):
+        with self._lock:
+            if source:
+                return self._db.execute("SELECT COUNT(*) FROM outbox WHERE source = ?", (source,)).fetchone()[0]
+            return self._db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    def import_json(self, path):
+        # One-time migration of the old bridge_outbox.json list.
+        items = load_json(path, None)
+        if not isinstance(items, list):
+            return 0
+        n = 0
+        for item in items:
+            if item.get("source") and item.get("text"):
+                self.enqueue(item.get("chat_id", ""), item["source"], item["text"], item.get("ts"))
+                n += 1
+        os.replace(path, path + ".migrated")
+        print(f"[Outbox] imported {n} items from {os.path.basename(path)}")
+        return n
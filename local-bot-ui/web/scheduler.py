@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# Admission control for Ollama generations.
+#
+# Every generation (web UI, and /api/generate used by the bridge and app.py)
+# takes a slot first. Each model runs at most `slots` generations at once
+# (match Ollama's OLLAMA_NUM_PARALLEL, which batches them) and all models
+# together at most `max_running`, so a generation holds a server worker only
+# within max_running + max_queue whatever the number of models. The rest wait in
+# one bounded queue, interactive requests ahead of bridge traffic and FIFO
+# within a priority. When the queue is full, a request evicts the newest waiter
+# of a lower priority, or is itself refused. Refused, evicted and timed out
+# requests raise Busy so the caller answers 429 instead of piling more work
+# onto the model.
+import os
+import statistics
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from itertools import count
+
+from metrics import observe
+
+PRIORITY_UI = 0
+PRIORITY_BRIDGE = 1
+PRIORITIES = {"ui": PRIORITY_UI, "bridge": PRIORITY_BRIDGE}
+SLOTS_PER_MODEL = int(os.environ.get("LOCAL_BOT_GEN_SLOTS") or 1)
+MAX_QUEUE = int(os.environ.get("LOCAL_BOT_GEN_QUEUE") or 6)
+MAX_RUNNING = int(os.environ.get("LOCAL_BOT_GEN_MAX_RUNNING") or max(2, SLOTS_PER_MODEL))
+QUEUE_TIMEOUT_SEC = 120.0
+WAIT_SAMPLES = 1024
+
+
+class Busy(Exception):
+    def __init__(self, reason, depth):
+        super().__init__(reason)
+        self.reason = reason
+        self.depth = depth
+
+
+class Scheduler:
+    def __init__(self, slots=SLOTS_PER_MODEL, max_queue=MAX_QUEUE, max_running=MAX_RUNNING):
+        self.slots = slots
+        self.max_queue = max_queue
+        self.max_running = max_running
+        self._cond = threading.Condition()
+        # model -> generations running
+        self._running = {}
+        self._total = 0
+        # (priority, seq, model) of every waiting request
+        self._queue = []
+        # Waiting entries pushed out by a higher priority request.
+        self._evicted = set()
+        self._seq = count()
+        self._waits = deque(maxlen=WAIT_SAMPLES)
+        self.admitted = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.max_depth = 0
+
+    def _ready(self, entry):
+        # entry is the first waiter among those whose model has a free slot,
+        # and a global slot is free.
+        if self._total >= self.max_running or self._running.get(entry[2], 0) >= self.slots:
+            return False
+        return entry == min(e for e in self._queue if self._running.get(e[2], 0) < self.slots)
+
+    def fit(self, workers):
+        # Shrinks max_running and max_queue so that generations, running or
+        # queued, hold at most `workers` server threads.
+        with self._cond:
+            self.max_running = max(1, min(self.max_running, workers // 2))
+            self.max_queue = max(1, min(self.max_queue, workers - self.max_running))
+
+    def acquire(self, model, priority=PRIORITY_UI, timeout=QUEUE_TIMEOUT_SEC):
+        t0 = time.perf_counter()
+        with self._cond:
+            entry = (priority, next(self._seq), model)
+            self._queue.append(entry)
+            if not self._ready(entry):
+                # Only requests that have to wait count against the queue.
+                if len(self._queue) > self.max_queue:
+                    victim = max(self._queue)
+                    if victim[0] <= priority:
+                        self._queue.remove(entry)
+                        self.rejected += 1
+                        raise Busy("queue full", len(self._queue))
+                    self._queue.remove(victim)
+                    self._evicted.add(victim)
+                    self._cond.notify_all()
+                self.max_depth = max(self.max_depth, len(self._queue))
+            deadline = time.monotonic() + timeout
+            while True:
+                if entry in self._evicted:
+                    self._evicted.discard(entry)
+                    self.rejected += 1
+                    raise Busy("preempted", len(self._queue))
+                if self._ready(entry):
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._queue.remove(entry)
+                    self.timeouts += 1
+                    self._cond.notify_all()
+                    raise Busy("queue timeout", len(self._queue))
+                self._cond.wait(remaining)
+            self._queue.remove(entry)
+            self._running[model] = self._running.get(model, 0) + 1
+            self._total += 1
+            self.admitted += 1
+            # The next waiter may now be first among the runnable ones.
+            self._cond.notify_all()
+            wait = time.perf_counter() - t0
+            self._waits.append(wait)
+        observe("local_bot_gen_queue_wait_seconds", wait, model=model)
+
+    def release(self, model):
+        with self._cond:
+            if model in self._running:
+                self._total -= 1
+            left = self._running.get(model, 1) - 1
+            if left > 0:
+                self._running[model] = left
+            else:
+                self._running.pop(model, None)
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, model, priority=PRIORITY_UI, timeout=QUEUE_TIMEOUT_SEC):
+        self.acquire(model, priority, timeout)
+        try:
+            yield
+        finally:
+            self.release(model)
+
+    def stats(self):
+        with self._cond:
+            waits = sorted(self._waits)
+            out = {
+                "running": dict(self._running),
+                "max_running": self.max_running,
+                "max_queue": self.max_queue,
+                "queued": {name: sum(1 for e in self._queue if e[0] == p) for name, p in PRIORITIES.items()},
+                "max_depth": self.max_depth,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "timeouts": self.timeouts,
+            }
+        if waits:
+            out["wait_p50_ms"] = round(statistics.median(waits) * 1000, 3)
+            out["wait_p95_ms"] = round(waits[min(len(waits) - 1, int(len(waits) * 0.95))] * 1000, 3)
+        return out
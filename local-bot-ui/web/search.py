@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# Full-text search over chat messages (/api/search).
+#
+# An in-memory inverted index, term -> {doc: term frequency}, where a doc is one
+# message (chat_id, seq). Terms come from graph.tokenize, so search sees the
+# same words and skips the same STOPWORDS as the graph. The index is built from
+# the chat files once (start() runs it in the background) and then kept current
+# by on_append(); appends that land while the build runs are queued and applied
+# when it finishes. Hits are ranked with BM25. Message texts are kept (they are
+# the strings the build loaded anyway), so snippets need no disk reads.
+import heapq
+import math
+import threading
+import time
+from collections import Counter
+
+from graph import tokenize
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+SNIPPET_CHARS = 160
+BUILD_WAIT_SEC = 10.0
+
+
+def snippet(text, terms, width=SNIPPET_CHARS):
+    # Up to width chars around the first occurrence of any query term.
+    text = " ".join((text or "").split())
+    if len(text) <= width:
+        return text
+    lower = text.lower()
+    found = [i for i in (lower.find(t) for t in terms) if i >= 0]
+    pos = min(found) if found else 0
+    start = max(0, min(pos - width // 3, len(text) - width))
+    out = text[start:start + width].strip()
+    if start > 0:
+        out = "…" + out
+    if start + width < len(text):
+        out = out + "…"
+    return out
+
+
+class SearchIndex:
+    def __init__(self, list_chats, load_messages):
+        # list_chats() returns chat ids; load_messages(chat_id) a chat's messages.
+        self.list_chats = list_chats
+        self.load_messages = load_messages
+        self._lock = threading.Lock()
+        self._built = threading.Event()
+        self._building = False
+        self._pending = []
+        # doc -> (chat_id, seq, role, content); _lengths[doc] is its term count
+        self._docs = []
+        self._lengths = []
+        self._doc_ids = {}
+        self._postings = {}
+        self._total_len = 0
+        self.build_sec = None
+        self.queries = 0
+
+    def start(self):
+        with self._lock:
+            if self._building or self._built.is_set():
+                return
+            self._building = True
+        threading.Thread(target=self._build, daemon=True).start()
+
+    def _build(self):
+        t0 = time.perf_counter()
+        chats = 0
+        for chat_id in self.list_chats():
+            try:
+                messages = self.load_messages(chat_id)
+            except Exception as e:
+                print(f"[Search] skip {chat_id}: {e}")
+                continue
+            counted = [(seq, Counter(tokenize(m.get("content") or ""))) for seq, m in enumerate(messages)]
+            with self._lock:
+                for (seq, counts), m in zip(counted, messages):
+                    self._add(chat_id, seq, m, counts)
+            chats += 1
+        with self._lock:
+            for chat_id, start, messages in self._pending:
+                for i, m in enumerate(messages):
+                    self._add(chat_id, start + i, m, Counter(tokenize(m.get("content") or "")))
+            self._pending = []
+            self._building = False
+            self.build_sec = time.perf_counter() - t0
+            self._built.set()
+            docs = len(self._docs)
+        print(f"[Search] indexed {docs} messages from {chats} chats in {self.build_sec:.2f}s")
+
+    def _add(self, chat_id, seq, m, counts):
+        # Caller holds self._lock. A message seen both by the build and by
+        # on_append is indexed once.
+        key = (chat_id, seq)
+        if not counts or key in self._doc_ids:
+            return
+        doc = len(self._docs)
+        length = sum(counts.values())
+        self._doc_ids[key] = doc
+        self._docs.append((chat_id, seq, m.get("role"), m.get("content") or ""))
+        self._lengths.append(length)
+        self._total_len += length
+        for term, tf in counts.items():
+            postings = self._postings.get(term)
+            if postings is None:
+                self._postings[term] = {doc: tf}
+            else:
+                postings[doc] = tf
+
+    def on_append(self, chat_id, start, messages):
+        # start is the seq of messages[0], as returned by ChatStore.append.
+        counted = [Counter(tokenize(m.get("content") or "")) for m in messages]
+        with self._lock:
+            if self._building:
+                self._pending.append((chat_id, start, messages))
+            elif self._built.is_set():
+                for i, (m, counts) in enumerate(zip(messages, counted)):
+                    self._add(chat_id, start + i, m, counts)
+            # Not built yet: the build reads the message from disk.
+
+    def search(self, query, limit=DEFAULT_LIMIT, chat_id=None):
+        t0 = time.perf_counter()
+        self.start()
+        self._built.wait(BUILD_WAIT_SEC)
+        terms = list(dict.fromkeys(tokenize(query or "")))
+        limit = max(1, min(int(limit), MAX_LIMIT))
+        with self._lock:
+            self.queries += 1
+            ranked, total = self._rank(terms, limit, chat_id)
+            hits = [(self._docs[doc], score) for score, doc in ranked]
+        out = [
+            {"chat_id": cid, "seq": seq, "role": role, "score": round(score, 4), "snippet": snippet(content, terms)}
+            for (cid, seq, role, content), score in hits
+        ]
+        return {
+            "query": query,
+            "terms": terms,
+            "total": total,
+            "hits": out,
+            "ready": self._built.is_set(),
+            "took_ms": round((time.perf_counter() - t0) * 1000, 3),
+        }
+
+    def _rank(self, terms, limit, chat_id):
+        # Caller holds self._lock. Returns ([(score, doc)], number of matches).
+        n = len(self._docs)
+        if not n:
+            return [], 0
+        lengths = self._lengths
+        k = BM25_K1 * (1 - BM25_B)
+        kb = BM25_K1 * BM25_B * n / self._total_len
+        scores = None
+        for term in terms:
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            df = len(postings)
+            w = math.log(1 + (n - df + 0.5) / (df + 0.5)) * (BM25_K1 + 1)
+            part = {doc: w * tf / (tf + k + kb * lengths[doc]) for doc, tf in postings.items()}
+            if scores is None:
+                scores = part
+                continue
+            if len(part) > len(scores):
+                scores, part = part, scores
+            get = scores.get
+            for doc, s in part.items():
+                scores[doc] = get(doc, 0.0) + s
+        if not scores:
+            return [], 0
+        if chat_id:
+            docs = self._docs
+            scores = {doc: s for doc, s in scores.items() if docs[doc][0] == chat_id}
+        top = heapq.nlargest(limit, scores, key=scores.get)
+        return [(scores[doc], doc) for doc in top], len(scores)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "ready": self._built.is_set(),
+                "messages": len(self._docs),
+                "terms": len(self._postings),
+                "build_sec": round(self.build_sec, 3) if self.build_sec is not None else None,
+                "queries": self.queries,
+            }
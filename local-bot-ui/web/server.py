@@ -1,28 +1,58 @@
 #!/usr/bin/env python3
 import json
+import math
 import os
-import re
 import sys
 import threading
 import subprocess
 import time
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer, ThreadingHTTPServer
 from urllib.parse import urlparse, parse_qs
-import urllib.request
 import urllib.error
 
+import chat_store
+import compress
+import events
+import gen_cache
+import inbox
+import metrics
+import outbox
+import scheduler
+import search
+from model_catalog import ModelCatalog
+from context import ContextWindow
+from graph import GraphEngine, count_graph, to_json_graph, top_k
+from ollama_client import OllamaClient
+from storage import COMMITTER, JsonCache, load_json, save_json
+
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DATA_DIR = os.path.join(BASE_DIR, "data")
+DATA_DIR = os.environ.get("LOCAL_BOT_DATA_DIR") or os.path.join(BASE_DIR, "data")
 CHATS_DIR = os.path.join(DATA_DIR, "chats")
+SESSION_GRAPHS_DIR = os.path.join(CHATS_DIR, ".graphs")
 GLOBAL_GRAPH_PATH = os.path.join(DATA_DIR, "global_graph.json")
 CONFIG_PATH = os.path.join(DATA_DIR, "config.json")
 BRIDGE_INBOX_PATH = os.path.join(DATA_DIR, "bridge_inbox.json")
+BRIDGE_INBOX_DIR = os.path.join(DATA_DIR, "bridge_inbox")
 BRIDGE_OUTBOX_PATH = os.path.join(DATA_DIR, "bridge_outbox.json")
+BRIDGE_OUTBOX_DB_PATH = os.path.join(DATA_DIR, "bridge_outbox.db")
+CHAT_INDEX_PATH = os.path.join(DATA_DIR, "chat_index.json")
+MODELS_CACHE_PATH = os.path.join(DATA_DIR, "models_cache.json")
+GEN_CACHE_DIR = os.path.join(DATA_DIR, "gen_cache")
+CHAT_STORE = chat_store.ChatStore(CHATS_DIR)
+CHAT_INDEX = chat_store.ChatIndex(CHAT_INDEX_PATH, CHAT_STORE)
+# config.json: cached in memory, writes batched.
+STATE_FILES = JsonCache()
 SERVER_STARTED_AT = time.time()
 SERVER_REF = {"server": None}
 
-OLLAMA_TAGS_URL = "http://127.0.0.1:11434/api/tags"
-OLLAMA_GEN_URL = "http://127.0.0.1:11434/api/generate"
+OLLAMA_URL = (os.environ.get("OLLAMA_URL") or "http://127.0.0.1:11434").rstrip("/")
+# Pooled keep-alive client with retries and a circuit breaker.
+OLLAMA = OllamaClient(OLLAMA_URL)
+# /api/tags, cached with stale-while-revalidate; a changed list is pushed as a
+# "models" event.
+MODELS = ModelCatalog(lambda: OLLAMA.tags(timeout=5), MODELS_CACHE_PATH,
+                      on_change=lambda: EVENTS.publish("models"))
 DEFAULT_MODEL = "llama3.1:8b"
 DEFAULT_SOURCES = [
     "Local (Ollama)",
@@ -40,47 +70,79 @@ MAX_GLOBAL_EDGES = 240
 MAX_SESSION_NODES = 80
 MAX_SESSION_EDGES = 160
 
-STOPWORDS = set([
-    "и","в","во","не","что","он","на","я","с","со","как","а","то","все","она",
-    "так","его","но","да","ты","к","у","же","вы","за","бы","по","только","ее",
-    "мне","было","вот","от","меня","еще","нет","о","из","ему","теперь","когда",
-    "даже","ну","вдруг","ли","если","уже","или","ни","быть","был","него","до",
-    "вас","нибудь","опять","уж","вам","ведь","там","потом","себя","ничего","ей",
-    "может","они","тут","где","есть","надо","ней","для","мы","тебя","их","чем",
-    "была","сам","чтоб","без","будто","чего","раз","тоже","себе","под","будет",
-    "ж","тогда","кто","этот","того","потому","этого","какой","совсем","ним","здесь",
-    "этом","один","почти","мой","тем","чтобы","нее","сейчас","были","куда","зачем",
-    "сказать","всех","никогда","сегодня","можно","при","наконец","два","об","другой",
-    "хоть","после","над","больше","тот","через","эти","нас","про","всего","них","какая",
-    "много","разве","три","эту","моя","впрочем","хорошо","свою","этой","перед","иногда",
-    "лучше","чуть","том","нельзя","такой","им","более","всегда","конечно","всю","между",
-    "and","the","to","of","in","is","it","for","on","with","as","that","this",
-    "are","be","or","an","by","from","at","was","were","but","not","we","you","your",
-    "i","me","my","they","them","their","our","us","so","if","then","than","about"
-])
-
+# Worker threads serving requests; 0 falls back to the single-threaded HTTPServer.
+SERVER_WORKERS = int(os.environ.get("LOCAL_BOT_WORKERS", "16"))
+# Endpoints that may block for long (Ollama calls) get their own concurrency cap,
+# so they can never occupy every worker and starve status/outbox polling.
+# Ollama generations themselves (/api/chat/send, /api/generate) are admitted by
+# SCHEDULER, which make_server() fits into the workers left after long-poll
+# waiters and RESERVED_WORKERS, however many models are in use.
+ENDPOINT_LIMITS = {
+    "/api/models/refresh": 2,
+    "/api/bridge/ingest": 4,
+    "/api/bridge/ingest/batch": 2,
+}
+ENDPOINT_WAIT_SEC = 1.0
+RESERVED_WORKERS = 2
+MAX_INGEST_BATCH = 500
+ENDPOINT_SLOTS = {path: threading.BoundedSemaphore(n) for path, n in ENDPOINT_LIMITS.items()}
+# Per-model generation slots and a bounded priority queue (UI before bridge).
+SCHEDULER = scheduler.Scheduler()
+# Finished generations by (model, prompt, options); off unless enabled in config.
+GEN_CACHE = gen_cache.GenCache(GEN_CACHE_DIR)
+# Chat history for /api/chat/send prompts, bounded by LOCAL_BOT_CONTEXT_TOKENS.
+CONTEXT = ContextWindow()
+# Long-poll (?wait= / "wait") and /api/events hold a worker while idle; at most
+# half of the pool may do so (SERVER_REF["waiters"]), extra waits return at once.
+LONG_POLL_MAX_SEC = 25.0
+# Longest lease /api/bridge/outbox/claim accepts for "visibility".
+MAX_VISIBILITY_SEC = 3600.0
+EVENTS_KEEPALIVE_SEC = 15.0
+EVENTS = events.EventHub()
+# Guards load -> modify -> save of config and lazy setup. Chats have their own
+# per-chat locks (CHAT_STORE.locks), so sends to different chats run in parallel.
+STATE_LOCK = threading.RLock()
+# Every request with "X-Trace: 1" gets a Server-Timing header (queue, ollama,
+# disk, graph, total); LOCAL_BOT_TRACE=1 traces all requests and logs them.
+TRACE_ALL = os.environ.get("LOCAL_BOT_TRACE", "0") == "1"
 
 def ensure_dirs():
     os.makedirs(CHATS_DIR, exist_ok=True)
 
 
-def load_json(path, default):
-    if not os.path.exists(path):
-        return default
-    try:
-        with open(path, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except Exception:
-        return default
+def new_chat_id():
+    return time.strftime("%Y%m%d-%H%M%S")
 
 
-def save_json(path, data):
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+class BadRequest(ValueError):
+    # Malformed request parameter; the handlers answer 400 with the message.
+    pass
 
 
-def new_chat_id():
-    return time.strftime("%Y%m%d-%H%M%S")
+def number_param(value, name, default, cast=int, lo=None, hi=None):
+    # A query string or payload value as int/float: default when missing,
+    # BadRequest when malformed or outside [lo, hi].
+    if value is None or value == "":
+        return default
+    try:
+        number = cast(value)
+    except (TypeError, ValueError, OverflowError):
+        raise BadRequest(f"invalid {name}: {value!r}")
+    if isinstance(number, float) and not math.isfinite(number):
+        raise BadRequest(f"invalid {name}: {value!r}")
+    if (lo is not None and number < lo) or (hi is not None and number > hi):
+        raise BadRequest(f"{name} out of range: {value!r}")
+    return number
+
+
+def text_param(value, name, default=""):
+    # A payload string, stripped: default when missing, BadRequest when it is
+    # not a string (a number would become a chat id of another type).
+    if value is None:
+        return default
+    if not isinstance(value, str):
+        raise BadRequest(f"invalid {name}: {value!r}")
+    return value.strip()
 
 
 def list_chats():
@@ -89,142 +151,71 @@ def list_chats():
     return [f.replace(".json", "") for f in files]
 
 
-def parse_source_from_assistant(text):
-    if text.startswith("[") and "]" in text[:40]:
-        return text[1:text.index("]")]
-    return "Local"
-
-
-def chat_preview(chat):
-    messages = chat.get("messages", [])
-    text = ""
-    for m in messages:
-        if m.get("role") == "user":
-            text = m.get("content", "")
-            break
-    if not text and messages:
-        text = messages[0].get("content", "")
-    text = (text or "").replace("\n", " ").strip()
-    if not text:
-        return ""
-    parts = re.split(r'(?<=[.!?])\s+', text)
-    preview = " ".join(parts[:2]).strip()
-    if len(preview) > 200:
-        preview = preview[:200].rstrip() + "…"
-    return preview
-
-
-def chat_title(chat):
-    preview = chat_preview(chat)
-    if preview:
-        words = preview.split()
-        title = " ".join(words[:6]).strip()
-        return title if title else "Новый чат"
-    return chat.get("title") or "Новый чат"
-
-
-def chat_sources(chat):
-    sources = set()
-    for m in chat.get("messages", []):
-        if m.get("role") == "assistant":
-            sources.add(parse_source_from_assistant(m.get("content", "")))
-    return sorted(sources)
-
-
-def list_chat_infos():
-    infos = []
-    for chat_id in list_chats():
-        p = os.path.join(CHATS_DIR, f"{chat_id}.json")
-        chat = load_json(p, {"id": chat_id, "title": "Новый чат", "messages": []})
-        try:
-            updated_ts = os.path.getmtime(p)
-        except Exception:
-            updated_ts = 0
-        infos.append({
-            "id": chat_id,
-            "title": chat_title(chat),
-            "preview": chat_preview(chat),
-            "sources": chat_sources(chat),
-            "updated_ts": updated_ts,
-            "message_count": len(chat.get("messages", []))
-        })
-    return infos
-
-
-def fetch_models_from_ollama():
-    try:
-        req = urllib.request.Request(OLLAMA_TAGS_URL, method="GET")
-        with urllib.request.urlopen(req, timeout=5) as res:
-            data = json.loads(res.read().decode("utf-8"))
-        models = [m.get("name") for m in data.get("models", []) if m.get("name")]
-        return sorted(models)
-    except Exception:
-        return []
-
+def list_chat_infos(offset=0, limit=None, since=None):
+    return CHAT_INDEX.list(offset=offset, limit=limit, since=since)
+
+
+def models_payload(catalog):
+    # Ollama models first, then manually added ones; details only for the former.
+    config = STATE_FILES.load(CONFIG_PATH, {"manual_models": [DEFAULT_MODEL], "last_model": DEFAULT_MODEL})
+    auto = [m["name"] for m in catalog["models"]]
+    models = []
+    for m in auto + config.get("manual_models", []):
+        if m and m not in models:
+            models.append(m)
+    if not models:
+        models = [DEFAULT_MODEL]
+    return {
+        "models": models,
+        "last": config.get("last_model", models[0]),
+        "details": {m["name"]: m for m in catalog["models"]},
+        "catalog": {k: catalog[k] for k in ("fetched_at", "stale", "refreshing", "error")},
+    }
+
+
+def gen_cache_for(payload):
+    # GEN_CACHE if "gen_cache" is enabled in config.json and the request did
+    # not opt out with "cache": false; None otherwise.
+    GEN_CACHE.settings = gen_cache.settings_from_config(STATE_FILES.load(CONFIG_PATH, {}))
+    if GEN_CACHE.settings["enabled"] and payload.get("cache", True) is not False:
+        return GEN_CACHE
+    return None
+
+
+def call_ollama(model, prompt, priority=scheduler.PRIORITY_UI, options=None, cache=None, context=None, final=None):
+    # A cache hit needs no scheduler slot (and leaves final empty).
+    if cache is not None:
+        hit = cache.get(model, prompt, options)
+        if hit is not None:
+            return hit
+    with SCHEDULER.slot(model, priority):
+        response = OLLAMA.generate(model, prompt, options, context=context, final=final)
+    if cache is not None:
+        cache.put(model, prompt, response, options)
+    return response
+
+
+def call_ollama_stream(model, prompt, options=None, context=None, final=None):
+    # Yields response pieces as Ollama emits them. The caller holds a
+    # SCHEDULER slot for the whole stream.
+    return OLLAMA.generate_stream(model, prompt, options, context=context, final=final)
+
+
+def chat_turn(chat_id, model, text, history=True):
+    # (prompt, ollama context, report) for one /api/chat/send turn. With
+    # history off only the text is sent, as before.
+    if not history:
+        return text, None, None
+    # Only the messages the turn needs are read, not the whole chat.
+    return CONTEXT.build(chat_id, model, CHAT_STORE.count(chat_id), text,
+                         lambda seq: CHAT_STORE.since(chat_id, seq))
 
-def call_ollama(model, prompt):
-    payload = json.dumps({"model": model, "prompt": prompt, "stream": False}).encode("utf-8")
-    req = urllib.request.Request(OLLAMA_GEN_URL, data=payload, headers={"Content-Type": "application/json"}, method="POST")
-    with urllib.request.urlopen(req, timeout=120) as res:
-        data = json.loads(res.read().decode("utf-8"))
-    return data.get("response", "")
-
-
-def tokenize(text):
-    out = []
-    for raw in text.lower().replace("\n", " ").split(" "):
-        t = "".join(ch for ch in raw if ch.isalnum() or ch in ("-", "_"))
-        if len(t) < 3:
-            continue
-        if t in STOPWORDS:
-            continue
-        out.append(t)
-    return out
-
-
-def build_graph_from_texts(texts):
-    nodes = {}
-    edges = {}
-    for text in texts:
-        tokens = tokenize(text)
-        unique = list(dict.fromkeys(tokens))
-        for t in unique:
-            nodes[t] = nodes.get(t, 0) + 1
-        for i in range(len(unique)):
-            for j in range(i + 1, len(unique)):
-                a, b = unique[i], unique[j]
-                key = "|".join(sorted([a, b]))
-                edges[key] = edges.get(key, 0) + 1
-    return {"nodes": nodes, "edges": edges}
-
-
-def merge_graph(g1, g2):
-    nodes = dict(g1.get("nodes", {}))
-    edges = dict(g1.get("edges", {}))
-    for k, v in g2.get("nodes", {}).items():
-        nodes[k] = nodes.get(k, 0) + v
-    for k, v in g2.get("edges", {}).items():
-        edges[k] = edges.get(k, 0) + v
-    return {"nodes": nodes, "edges": edges}
-
-def compact_graph(graph, max_nodes, max_edges):
-    nodes = dict(graph.get("nodes", {}))
-    edges = dict(graph.get("edges", {}))
-    if max_nodes and len(nodes) > max_nodes:
-        top = sorted(nodes.items(), key=lambda kv: kv[1], reverse=True)[:max_nodes]
-        keep = {k for k, _ in top}
-        nodes = {k: v for k, v in nodes.items() if k in keep}
-        edges = {k: v for k, v in edges.items() if all(part in keep for part in k.split("|"))}
-    if max_edges and len(edges) > max_edges:
-        edges = dict(sorted(edges.items(), key=lambda kv: kv[1], reverse=True)[:max_edges])
-    return {"nodes": nodes, "edges": edges}
 
 def rebuild_global_graph_from_chats(max_chats=60, max_chars=200000):
     texts = []
     total = 0
     for chat_id in list_chats()[:max_chats]:
-        chat_path = os.path.join(CHATS_DIR, f"{chat_id}.json")
-        chat = load_json(chat_path, {"messages": []})
+        chat = CHAT_STORE.load(chat_id, {"messages": []})
         for m in chat.get("messages", []):
             t = (m.get("content") or "").strip()
             if not t:
@@ -235,8 +226,7 @@ def rebuild_global_graph_from_chats(max_chats=60, max_chars=200000):
                 break
         if total >= max_chars:
             break
-    graph = build_graph_from_texts(texts)
-    return compact_graph(graph, MAX_GLOBAL_NODES, MAX_GLOBAL_EDGES)
+    return to_json_graph(top_k(count_graph(texts), MAX_GLOBAL_NODES, MAX_GLOBAL_EDGES))
 
 def load_global_graph():
     if not os.path.exists(GLOBAL_GRAPH_PATH):
@@ -244,36 +234,613 @@ def load_global_graph():
     try:
         if os.path.getsize(GLOBAL_GRAPH_PATH) > MAX_GRAPH_FILE_BYTES:
             graph = rebuild_global_graph_from_chats()
-            save_json(GLOBAL_GRAPH_PATH, graph)
+            save_json(GLOBAL_GRAPH_PATH, graph, compact=True)
             return graph
     except Exception:
         return {"nodes": {}, "edges": {}}
     return load_json(GLOBAL_GRAPH_PATH, {"nodes": {}, "edges": {}})
 
 
+GRAPH = GraphEngine(GLOBAL_GRAPH_PATH, load_global_graph, SESSION_GRAPHS_DIR)
+STATIC_FILES = compress.StaticFiles(BASE_DIR)
+SEARCH = search.SearchIndex(list_chats, lambda chat_id: CHAT_STORE.load(chat_id, chat_store.new_chat(chat_id))["messages"])
+
+
+def chat_texts(chat):
+    return [m.get("content", "") for m in chat.get("messages", [])]
+
+
+def graph_version():
+    # The start time keeps versions handed out by an earlier run from matching.
+    return f"{GRAPH.global_version}.{int(SERVER_STARTED_AT * 1000)}"
+
+
+def chat_version(count, gv=None):
+    # Chats are append-only, so the message count plus the global graph
+    # version identify everything /api/chat/<id> returns. Take gv before
+    # reading the graphs: a change in between then shows up as a new version.
+    return f"{count}.{gv or graph_version()}"
+
+
+def chat_etag(version):
+    return f'"{version}"'
+
+
+def chat_graphs(chat_id, chat, count=None):
+    # Without "messages" in chat (slim replies), the texts are only loaded if
+    # the session graph has to be rebuilt.
+    if "messages" in chat:
+        load_texts = lambda: chat_texts(chat)
+        count = len(chat["messages"])
+    else:
+        load_texts = lambda: chat_texts(CHAT_STORE.load(chat_id, chat_store.new_chat(chat_id)))
+    session_graph = GRAPH.session(chat_id, load_texts, MAX_SESSION_NODES, MAX_SESSION_EDGES, count=count)
+    global_graph = GRAPH.global_graph(MAX_GLOBAL_NODES, MAX_GLOBAL_EDGES)
+    return session_graph, global_graph
+
+
+_outbox = None
+
+
+def get_outbox():
+    # Opened lazily so the data dir exists; imports a leftover bridge_outbox.json.
+    global _outbox
+    with STATE_LOCK:
+        if _outbox is None:
+            _outbox = outbox.Outbox(BRIDGE_OUTBOX_DB_PATH)
+            if os.path.exists(BRIDGE_OUTBOX_PATH):
+                _outbox.import_json(BRIDGE_OUTBOX_PATH)
+        return _outbox
+
+
+_inbox = None
+
+
+def get_inbox():
+    global _inbox
+    with STATE_LOCK:
+        if _inbox is None:
+            _inbox = inbox.Inbox(BRIDGE_INBOX_DIR)
+            if os.path.exists(BRIDGE_INBOX_PATH):
+                _inbox.import_json(BRIDGE_INBOX_PATH, inbox_retention())
+        return _inbox
+
+
+def inbox_retention():
+    return inbox.retention_from_config(STATE_FILES.load(CONFIG_PATH, {}))
+
+
+def outbox_changed(source):
+    EVENTS.publish("outbox", {"source": source, "count": get_outbox().count()})
+
+
+def outbox_event_for(source):
+    return lambda kind, data: kind == "outbox" and (not source or data.get("source") == source)
+
+
+def acquire_waiter(wait):
+    # Returns (wait, release); wait drops to 0 when no waiter slot is free.
+    waiters = SERVER_REF.get("waiters")
+    if wait <= 0 or waiters is None or not waiters.acquire(blocking=False):
+        return 0, lambda: None
+    return min(wait, LONG_POLL_MAX_SEC), waiters.release
+
+
+def claim_outbox(source, visibility, wait):
+    wait, release = acquire_waiter(wait)
+    try:
+        deadline = time.monotonic() + wait
+        while True:
+            seen = EVENTS.seq
+            item = get_outbox().claim(source, visibility)
+            remaining = deadline - time.monotonic()
+            if item is not None or remaining <= 0:
+                return item
+            # Expired leases do not publish; the final claim picks them up.
+            if not EVENTS.wait(seen, remaining, outbox_event_for(source)):
+                return get_outbox().claim(source, visibility)
+    finally:
+        release()
+
+
+def outbox_count(source, known, wait):
+    # With known set, waits until the count differs from it.
+    wait, release = acquire_waiter(wait if known is not None else 0)
+    try:
+        deadline = time.monotonic() + wait
+        while True:
+            seen = EVENTS.seq
+            count = get_outbox().count(source)
+            remaining = deadline - time.monotonic()
+            if count != known or remaining <= 0:
+                return count
+            if not EVENTS.wait(seen, remaining, outbox_event_for(source)):
+                return get_outbox().count(source)
+    finally:
+        release()
+
+
+def server_status():
+    return {
+        "ok": True,
+        "started_at": SERVER_STARTED_AT,
+        "pid": os.getpid(),
+        "uptime_sec": max(0, time.time() - SERVER_STARTED_AT),
+        "chat_locks": CHAT_STORE.locks.stats(),
+        "ollama": OLLAMA.stats(),
+        "models": MODELS.stats(),
+        "generations": SCHEDULER.stats(),
+        "gen_cache": GEN_CACHE.stats(),
+        "context": CONTEXT.stats(),
+        "search": SEARCH.stats(),
+    }
+
+
+def route_label(method, path, code):
+    # Bounded label set for metrics: chat ids and unknown paths are folded.
+    if method == "GET" and path.startswith("/api/chat/"):
+        return "/api/chat/<id>"
+    if code == 404:
+        return "other"
+    return path
+
+
+def server_timing(spans, total):
+    parts = [f'{name};desc="{n}";dur={sec * 1000:.2f}' for name, (sec, n) in sorted(spans.items())]
+    parts.append(f"total;dur={total * 1000:.2f}")
+    return ", ".join(parts)
+
+
+def server_metrics():
+    # Gauges and counters other modules already keep, read at scrape time.
+    sched = SCHEDULER.stats()
+    ollama = OLLAMA.stats()
+    chat_locks = CHAT_STORE.locks.stats()
+    cache = GEN_CACHE.stats()
+    index = SEARCH.stats()
+    pool = getattr(SERVER_REF.get("server"), "pool", None)
+    return [
+        ("local_bot_uptime_seconds", "gauge", "Seconds since the server started.",
+         [({}, round(time.time() - SERVER_STARTED_AT, 3))]),
+        ("local_bot_http_pool_queued", "gauge", "Accepted connections waiting for a worker thread.",
+         [({}, pool._work_queue.qsize() if pool is not None else None)]),
+        ("local_bot_gen_running", "gauge", "Generations holding a scheduler slot.",
+         [({"model": model}, n) for model, n in sched["running"].items()]),
+        ("local_bot_gen_queued", "gauge", "Generations waiting for a scheduler slot.",
+         [({"priority": name}, n) for name, n in sched["queued"].items()]),
+        ("local_bot_gen_refused_total", "counter", "Generations answered with 429.",
+         [({"reason": "rejected"}, sched["rejected"]), ({"reason": "timeout"}, sched["timeouts"])]),
+        ("local_bot_gen_cache_lookups_total", "counter", "Generation cache lookups by result.",
+         [({"result": "memory"}, cache["hits_memory"]), ({"result": "disk"}, cache["hits_disk"]), ({"result": "miss"}, cache["misses"])]),
+        ("local_bot_ollama_requests_total", "counter", "HTTP requests sent to Ollama.", [({}, ollama["requests"])]),
+        ("local_bot_ollama_failures_total", "counter", "Ollama calls that failed to connect or were refused by the open breaker.",
+         [({"reason": "error"}, ollama["errors"]), ({"reason": "breaker"}, ollama["rejected"])]),
+        ("local_bot_ollama_breaker_open", "gauge", "1 while the Ollama circuit breaker is open or half-open.",
+         [({}, int(ollama["state"] != "closed"))]),
+        ("local_bot_outbox_items", "gauge", "Items in the bridge outbox.", [({}, get_outbox().count())]),
+        ("local_bot_chat_lock_contended_total", "counter", "Chat lock acquisitions that had to wait.",
+         [({}, chat_locks["contended"])]),
+        ("local_bot_chat_lock_wait_seconds_total", "counter", "Total time spent waiting for chat locks.",
+         [({}, chat_locks["wait_total_ms"] / 1000)]),
+        ("local_bot_fsyncs_total", "counter", "fsync calls made by the group commit.", [({}, COMMITTER.fsyncs)]),
+        ("local_bot_search_messages", "gauge", "Messages in the search index.", [({}, index["messages"])]),
+        ("local_bot_search_build_seconds", "gauge", "Duration of the search index build.", [({}, index["build_sec"])]),
+        ("local_bot_graph_version", "gauge", "Changes to the global graph since start.", [({}, GRAPH.global_version)]),
+    ]
+
+
+metrics.collector(server_metrics)
+
+
+def flush_state():
+    # Index, graph and state file writes are debounced; persist them before exiting.
+    STATE_FILES.flush()
+    CHAT_INDEX.flush()
+    GRAPH.flush()
+
+
+def store_chat_messages(chat_id, messages, graph_appends=None):
+    # Caller holds the chat lock. Returns the seq of messages[0]. With a
+    # graph_appends list the graph update is added to it instead, for the
+    # caller's single GRAPH.add_batch().
+    start = CHAT_STORE.append(chat_id, messages)
+    CHAT_INDEX.on_append(chat_id, messages)
+    texts = [m.get("content", "") for m in messages]
+    if graph_appends is None:
+        GRAPH.add_messages(chat_id, start, texts)
+    else:
+        graph_appends.append((chat_id, start, texts))
+    SEARCH.on_append(chat_id, start, messages)
+    return start
+
+
+def bridge_default_chat():
+    # Where bridge answers without a chat_id go: the bridge target, else the newest chat.
+    config = STATE_FILES.load(CONFIG_PATH, {"sources": DEFAULT_SOURCES, "last_source": DEFAULT_SOURCES[0], "bridge_target": ""})
+    chat_id = (config.get("bridge_target") or "").strip()
+    if not chat_id:
+        chats = list_chats()
+        if chats:
+            chat_id = chats[0]
+    return chat_id
+
+
+def ingest_batch(items):
+    # Bridge answers grouped by chat: one append (one log write) per chat, one
+    # graph update and one inbox write for the whole batch. Returns one result
+    # per item, in order.
+    results = []
+    groups = {}
+    default_chat = None
+    for i, item in enumerate(items):
+        item = item if isinstance(item, dict) else {}
+        try:
+            chat_id = text_param(item.get("chat_id"), "chat_id")
+            source = text_param(item.get("source"), "source") or "Bridge"
+            text = text_param(item.get("text"), "text")
+        except BadRequest as e:
+            # Only this item is rejected; retrying it would fail the same way.
+            results.append({"ok": False, "error": str(e)})
+            continue
+        if not chat_id:
+            if default_chat is None:
+                default_chat = bridge_default_chat()
+            chat_id = default_chat
+        if not chat_id or not text:
+            results.append({"ok": False, "error": "missing chat_id or text"})
+            continue
+        results.append({"ok": True, "chat_id": chat_id})
+        groups.setdefault(chat_id, []).append((i, source, text))
+    now = time.time()
+    stored = []
+    graph_appends = []
+    for chat_id, entries in groups.items():
+        messages = [{"role": "assistant", "content": f"[{source}] {text}"} for _i, source, text in entries]
+        try:
+            with CHAT_STORE.locks.hold(chat_id):
+                start = store_chat_messages(chat_id, messages, graph_appends)
+        except Exception as e:
+            for i, _source, _text in entries:
+                # Not the item's fault: the sender may retry it.
+                results[i] = {"ok": False, "chat_id": chat_id, "error": str(e), "retry": True}
+            continue
+        for k, (i, source, text) in enumerate(entries):
+            results[i]["seq"] = start + k
+            stored.append((i, {"chat_id": chat_id, "source": source, "text": text, "ts": now}))
+    if graph_appends:
+        # After the chat locks are released; "chat" events go out once the
+        # graph includes the new messages.
+        GRAPH.add_batch(graph_appends)
+    for chat_id, start, texts in graph_appends:
+        EVENTS.publish("chat", {"chat_id": chat_id, "message_count": start + len(texts)})
+    if stored:
+        stored.sort(key=lambda x: x[0])
+        get_inbox().extend([item for _i, item in stored], inbox_retention())
+        EVENTS.publish("inbox", {"last": stored[-1][1]})
+    print(f"[Bridge] ingest batch: {len(stored)}/{len(items)} items in {len(groups)} chats")
+    return results
+
+
+def append_chat_messages(chat_id, messages, slim=False):
+    # The chat lock spans the append and the graph update, so start seqs reach
+    # GRAPH in order; other chats are not blocked. Returns the reply fields:
+    # the whole chat, or with slim only the appended messages ("after" is the
+    # seq of the first one), which skips reloading the chat.
+    with CHAT_STORE.locks.hold(chat_id):
+        start = store_chat_messages(chat_id, messages)
+        chat = None if slim else CHAT_STORE.load(chat_id, chat_store.new_chat(chat_id))
+    count = start + len(messages)
+    EVENTS.publish("chat", {"chat_id": chat_id, "message_count": count})
+    gv = graph_version()
+    if chat is None:
+        chat = {"id": chat_id}
+        reply = {"chat_id": chat_id, "after": start, "messages": messages}
+    else:
+        count = len(chat["messages"])
+        reply = {"chat": chat}
+    session_graph, global_graph = chat_graphs(chat_id, chat, count)
+    reply.update({
+        "message_count": count,
+        "version": chat_version(count, gv),
+        "graph_version": gv,
+        "session_graph": session_graph,
+        "global_graph": global_graph,
+    })
+    return reply
+
+
 class Handler(BaseHTTPRequestHandler):
-    def _send(self, code, body, content_type="application/json"):
+    # Per request, set by _dispatch.
+    _t0 = 0.0
+    _status = None
+    _trace = False
+
+    def send_response(self, code, message=None):
+        self._status = code
+        super().send_response(code, message)
+
+    def _send(self, code, body, content_type="application/json", headers=None, variants=None):
+        # variants: precompressed bodies by encoding (static files).
+        if isinstance(body, (dict, list)):
+            body = compress.json_bytes(body)
+        elif isinstance(body, str):
+            body = body.encode("utf-8")
+        headers = dict(headers or {})
+        if self._trace:
+            headers["Server-Timing"] = server_timing(metrics.trace_spans() or {}, time.perf_counter() - self._t0)
+        encoding = None
+        if len(body) >= compress.COMPRESS_MIN_BYTES:
+            headers["Vary"] = "Accept-Encoding"
+            encoding = compress.negotiate(self.headers.get("Accept-Encoding"))
+            if encoding:
+                body = (variants or {}).get(encoding) or compress.compress(body, encoding)
+                headers["Content-Encoding"] = encoding
         self.send_response(code)
         self.send_header("Content-Type", content_type)
-        self.send_header("Cache-Control", "no-store")
+        self.send_header("Cache-Control", headers.pop("Cache-Control", "no-store"))
         self.send_header("Access-Control-Allow-Origin", "*")
         self.send_header("Access-Control-Allow-Methods", "GET, POST, OPTIONS")
-        self.send_header("Access-Control-Allow-Headers", "Content-Type")
+        self.send_header("Access-Control-Allow-Headers", "Content-Type, X-Trace")
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(body)))
         self.end_headers()
-        if isinstance(body, (dict, list)):
-            body = json.dumps(body).encode("utf-8")
-        elif isinstance(body, str):
-            body = body.encode("utf-8")
         self.wfile.write(body)
 
+    def _send_chat_since(self, chat_id, after, known_graph):
+        # Incremental read: messages from seq `after` on, the session graph
+        # only if there are any, the global graph only if it changed since
+        # the client's graph_version.
+        gv = graph_version()
+        messages = CHAT_STORE.since(chat_id, after)
+        count = after + len(messages)
+        version = chat_version(count, gv)
+        payload = {
+            "id": chat_id,
+            "after": after,
+            "message_count": count,
+            "messages": messages,
+            "version": version,
+            "graph_version": gv,
+        }
+        if messages:
+            payload["session_graph"] = GRAPH.session(
+                chat_id,
+                lambda: chat_texts(CHAT_STORE.load(chat_id, chat_store.new_chat(chat_id))),
+                MAX_SESSION_NODES,
+                MAX_SESSION_EDGES,
+                count=count,
+            )
+        if known_graph != gv:
+            payload["global_graph"] = GRAPH.global_graph(MAX_GLOBAL_NODES, MAX_GLOBAL_EDGES)
+        return self._send(200, payload, headers={"ETag": chat_etag(version)})
+
+    def _send_busy(self, busy):
+        # Generation queue full or wait timed out; nothing was saved.
+        return self._send(429, {"error": "busy", "reason": busy.reason, "queue": busy.depth}, headers={"Retry-After": "5"})
+
+    def _start_event_stream(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream; charset=utf-8")
+        self.send_header("Cache-Control", "no-store")
+        self.send_header("X-Accel-Buffering", "no")
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.end_headers()
+
+    def _send_event(self, event, data, seq=None):
+        body = f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, separators=(',', ':'))}\n\n"
+        if seq is not None:
+            body = f"id: {seq}\n" + body
+        self.wfile.write(body.encode("utf-8"))
+        self.wfile.flush()
+
+    def _stream_events(self, since):
+        # SSE push of outbox/inbox/chat events; "status" doubles as keepalive.
+        waiters = SERVER_REF.get("waiters")
+        if waiters is None or not waiters.acquire(blocking=False):
+            return self._send(429, {"error": "busy"}, headers={"Retry-After": "5"})
+        try:
+            self._start_event_stream()
+            self._send_event("status", server_status(), since)
+            while not EVENTS.closed:
+                found = EVENTS.wait(since, EVENTS_KEEPALIVE_SEC)
+                for seq, kind, data in found:
+                    self._send_event(kind, data, seq)
+                    since = seq
+                if not found:
+                    self._send_event("status", server_status())
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            waiters.release()
+
+    def _write_line(self, data):
+        self.wfile.write((json.dumps(data, ensure_ascii=False) + "\n").encode("utf-8"))
+        self.wfile.flush()
+
+    def _proxy_generate(self, payload):
+        # Ollama's /api/generate behind SCHEDULER and GEN_CACHE, for
+        # bot/bridge.py and app.py: same request body and JSON/NDJSON replies as
+        # Ollama, plus "priority" ("ui" or "bridge", the default) and "cache".
+        model = (payload.get("model") or DEFAULT_MODEL).strip()
+        prompt = payload.get("prompt") or ""
+        options = payload.get("options") or None
+        priority = scheduler.PRIORITIES.get(payload.get("priority"), scheduler.PRIORITY_BRIDGE)
+        context = payload.get("context") or None
+        # A reply that continues an Ollama context is not a function of the prompt.
+        cache = gen_cache_for(payload) if context is None else None
+        final = {}
+        if not payload.get("stream", True):
+            try:
+                response = call_ollama(model, prompt, priority, options, cache, context, final)
+            except scheduler.Busy as e:
+                return self._send_busy(e)
+            except Exception as e:
+                return self._send(502, {"error": str(e)})
+            return self._send(200, dict(final, model=model, response=response, done=True))
+        hit = cache.get(model, prompt, options) if cache is not None else None
+        if hit is None:
+            try:
+                SCHEDULER.acquire(model, priority)
+            except scheduler.Busy as e:
+                return self._send_busy(e)
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Cache-Control", "no-store")
+            self.end_headers()
+            pieces = iter((hit,)) if hit is not None else call_ollama_stream(model, prompt, options, context, final)
+            parts = []
+            try:
+                for piece in pieces:
+                    parts.append(piece)
+                    self._write_line({"model": model, "response": piece, "done": False})
+                if cache is not None and hit is None:
+                    cache.put(model, prompt, "".join(parts), options)
+                self._write_line(dict(final, model=model, response="", done=True))
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            except Exception as e:
+                self._write_line({"error": str(e)})
+            finally:
+                # Client gone: closing the stream stops the Ollama generation.
+                if hit is None:
+                    pieces.close()
+        finally:
+            if hit is None:
+                SCHEDULER.release(model)
+
+    def _stream_chat_reply(self, chat_id, text, model, cache=None, history=True, slim=False):
+        # SSE: one "delta" event per Ollama chunk, then a single "done" event
+        # carrying the same payload as the non-streaming response. The chat is
+        # written once, after the generation finishes (or the client leaves).
+        # A cached reply arrives as a single delta. If Ollama fails after some
+        # deltas, the partial reply is saved with "truncated" and the "done"
+        # event says so.
+        prompt, context, report = chat_turn(chat_id, model, text, history)
+        if context is not None:
+            # Depends on Ollama's state, not only on the prompt.
+            cache = None
+        final = {}
+        hit = cache.get(model, prompt) if cache is not None else None
+        if hit is None:
+            try:
+                SCHEDULER.acquire(model, scheduler.PRIORITY_UI)
+            except scheduler.Busy as e:
+                return self._send_busy(e)
+        parts = []
+        client_gone = False
+        error = None
+        try:
+            self._start_event_stream()
+            for piece in (hit,) if hit is not None else call_ollama_stream(model, prompt, context=context, final=final):
+                parts.append(piece)
+                try:
+                    self._send_event("delta", {"text": piece})
+                except (BrokenPipeError, ConnectionResetError):
+                    client_gone = True
+                    break
+            response = "".join(parts)
+            if cache is not None and hit is None and not client_gone:
+                cache.put(model, prompt, response)
+        except urllib.error.URLError as e:
+            error = f"Ошибка подключения к Ollama: {e}"
+        except Exception as e:
+            error = f"Ошибка: {e}"
+        finally:
+            if hit is None:
+                SCHEDULER.release(model)
+        assistant = {"role": "assistant"}
+        if error is not None:
+            response = "".join(parts)
+            if response:
+                # Ollama failed mid-reply: the partial text is kept, marked as
+                # cut off, and "done" carries the error.
+                response += f"\n\n[Ответ прерван. {error}]"
+                assistant["truncated"] = True
+            else:
+                response = error
+        assistant["content"] = response
+
+        # The 200 status line is already out: from here on a failure is
+        # reported as an "error" event, never through _send().
+        try:
+            reply = append_chat_messages(chat_id, [
+                {"role": "user", "content": text},
+                assistant,
+            ], slim)
+            if history:
+                CONTEXT.commit(chat_id, model, reply["message_count"], final.get("context"))
+        except Exception as e:
+            print(f"[Chat] saving streamed reply to {chat_id} failed: {e}")
+            if not client_gone:
+                self._send_stream_error(f"Ошибка сохранения: {e}")
+            return
+        if client_gone:
+            return
+        try:
+            done = {"response": response, **reply, "context_stats": report}
+            if assistant.get("truncated"):
+                done.update(truncated=True, error=error)
+            self._send_event("done", done)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        except Exception as e:
+            self._send_stream_error(f"Ошибка: {e}")
+
+    def _send_stream_error(self, message):
+        # Last frame of a failed SSE reply; the connection is not reused.
+        self.close_connection = True
+        try:
+            self._send_event("error", {"error": message})
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
     def do_OPTIONS(self):
         self.send_response(204)
         self.send_header("Access-Control-Allow-Origin", "*")
         self.send_header("Access-Control-Allow-Methods", "GET, POST, OPTIONS")
-        self.send_header("Access-Control-Allow-Headers", "Content-Type")
+        self.send_header("Access-Control-Allow-Headers", "Content-Type, X-Trace")
         self.end_headers()
 
+    def _dispatch(self, handler):
+        path = urlparse(self.path).path
+        self._t0 = time.perf_counter()
+        self._status = None
+        self._trace = TRACE_ALL or self.headers.get("X-Trace") == "1"
+        if self._trace:
+            metrics.trace_start()
+        try:
+            slot = ENDPOINT_SLOTS.get(path)
+            if slot is not None and not slot.acquire(timeout=ENDPOINT_WAIT_SEC):
+                return self._send(429, {"error": "busy", "path": path}, headers={"Retry-After": "1"})
+            try:
+                return handler()
+            finally:
+                if slot is not None:
+                    slot.release()
+        finally:
+            self._record(path)
+
+    def _record(self, path):
+        elapsed = time.perf_counter() - self._t0
+        route = route_label(self.command, path, self._status)
+        metrics.inc("local_bot_http_requests_total", method=self.command, route=route, code=str(self._status or 0))
+        metrics.observe("local_bot_http_request_seconds", elapsed, method=self.command, route=route)
+        if self._trace:
+            spans = metrics.trace_stop()
+            self._trace = False
+            if TRACE_ALL:
+                parts = " ".join(f"{name}={sec * 1000:.1f}ms/{n}" for name, (sec, n) in sorted(spans.items()))
+                print(f"[Trace] {self.command} {path} {self._status} {elapsed * 1000:.1f}ms {parts}".rstrip())
+
     def do_GET(self):
+        return self._dispatch(self._handle_get)
+
+    def do_POST(self):
+        return self._dispatch(self._handle_post)
+
+    def _handle_get(self):
         try:
             parsed = urlparse(self.path)
             path = parsed.path
@@ -286,73 +853,91 @@ class Handler(BaseHTTPRequestHandler):
             if path == "/styles.css":
                 return self._send_file("styles.css", "text/css")
             if path == "/api/models":
-                config = load_json(CONFIG_PATH, {"manual_models": [DEFAULT_MODEL], "last_model": DEFAULT_MODEL})
-                auto = fetch_models_from_ollama()
-                manual = config.get("manual_models", [])
-                models = []
-                for m in auto + manual:
-                    if m and m not in models:
-                        models.append(m)
-                if not models:
-                    models = [DEFAULT_MODEL]
-                return self._send(200, {"models": models, "last": config.get("last_model", models[0])})
+                return self._send(200, models_payload(MODELS.get()))
             if path == "/api/sources":
-                config = load_json(CONFIG_PATH, {"sources": DEFAULT_SOURCES, "last_source": DEFAULT_SOURCES[0], "bridge_target": ""})
+                config = STATE_FILES.load(CONFIG_PATH, {"sources": DEFAULT_SOURCES, "last_source": DEFAULT_SOURCES[0], "bridge_target": ""})
                 sources = config.get("sources") or DEFAULT_SOURCES
                 last = config.get("last_source") or sources[0]
                 return self._send(200, {"sources": sources, "last": last})
             if path == "/api/bridge/target":
-                config = load_json(CONFIG_PATH, {"sources": DEFAULT_SOURCES, "last_source": DEFAULT_SOURCES[0], "bridge_target": ""})
+                config = STATE_FILES.load(CONFIG_PATH, {"sources": DEFAULT_SOURCES, "last_source": DEFAULT_SOURCES[0], "bridge_target": ""})
                 return self._send(200, {"bridge_target": config.get("bridge_target", "")})
             if path == "/api/bridge/outbox/next":
+                # Legacy dequeue: claim + ack at once (at-most-once delivery).
                 source = (query.get("source", [""])[0] or "").strip()
-                outbox = load_json(BRIDGE_OUTBOX_PATH, [])
-                if not outbox:
+                item = get_outbox().take(source)
+                if item is None:
                     return self._send(200, {"item": None})
-                idx = None
-                for i, item in enumerate(outbox):
-                    if not source or item.get("source") == source:
-                        idx = i
-                        break
-                if idx is None:
-                    return self._send(200, {"item": None})
-                item = outbox.pop(idx)
-                save_json(BRIDGE_OUTBOX_PATH, outbox)
-                print(f"[Outbox] dequeue: source={item.get('source')} remaining={len(outbox)}")
+                outbox_changed(item["source"])
+                print(f"[Outbox] dequeue: source={item.get('source')} id={item['id']}")
                 return self._send(200, {"item": item})
             if path == "/api/bridge/outbox/count":
-                outbox = load_json(BRIDGE_OUTBOX_PATH, [])
-                return self._send(200, {"count": len(outbox)})
+                source = (query.get("source", [""])[0] or "").strip()
+                known = number_param(query.get("known", [""])[0], "known", None, lo=0)
+                wait = number_param(query.get("wait", [""])[0], "wait", 0.0, float, lo=0)
+                count = outbox_count(source, known, min(wait, LONG_POLL_MAX_SEC))
+                return self._send(200, {"count": count, "seq": EVENTS.seq})
+            if path == "/api/events":
+                since = query.get("since", [""])[0] or self.headers.get("Last-Event-ID") or ""
+                return self._stream_events(number_param(since, "since", EVENTS.seq, lo=0))
             if path == "/api/bridge/inbox/last":
-                inbox = load_json(BRIDGE_INBOX_PATH, [])
-                return self._send(200, {"last": inbox[-1] if inbox else None})
+                return self._send(200, {"last": get_inbox().last()})
             if path == "/api/chats":
-                return self._send(200, {"chats": list_chat_infos()})
+                # Negative values are clamped to 0.
+                offset = max(0, number_param(query.get("offset", [""])[0], "offset", 0))
+                limit = number_param(query.get("limit", [""])[0], "limit", None)
+                since = number_param(query.get("since", [""])[0], "since", None, float)
+                chats, total = list_chat_infos(
+                    offset=offset,
+                    limit=max(0, limit) if limit is not None else None,
+                    since=max(0.0, since) if since is not None else None,
+                )
+                return self._send(200, {"chats": chats, "total": total})
             if path.startswith("/api/chat/"):
                 chat_id = path.split("/api/chat/")[-1]
-                p = os.path.join(CHATS_DIR, f"{chat_id}.json")
-                data = load_json(p, None)
+                if not CHAT_STORE.exists(chat_id):
+                    return self._send(404, {"error": "not found"})
+                # Unchanged since the client's copy: no chat file is read.
+                etag = chat_etag(chat_version(CHAT_STORE.count(chat_id)))
+                if self.headers.get("If-None-Match") == etag:
+                    return self._send(304, b"", headers={"ETag": etag})
+                after = number_param(query.get("after", [""])[0], "after", None)
+                if after is not None and 0 <= after <= CHAT_STORE.count(chat_id):
+                    return self._send_chat_since(chat_id, after, query.get("graph", [""])[0])
+                data = CHAT_STORE.load(chat_id)
                 if not data or not isinstance(data, dict):
                     return self._send(404, {"error": "not found"})
-                texts = [m.get("content", "") for m in data.get("messages", [])]
-                session_graph = build_graph_from_texts(texts)
-                session_graph = compact_graph(session_graph, MAX_SESSION_NODES, MAX_SESSION_EDGES)
-                global_graph = load_global_graph()
-                global_graph = compact_graph(global_graph, MAX_GLOBAL_NODES, MAX_GLOBAL_EDGES)
-                return self._send(200, {**data, "session_graph": session_graph, "global_graph": global_graph})
-            if path == "/api/status":
+                gv = graph_version()
+                version = chat_version(len(data.get("messages", [])), gv)
+                session_graph, global_graph = chat_graphs(chat_id, data)
                 return self._send(200, {
-                    "ok": True,
-                    "started_at": SERVER_STARTED_AT,
-                    "pid": os.getpid(),
-                    "uptime_sec": max(0, time.time() - SERVER_STARTED_AT)
-                })
+                    **data,
+                    "version": version,
+                    "graph_version": gv,
+                    "session_graph": session_graph,
+                    "global_graph": global_graph,
+                }, headers={"ETag": chat_etag(version)})
+            if path == "/api/search":
+                q = (query.get("q", [""])[0] or "").strip()
+                if not q:
+                    return self._send(400, {"error": "missing q"})
+                limit = number_param(query.get("limit", [""])[0], "limit", search.DEFAULT_LIMIT)
+                limit = max(1, min(limit, search.MAX_LIMIT))
+                chat_id = (query.get("chat_id", [""])[0] or "").strip()
+                return self._send(200, SEARCH.search(q, limit, chat_id or None))
+            if path == "/api/status":
+                return self._send(200, server_status())
+
+            if path == "/api/metrics":
+                return self._send(200, metrics.render(), "text/plain; version=0.0.4; charset=utf-8")
 
             return self._send(404, {"error": "not found"})
+        except BadRequest as e:
+            return self._send(400, {"error": str(e)})
         except Exception as e:
             return self._send(500, {"error": str(e)})
 
-    def do_POST(self):
+    def _handle_post(self):
         try:
             parsed = urlparse(self.path)
             path = parsed.path
@@ -366,6 +951,7 @@ class Handler(BaseHTTPRequestHandler):
             if path == "/api/control/shutdown":
                 def _stop():
                     time.sleep(0.2)
+                    flush_state()
                     srv = SERVER_REF.get("server")
                     if srv:
                         srv.shutdown()
@@ -376,6 +962,7 @@ class Handler(BaseHTTPRequestHandler):
             if path == "/api/control/restart":
                 def _restart():
                     time.sleep(0.2)
+                    flush_state()
                     py = sys.executable or "python3"
                     os.execv(py, [py, os.path.abspath(__file__)])
                 threading.Thread(target=_restart, daemon=True).start()
@@ -383,170 +970,253 @@ class Handler(BaseHTTPRequestHandler):
 
             if path == "/api/chat/new":
                 chat_id = new_chat_id()
-                chat = {"id": chat_id, "title": "Новый чат", "messages": []}
-                save_json(os.path.join(CHATS_DIR, f"{chat_id}.json"), chat)
+                chat = CHAT_STORE.create(chat_id)
+                CHAT_INDEX.on_create(chat)
+                EVENTS.publish("chat", {"chat_id": chat_id, "message_count": 0})
                 return self._send(200, chat)
 
+            if path == "/api/generate":
+                return self._proxy_generate(payload)
+
             if path == "/api/chat/send":
-                chat_id = payload.get("chat_id")
-                text = (payload.get("text") or "").strip()
-                model = (payload.get("model") or DEFAULT_MODEL).strip()
-                source = (payload.get("source") or "Local (Ollama)").strip()
+                chat_id = text_param(payload.get("chat_id"), "chat_id")
+                text = text_param(payload.get("text"), "text")
+                model = text_param(payload.get("model"), "model") or DEFAULT_MODEL
+                source = text_param(payload.get("source"), "source") or "Local (Ollama)"
                 enqueue = bool(payload.get("enqueue"))
                 if not chat_id or not text:
                     return self._send(400, {"error": "missing chat_id or text"})
-
-                chat_path = os.path.join(CHATS_DIR, f"{chat_id}.json")
-                chat = load_json(chat_path, {"id": chat_id, "title": "Новый чат", "messages": []})
-                chat["messages"].append({"role": "user", "content": text})
-
+                cache = gen_cache_for(payload)
+                # "history": false sends only the new text, without chat context.
+                history = payload.get("history", True) is not False
+                # "slim": true replies with the new messages instead of the chat.
+                slim = bool(payload.get("slim"))
+                if payload.get("stream") and source == "Local (Ollama)":
+                    return self._stream_chat_reply(chat_id, text, model, cache, history, slim)
+
+                # The Ollama call runs outside STATE_LOCK so a slow generation
+                # never blocks other handlers; the chat is reloaded afterwards.
+                report = None
+                final = {}
                 if source == "Local (Ollama)":
+                    prompt, context, report = chat_turn(chat_id, model, text, history)
                     try:
-                        response = call_ollama(model, text)
+                        response = call_ollama(model, prompt, cache=cache if context is None else None,
+                                               context=context, final=final)
+                    except scheduler.Busy as e:
+                        return self._send_busy(e)
                     except urllib.error.URLError as e:
                         response = f"Ошибка подключения к Ollama: {e}"
                     except Exception as e:
                         response = f"Ошибка: {e}"
-                    chat["messages"].append({"role": "assistant", "content": response})
                 else:
                     response = f"[Ожидаю ответ из {source}. Вставьте ответ вручную через кнопку «Добавить ответ».]"
-                    chat["messages"].append({"role": "assistant", "content": response})
                     if enqueue:
-                        outbox = load_json(BRIDGE_OUTBOX_PATH, [])
-                        outbox.append({"chat_id": chat_id, "source": source, "text": text, "ts": time.time()})
-                        save_json(BRIDGE_OUTBOX_PATH, outbox)
-                        print(f"[Outbox] enqueued: source={source} size={len(outbox)}")
+                        item_id = get_outbox().enqueue(chat_id, source, text)
+                        outbox_changed(source)
+                        print(f"[Outbox] enqueued: source={source} id={item_id}")
                     else:
                         print(f"[Outbox] NOT enqueued: source={source} enqueue={enqueue}")
 
-                save_json(chat_path, chat)
+                reply = append_chat_messages(chat_id, [
+                    {"role": "user", "content": text},
+                    {"role": "assistant", "content": response},
+                ], slim)
+                if report is not None:
+                    CONTEXT.commit(chat_id, model, reply["message_count"], final.get("context"))
 
-                # graphs
-                texts = [m.get("content", "") for m in chat.get("messages", [])]
-                session_graph = build_graph_from_texts(texts)
-                session_graph = compact_graph(session_graph, MAX_SESSION_NODES, MAX_SESSION_EDGES)
-                global_graph = load_global_graph()
-                global_graph = merge_graph(global_graph, session_graph)
-                global_graph = compact_graph(global_graph, MAX_GLOBAL_NODES, MAX_GLOBAL_EDGES)
-                save_json(GLOBAL_GRAPH_PATH, global_graph)
+                return self._send(200, {"response": response, **reply, "context_stats": report})
 
-                return self._send(200, {"response": response, "chat": chat, "session_graph": session_graph, "global_graph": global_graph})
+            if path == "/api/models/refresh":
+                return self._send(200, models_payload(MODELS.refresh()))
 
             if path == "/api/models/add":
                 name = (payload.get("name") or "").strip()
                 if not name:
                     return self._send(400, {"error": "empty"})
-                config = load_json(CONFIG_PATH, {"manual_models": [DEFAULT_MODEL], "last_model": DEFAULT_MODEL})
-                manual = config.get("manual_models", [])
-                if name not in manual:
-                    manual.append(name)
-                config["manual_models"] = manual
-                save_json(CONFIG_PATH, config)
+                with STATE_LOCK:
+                    config = STATE_FILES.load(CONFIG_PATH, {"manual_models": [DEFAULT_MODEL], "last_model": DEFAULT_MODEL})
+                    manual = config.get("manual_models", [])
+                    if name not in manual:
+                        manual.append(name)
+                    config["manual_models"] = manual
+                    STATE_FILES.save(CONFIG_PATH, config)
                 return self._send(200, {"ok": True})
 
             if path == "/api/models/last":
                 name = (payload.get("name") or "").strip()
-                config = load_json(CONFIG_PATH, {"manual_models": [DEFAULT_MODEL], "last_model": DEFAULT_MODEL})
-                if name:
-                    config["last_model"] = name
-                save_json(CONFIG_PATH, config)
+                with STATE_LOCK:
+                    config = STATE_FILES.load(CONFIG_PATH, {"manual_models": [DEFAULT_MODEL], "last_model": DEFAULT_MODEL})
+                    if name:
+                        config["last_model"] = name
+                    STATE_FILES.save(CONFIG_PATH, config)
                 return self._send(200, {"ok": True})
 
             if path == "/api/sources/add":
                 name = (payload.get("name") or "").strip()
                 if not name:
                     return self._send(400, {"error": "empty"})
-                config = load_json(CONFIG_PATH, {"sources": DEFAULT_SOURCES, "last_source": DEFAULT_SOURCES[0], "bridge_target": ""})
-                sources = config.get("sources") or DEFAULT_SOURCES
-                if name not in sources:
-                    sources.append(name)
-                config["sources"] = sources
-                save_json(CONFIG_PATH, config)
+                with STATE_LOCK:
+                    config = STATE_FILES.load(CONFIG_PATH, {"sources": DEFAULT_SOURCES, "last_source": DEFAULT_SOURCES[0], "bridge_target": ""})
+                    sources = config.get("sources") or DEFAULT_SOURCES
+                    if name not in sources:
+                        sources.append(name)
+                    config["sources"] = sources
+                    STATE_FILES.save(CONFIG_PATH, config)
                 return self._send(200, {"ok": True})
 
             if path == "/api/sources/last":
                 name = (payload.get("name") or "").strip()
-                config = load_json(CONFIG_PATH, {"sources": DEFAULT_SOURCES, "last_source": DEFAULT_SOURCES[0], "bridge_target": ""})
-                if name:
-                    config["last_source"] = name
-                save_json(CONFIG_PATH, config)
+                with STATE_LOCK:
+                    config = STATE_FILES.load(CONFIG_PATH, {"sources": DEFAULT_SOURCES, "last_source": DEFAULT_SOURCES[0], "bridge_target": ""})
+                    if name:
+                        config["last_source"] = name
+                    STATE_FILES.save(CONFIG_PATH, config)
                 return self._send(200, {"ok": True})
 
             if path == "/api/bridge/ingest":
-                config = load_json(CONFIG_PATH, {"sources": DEFAULT_SOURCES, "last_source": DEFAULT_SOURCES[0], "bridge_target": ""})
-                chat_id = (payload.get("chat_id") or config.get("bridge_target") or "").strip()
-                if not chat_id:
-                    chats = list_chats()
-                    if chats:
-                        chat_id = chats[0]
-                source = (payload.get("source") or "Bridge").strip()
-                text = (payload.get("text") or "").strip()
+                chat_id = text_param(payload.get("chat_id"), "chat_id") or bridge_default_chat()
+                source = text_param(payload.get("source"), "source") or "Bridge"
+                text = text_param(payload.get("text"), "text")
                 if not chat_id or not text:
                     return self._send(400, {"error": "missing chat_id or text"})
-                chat_path = os.path.join(CHATS_DIR, f"{chat_id}.json")
-                chat = load_json(chat_path, {"id": chat_id, "title": "Новый чат", "messages": []})
-                chat["messages"].append({"role": "assistant", "content": f"[{source}] {text}"})
-                save_json(chat_path, chat)
+                reply = append_chat_messages(chat_id, [
+                    {"role": "assistant", "content": f"[{source}] {text}"},
+                ], bool(payload.get("slim")))
                 print(f"[Bridge] ingest: chat_id={chat_id} source={source} len={len(text)}")
-                inbox = load_json(BRIDGE_INBOX_PATH, [])
-                inbox.append({"chat_id": chat_id, "source": source, "text": text, "ts": time.time()})
-                save_json(BRIDGE_INBOX_PATH, inbox)
-                texts = [m.get("content", "") for m in chat.get("messages", [])]
-                session_graph = build_graph_from_texts(texts)
-                session_graph = compact_graph(session_graph, MAX_SESSION_NODES, MAX_SESSION_EDGES)
-                global_graph = load_global_graph()
-                global_graph = merge_graph(global_graph, session_graph)
-                global_graph = compact_graph(global_graph, MAX_GLOBAL_NODES, MAX_GLOBAL_EDGES)
-                save_json(GLOBAL_GRAPH_PATH, global_graph)
-                return self._send(200, {"ok": True, "chat": chat, "session_graph": session_graph, "global_graph": global_graph})
+                item = {"chat_id": chat_id, "source": source, "text": text, "ts": time.time()}
+                get_inbox().append(item, inbox_retention())
+                EVENTS.publish("inbox", {"last": item})
+                return self._send(200, {"ok": True, **reply})
+
+            if path == "/api/bridge/ingest/batch":
+                items = payload.get("items")
+                if not isinstance(items, list) or not items:
+                    return self._send(400, {"error": "missing items"})
+                if len(items) > MAX_INGEST_BATCH:
+                    return self._send(400, {"error": f"too many items (max {MAX_INGEST_BATCH})"})
+                results = ingest_batch(items)
+                return self._send(200, {"ok": all(r["ok"] for r in results), "results": results})
 
             if path == "/api/bridge/target/set":
-                chat_id = (payload.get("chat_id") or "").strip()
-                config = load_json(CONFIG_PATH, {"sources": DEFAULT_SOURCES, "last_source": DEFAULT_SOURCES[0], "bridge_target": ""})
-                if chat_id:
-                    config["bridge_target"] = chat_id
-                    save_json(CONFIG_PATH, config)
+                chat_id = text_param(payload.get("chat_id"), "chat_id")
+                with STATE_LOCK:
+                    config = STATE_FILES.load(CONFIG_PATH, {"sources": DEFAULT_SOURCES, "last_source": DEFAULT_SOURCES[0], "bridge_target": ""})
+                    if chat_id:
+                        config["bridge_target"] = chat_id
+                        STATE_FILES.save(CONFIG_PATH, config)
                 return self._send(200, {"ok": True, "bridge_target": config.get("bridge_target", "")})
 
             if path == "/api/bridge/outbox/enqueue":
-                chat_id = (payload.get("chat_id") or "").strip()
-                source = (payload.get("source") or "").strip()
-                text = (payload.get("text") or "").strip()
+                chat_id = text_param(payload.get("chat_id"), "chat_id")
+                source = text_param(payload.get("source"), "source")
+                text = text_param(payload.get("text"), "text")
                 if not chat_id or not source or not text:
                     return self._send(400, {"error": "missing chat_id/source/text"})
-                outbox = load_json(BRIDGE_OUTBOX_PATH, [])
-                outbox.append({"chat_id": chat_id, "source": source, "text": text, "ts": time.time()})
-                save_json(BRIDGE_OUTBOX_PATH, outbox)
-                return self._send(200, {"ok": True})
+                item_id = get_outbox().enqueue(chat_id, source, text)
+                outbox_changed(source)
+                return self._send(200, {"ok": True, "id": item_id})
+
+            if path == "/api/bridge/outbox/claim":
+                # Lease-based dequeue: the item comes back unless it is acked
+                # within "visibility" seconds. "wait" long-polls for an item.
+                source = (payload.get("source") or "").strip()
+                visibility = number_param(payload.get("visibility"), "visibility", outbox.VISIBILITY_SEC, float,
+                                          lo=0, hi=MAX_VISIBILITY_SEC)
+                wait = number_param(payload.get("wait"), "wait", 0.0, float, lo=0)
+                item = claim_outbox(source, visibility, min(wait, LONG_POLL_MAX_SEC))
+                if item is not None:
+                    print(f"[Outbox] claim: source={item['source']} id={item['id']} attempt={item['attempt']}")
+                return self._send(200, {"item": item})
+
+            if path in ("/api/bridge/outbox/ack", "/api/bridge/outbox/nack"):
+                try:
+                    item_id = int(payload.get("id"))
+                except (TypeError, ValueError):
+                    return self._send(400, {"error": "missing id"})
+                token = payload.get("token") or ""
+                if path.endswith("/ack"):
+                    source = get_outbox().ack(item_id, token)
+                else:
+                    source = get_outbox().nack(item_id, token)
+                if source is not None:
+                    outbox_changed(source)
+                return self._send(200, {"ok": source is not None})
 
             if path == "/api/graph/reset":
-                save_json(GLOBAL_GRAPH_PATH, {"nodes": {}, "edges": {}})
+                with STATE_LOCK:
+                    GRAPH.reset()
                 return self._send(200, {"ok": True})
 
             return self._send(404, {"error": "not found"})
+        except BadRequest as e:
+            return self._send(400, {"error": str(e)})
         except Exception as e:
             return self._send(500, {"error": str(e)})
 
     def _send_file(self, filename, content_type):
-        path = os.path.join(BASE_DIR, filename)
-        if not os.path.exists(path):
+        entry = STATIC_FILES.get(filename)
+        if entry is None:
             return self._send(404, {"error": "file not found"})
-        with open(path, "rb") as f:
-            data = f.read()
-        self._send(200, data, content_type)
+        # Revalidated on every load; unchanged files cost a 304. The encoding
+        # is chosen as in _send(), and each one has its own ETag.
+        body = entry["body"]
+        headers = {"Cache-Control": "no-cache"}
+        encoding = None
+        if len(body) >= compress.COMPRESS_MIN_BYTES:
+            headers["Vary"] = "Accept-Encoding"
+            encoding = compress.negotiate(self.headers.get("Accept-Encoding"))
+            if encoding not in entry["variants"]:
+                encoding = None
+        headers["ETag"] = entry["etags"][encoding]
+        if self.headers.get("If-None-Match") == headers["ETag"]:
+            return self._send(304, b"", content_type, headers)
+        self._send(200, body, content_type, headers, entry["variants"])
+
+
+class PooledHTTPServer(ThreadingHTTPServer):
+    # ThreadingHTTPServer spawns an unbounded thread per connection;
+    # hand requests to a fixed pool instead.
+    def __init__(self, server_address, handler_class, workers=SERVER_WORKERS):
+        super().__init__(server_address, handler_class)
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="http")
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=False)
+
+
+def make_server(host="0.0.0.0", port=5050, workers=SERVER_WORKERS):
+    SERVER_REF["waiters"] = threading.BoundedSemaphore(max(1, workers // 2)) if workers and workers > 0 else None
+    if workers and workers > 0:
+        SCHEDULER.fit(workers - max(1, workers // 2) - RESERVED_WORKERS)
+        return PooledHTTPServer((host, port), Handler, workers=workers)
+    return HTTPServer((host, port), Handler)
 
 
 def main():
     ensure_dirs()
+    CHAT_INDEX.load()
     # auto-fix oversized global graph on startup
     try:
         load_global_graph()
     except Exception:
         pass
-    server = HTTPServer(("0.0.0.0", 5050), Handler)
+    # Warm the model catalog before the first page load asks for it.
+    MODELS.get(wait=0)
+    SEARCH.start()
+    server = make_server()
     SERVER_REF["server"] = server
-    print("Local Bot UI running at http://127.0.0.1:5050 (listening on 0.0.0.0)")
-    server.serve_forever()
+    mode = f"{SERVER_WORKERS} workers" if SERVER_WORKERS > 0 else "single-threaded"
+    print(f"Local Bot UI running at http://127.0.0.1:5050 (listening on 0.0.0.0, {mode})")
+    try:
+        server.serve_forever()
+    finally:
+        EVENTS.close()
+        flush_state()
 
 
 if __name__ == "__main__":
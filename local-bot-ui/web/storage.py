@@ -0,0 +1,286 @@
+import copy
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import timer
+
+# Every save is written to a temp file and renamed over the target, so a crash
+# leaves either the old or the new file, never a truncated one. With FSYNC on,
+# the data is fsynced before the rename; concurrent writers share those fsyncs
+# through one GroupCommit (see below). LOCAL_BOT_FSYNC=0 keeps the atomic
+# rename but skips fsync; LOCAL_BOT_COMPACT_JSON=1 drops indentation everywhere.
+FSYNC = os.environ.get("LOCAL_BOT_FSYNC", "1") != "0"
+COMPACT_JSON = os.environ.get("LOCAL_BOT_COMPACT_JSON", "0") == "1"
+# Extra time a commit leader waits for more writers to join its batch.
+GROUP_COMMIT_SEC = 0.0
+FSYNC_WORKERS = 8
+
+
+def load_json(path, default):
+    with timer("local_bot_disk_seconds", op="load"):
+        return _read_json(path, default)
+
+
+def _read_json(path, default):
+    if not os.path.exists(path):
+        return default
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except ValueError:
+        # Kept aside instead of being overwritten by the next save.
+        aside = f"{path}.corrupt"
+        try:
+            os.replace(path, aside)
+            print(f"[Storage] unreadable {os.path.basename(path)} moved to {os.path.basename(aside)}")
+        except OSError:
+            pass
+        return default
+    except Exception:
+        return default
+
+
+def dump_json(data, compact=None):
+    if compact is None:
+        compact = COMPACT_JSON
+    if compact:
+        text = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+    else:
+        text = json.dumps(data, ensure_ascii=False, indent=2)
+    return text.encode("utf-8")
+
+
+def _write_temp(path, payload, fsync):
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(payload)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+    except BaseException:
+        _unlink_quiet(tmp)
+        raise
+    return tmp
+
+
+def _unlink_quiet(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+def _fsync_path(path, directory=False):
+    fd = os.open(path, os.O_RDONLY | (getattr(os, "O_DIRECTORY", 0) if directory else 0))
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class GroupCommit:
+    # Classic group commit: the first writer to arrive becomes the leader and
+    # commits everything queued so far; writers arriving meanwhile wait for the
+    # next batch, which the leader also commits before stepping down. Repeated
+    # saves of one path in a batch collapse into one write, and each directory
+    # is fsynced once per batch. Every path is written, synced and renamed on its
+    # own: a failing path raises in each writer that submitted it and does not
+    # keep the rest of the batch from being committed.
+    def __init__(self, window=GROUP_COMMIT_SEC):
+        self.window = window
+        self._cond = threading.Condition()
+        self._replace = {}
+        self._sync = set()
+        # {"path", "error"} of every writer waiting on the batch being queued
+        self._waiters = []
+        self._gen = 0
+        self._committed = 0
+        self._leader = False
+        self._pool = None
+        self.batches = 0
+        self.fsyncs = 0
+
+    def submit(self, path, payload=None):
+        # payload: bytes to put at path atomically; None: fsync an appended file.
+        waiter = {"path": path, "error": None}
+        with self._cond:
+            if payload is None:
+                self._sync.add(path)
+            else:
+                self._replace[path] = payload
+            self._waiters.append(waiter)
+            gen = self._gen
+            lead = not self._leader
+            if lead:
+                self._leader = True
+            else:
+                while self._committed <= gen:
+                    self._cond.wait()
+        if lead:
+            self._lead()
+        if waiter["error"] is not None:
+            raise waiter["error"]
+
+    def _lead(self):
+        while True:
+            if self.window:
+                time.sleep(self.window)
+            with self._cond:
+                replace, sync, waiters = self._replace, self._sync, self._waiters
+                self._replace, self._sync, self._waiters = {}, set(), []
+                gen = self._gen
+                self._gen += 1
+            try:
+                errors = self._commit(replace, sync)
+            except Exception as e:
+                errors = {path: e for path in list(replace) + list(sync)}
+            for path, e in errors.items():
+                print(f"[Storage] commit failed for {os.path.basename(path)}: {e}")
+            with self._cond:
+                for waiter in waiters:
+                    waiter["error"] = errors.get(waiter["path"])
+                self._committed = gen + 1
+                self._cond.notify_all()
+                if not self._replace and not self._sync:
+                    self._leader = False
+                    break
+
+    def _commit(self, replace, sync):
+        # Returns {path: exception} for the paths that failed. The batch's
+        # fsyncs are issued in parallel so the filesystem can fold them into
+        # one journal commit; renames wait for all data to be durable.
+        errors = {}
+        temps = {}
+        for path, payload in replace.items():
+            try:
+                temps[path] = _write_temp(path, payload, False)
+            except OSError as e:
+                errors[path] = e
+        jobs = [(tmp, False, path) for path, tmp in temps.items()] + [(path, False, path) for path in sync]
+        errors.update(self._fsync_all(jobs))
+        dirs = set()
+        for path, tmp in temps.items():
+            if path in errors:
+                _unlink_quiet(tmp)
+                continue
+            try:
+                os.replace(tmp, path)
+            except OSError as e:
+                errors[path] = e
+                _unlink_quiet(tmp)
+                continue
+            dirs.add(os.path.dirname(os.path.abspath(path)))
+        self._fsync_all([(d, True, d) for d in dirs])
+        self.batches += 1
+        return errors
+
+    def _fsync_all(self, jobs):
+        # jobs: (path to fsync, is directory, path to blame). Returns
+        # {path to blame: exception} for failed file fsyncs.
+        def run(job):
+            try:
+                _fsync_path(job[0], job[1])
+                return 1, None
+            except FileNotFoundError:
+                return 0, None
+            except OSError as e:
+                # Directories cannot be opened for fsync on every platform.
+                return 0, None if job[1] else e
+        if len(jobs) <= 1:
+            results = [run(job) for job in jobs]
+        else:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=FSYNC_WORKERS, thread_name_prefix="fsync")
+            results = list(self._pool.map(run, jobs))
+        self.fsyncs += sum(n for n, _e in results)
+        return {job[2]: e for job, (_n, e) in zip(jobs, results) if e is not None}
+
+
+COMMITTER = GroupCommit()
+
+
+def save_json(path, data, compact=None):
+    payload = dump_json(data, compact)
+    with timer("local_bot_disk_seconds", op="save"):
+        if FSYNC:
+            COMMITTER.submit(path, payload)
+        else:
+            tmp = _write_temp(path, payload, False)
+            try:
+                os.replace(tmp, path)
+            except OSError:
+                _unlink_quiet(tmp)
+                raise
+
+
+def sync_appended(path):
+    # Call after appending to a log file; batched with concurrent saves.
+    if FSYNC:
+        with timer("local_bot_disk_seconds", op="sync"):
+            COMMITTER.submit(path)
+
+
+# Small state files (config, bridge queues) that are read on almost every
+# request. A cache entry is re-validated against the file's mtime/size at most
+# every STAT_INTERVAL_SEC, so hand edits are picked up, and writes are
+# batched: save() updates memory right away and the file after FLUSH_SEC.
+STAT_INTERVAL_SEC = 1.0
+FLUSH_SEC = 0.5
+
+
+def _stat_key(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+class JsonCache:
+    def __init__(self, flush_sec=FLUSH_SEC, stat_interval=STAT_INTERVAL_SEC):
+        self.flush_sec = flush_sec
+        self.stat_interval = stat_interval
+        self._lock = threading.RLock()
+        # path -> {"data", "stat", "checked", "dirty"}; data None = no file.
+        self._entries = {}
+        self._timer = None
+        self.disk_reads = 0
+
+    def load(self, path, default):
+        # Returns a private copy: callers may mutate it and save() it back.
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is None or (not entry["dirty"] and now - entry["checked"] >= self.stat_interval):
+                stat = _stat_key(path)
+                if entry is None or stat != entry["stat"]:
+                    data = load_json(path, None) if stat is not None else None
+                    self.disk_reads += 1
+                    entry = self._entries[path] = {"data": data, "stat": stat, "checked": now, "dirty": False}
+                else:
+                    entry["checked"] = now
+            data = entry["data"]
+            return copy.deepcopy(default if data is None else data)
+
+    def save(self, path, data):
+        with self._lock:
+            self._entries[path] = {"data": copy.deepcopy(data), "stat": None, "checked": time.monotonic(), "dirty": True}
+            if self._timer is None:
+                self._timer = threading.Timer(self.flush_sec, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        with self._lock:
+            self._timer = None
+            for path, entry in self._entries.items():
+                if not entry["dirty"]:
+                    continue
+                save_json(path, entry["data"])
+                entry["stat"] = _stat_key(path)
+                entry["checked"] = time.monotonic()
+                entry["dirty"] = False